@@ -0,0 +1,101 @@
+#! encoding = utf-8
+
+""" Benchmark how much an online backup slows down normal edits. Notes are
+saved one after the other while backups run in a background thread, and
+the save latency is compared with saves without a backup.
+
+Usage: python bench/bench_backup.py [n_notes] [n_images]
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from os.path import dirname, realpath, getsize
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+from liternote_backup import create_backup
+from liternote_img import open_image_store
+from bench_fts_tokenizer import fill, synthetic_note
+
+N_EDITS = 300
+
+
+def edit_latency(conn, c, rnd, n_notes):
+    """ Save N_EDITS random notes, return the latencies in ms """
+    latency = []
+    for i in range(N_EDITS):
+        j = rnd.randrange(n_notes)
+        entry_dict = synthetic_note(rnd, j)
+        id_ = ln.db_bibkey_id(c, entry_dict['bibkey'])
+        t0 = time.perf_counter()
+        ln.db_update_entry(conn, c, id_, entry_dict)
+        latency.append((time.perf_counter() - t0) * 1e3)
+        time.sleep(0.005)   # typing between saves
+    return latency
+
+
+def report(label, latency):
+    latency = sorted(latency)
+    print('  {:28s} median {:6.2f} ms   p99 {:7.2f} ms   max {:7.2f} ms'.format(
+        label, statistics.median(latency), latency[int(len(latency) * 0.99)],
+        latency[-1]))
+
+
+def during_backups(db_file, store, root, conn, c, rnd, n_notes, pages):
+    """ Edit while backups run back to back """
+    stop = threading.Event()
+    infos = []
+
+    def run():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            info = create_backup(db_file, store, root, keep=2, pages=pages)
+            info['seconds'] = time.perf_counter() - t0
+            infos.append(info)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    latency = edit_latency(conn, c, rnd, n_notes)
+    stop.set()
+    thread.join()
+    return latency, infos
+
+
+def main():
+    n_notes = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n_images = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_file = path_join(tmpdir, 'liternote.db')
+        conn, c = ln.create_or_open_db(db_file)
+        conn.execute('PRAGMA journal_mode=WAL')
+        fill(conn, c, n_notes)
+        store = open_image_store('file', path_join(tmpdir, 'img'))
+        for i in range(n_images):
+            store.write('img{:06d}.png'.format(i), os.urandom(30 * 1024))
+        print('{:d} notes ({:.0f} MB), {:d} images'.format(
+            n_notes, getsize(db_file) / 1e6, n_images))
+
+        report('no backup', edit_latency(conn, c, rnd, n_notes))
+        for label, pages in (('stepped backup', 256), ('small-step backup', 32),
+                             ('one-step backup', -1)):
+            root = path_join(tmpdir, 'backup_' + label.split()[0])
+            latency, infos = during_backups(db_file, store, root, conn, c, rnd,
+                                            n_notes, pages)
+            report('during ' + label, latency)
+            print('    {:d} backups, first {:.2f} s ({:d} new images), '
+                  'then {:.2f} s ({:d} new images)'.format(
+                    len(infos), infos[0]['seconds'], infos[0]['new_images'],
+                    infos[-1]['seconds'], infos[-1]['new_images']))
+        store.close()
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
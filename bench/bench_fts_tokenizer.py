@@ -0,0 +1,93 @@
+#! encoding = utf-8
+
+""" Benchmark index size and query latency of the fts tokenizer presets.
+
+Usage: python bench/bench_fts_tokenizer.py [n_notes]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from os.path import dirname, realpath, getsize
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+
+WORDS = ['spectroscopy', 'spectroscopic', 'molecule', 'molecular', 'laser',
+         'rotational', 'vibrational', 'transition', 'frequency', 'cavity',
+         'interstellar', 'astrochemistry', 'quantum', 'calculation', 'basis',
+         'harmonic', 'anharmonic', 'coupling', 'hyperfine', 'dipole',
+         'measurement', 'instrument', 'detector', 'emission', 'absorption']
+AUTHORS = ['Jérôme Müller', 'Ångström Søren', 'Zou Luyao', 'Nuñez José',
+           'Smith John', 'Dvořák Antonín', 'Öztürk Ayşe', 'Lee Kim']
+QUERIES = ['spectroscopy', 'spectroscop*', 'mol*', 'jerome', 'Jérôme',
+           'rotational transition']
+
+
+def synthetic_note(rnd, i):
+    def text(n):
+        return ' '.join(rnd.choice(WORDS) for _ in range(n))
+    return {'bibkey': 'key{:06d}'.format(i),
+            'author': ', '.join(rnd.sample(AUTHORS, 3)),
+            'genre': rnd.choice(['Code', 'Experiment', 'Instrum', 'Theory', 'Review']),
+            'thesis': text(30), 'hypothesis': text(30), 'method': text(120),
+            'finding': text(120), 'comment': text(40), 'img_linkstr': ''}
+
+
+def fill(conn, c, n):
+    rnd = random.Random(0)
+    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
+              'method', 'finding', 'comment', 'img_linkstr']
+    sql = 'INSERT INTO note ({:s}) VALUES (?,?,?,?,?,?,?,?,?)'.format(','.join(fields))
+    c.executemany(sql, (tuple(synthetic_note(rnd, i)[f] for f in fields)
+                        for i in range(n)))
+    conn.commit()
+
+
+def bench(n, tokenizer, prefix, tmpdir):
+    filename = path_join(tmpdir, 'bench.db')
+    if os.path.isfile(filename):
+        os.remove(filename)
+    conn, c = ln.create_or_open_db(filename)
+    fill(conn, c, n)
+    t0 = time.perf_counter()
+    ln.db_rebuild_fts(conn, c, tokenizer, prefix, chunk=1000)
+    t_build = time.perf_counter() - t0
+    c.execute('VACUUM')
+    size_before = getsize(filename)
+    c.execute("SELECT SUM(LENGTH(block)) FROM fts_data")
+    size_fts = c.fetchone()[0]
+    latency = {}
+    for q in QUERIES:
+        t0 = time.perf_counter()
+        for _ in range(20):
+            try:
+                n_hit = len(ln.db_search_fulltext(c, 'ALL', 'ALL', q))
+            except sqlite3.OperationalError:
+                # e.g. a trigram query shorter than three characters
+                n_hit = -1
+        latency[q] = ((time.perf_counter() - t0) / 20 * 1e3, n_hit)
+    conn.close()
+    return t_build, size_before, size_fts, latency
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    configs = [(tok, '') for tok in ln.FTS_TOKENIZERS] + \
+              [('unicode61', '2 3'), ('porter (fold diacritics)', '2 3')]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for tokenizer, prefix in configs:
+            t_build, size_db, size_fts, latency = bench(n, tokenizer, prefix, tmpdir)
+            print('{:s} prefix=[{:s}]'.format(tokenizer, prefix))
+            print('  build {:.2f} s, db {:.1f} MB, fts index {:.1f} MB'.format(
+                t_build, size_db / 1e6, size_fts / 1e6))
+            for q, (ms, n_hit) in latency.items():
+                print('  {:24s} {:8.2f} ms  {:6d} hits'.format(q, ms, n_hit))
+
+
+if __name__ == '__main__':
+    main()
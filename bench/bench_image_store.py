@@ -0,0 +1,62 @@
+#! encoding = utf-8
+
+""" Compare the image storage backends: write time, load latency and the
+cost of a sync / backup pass (walking the store and copying it).
+
+Usage: python bench/bench_image_store.py [n_images] [kbytes_per_image]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os.path import dirname, realpath
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+from liternote_img import IMAGE_BACKENDS, open_image_store
+
+
+def sync_pass(src_dir, dst_dir):
+    """ What a naive backup / sync tool does: stat every file and copy it """
+    n_files = 0
+    for root, dirs, files in os.walk(src_dir):
+        for name in files:
+            os.stat(path_join(root, name))
+            n_files += 1
+    shutil.copytree(src_dir, dst_dir)
+    return n_files
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    rnd = random.Random(0)
+    payload = os.urandom(size * 1024)
+    names = list('key{:06d}_{:d}.png'.format(i, rnd.getrandbits(40)) for i in range(n))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in IMAGE_BACKENDS:
+            img_dir = path_join(tmpdir, backend, 'img')
+            store = open_image_store(backend, img_dir)
+            t0 = time.perf_counter()
+            for name in names:
+                store.write(name, payload)
+            t_write = time.perf_counter() - t0
+            sample = rnd.sample(names, min(n, 1000))
+            t0 = time.perf_counter()
+            for name in sample:
+                store.read(name)
+            t_read = (time.perf_counter() - t0) / len(sample)
+            store.close()
+            t0 = time.perf_counter()
+            n_files = sync_pass(img_dir, path_join(tmpdir, backend, 'copy'))
+            t_sync = time.perf_counter() - t0
+            print('{:6s} write {:6.2f} ms/img, load {:6.3f} ms/img, '
+                  'sync pass {:6.2f} s over {:d} files'.format(
+                      backend, t_write / n * 1e3, t_read * 1e3, t_sync, n_files))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#! encoding = utf-8
+
+""" Compare image ingest policies: encoded size, encode time and decode
+(load) time of a synthetic screenshot-like diagram and a photo-like image.
+Needs PyQt5, runs without a display.
+
+Usage: python bench/bench_ingest_policy.py [width] [height]
+"""
+
+import os
+import random
+import sys
+import time
+from os.path import dirname, realpath
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+from PyQt5 import QtWidgets
+from PyQt5.QtGui import QImage, QPainter, QColor, QFont
+from liternote_img import IMAGE_POLICY_DEFAULT
+from liternote import encode_img
+
+POLICIES = [
+    ('full png (old)', {'max_dim': 0, 'format': 'png', 'png_level': 6}),
+    ('png level 9', {'max_dim': 0, 'format': 'png', 'png_level': 9}),
+    ('png 1920 + palette', {'max_dim': 1920, 'format': 'png', 'quantize': True}),
+    ('jpeg 1920 q85', {'max_dim': 1920, 'format': 'jpeg', 'quality': 85}),
+    ('webp 1920 q85', {'max_dim': 1920, 'format': 'webp', 'quality': 85}),
+    ('auto (default)', {}),
+]
+
+
+def diagram(width, height):
+    """ White background with text lines and a few flat colored boxes """
+    img = QImage(width, height, QImage.Format_RGB32)
+    img.fill(QColor('white'))
+    painter = QPainter(img)
+    painter.setFont(QFont('Sans', 14))
+    rnd = random.Random(0)
+    for y in range(30, height, 28):
+        painter.drawText(20, y, ' '.join('lorem ipsum dolor' for _ in range(8)))
+    for _ in range(10):
+        painter.fillRect(rnd.randrange(width), rnd.randrange(height), 200, 120,
+                         QColor(rnd.choice(['#0066cc', '#cc0000', '#00aa44'])))
+    painter.end()
+    return img
+
+
+def photo(width, height):
+    """ Smooth gradients with noise, many distinct colors """
+    img = QImage(width, height, QImage.Format_RGB32)
+    rnd = random.Random(0)
+    for y in range(height):
+        for x in range(0, width, 4):
+            v = (x * 255 // width + rnd.randrange(24)) & 0xff
+            img.setPixel(x, y, QColor(v, (y * 255 // height) & 0xff,
+                                      (v + y) & 0xff).rgb())
+            img.setPixel(min(x + 1, width - 1), y, img.pixel(x, y))
+    return img
+
+
+def main():
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 3840
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 2160
+    app = QtWidgets.QApplication(sys.argv[:1])
+    for kind, img in [('diagram', diagram(width, height)),
+                      ('photo', photo(width, height))]:
+        print('{:s} {:d}x{:d}'.format(kind, width, height))
+        for label, options in POLICIES:
+            policy = dict(IMAGE_POLICY_DEFAULT)
+            policy.update(options)
+            t0 = time.perf_counter()
+            data, ext = encode_img(img, policy)
+            t_encode = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            QImage.fromData(data)
+            t_decode = time.perf_counter() - t0
+            print('  {:20s} {:4s} {:8.1f} kB, encode {:7.1f} ms, '
+                  'decode {:6.1f} ms'.format(label, ext, len(data) / 1024,
+                                             t_encode * 1e3, t_decode * 1e3))
+    del app
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#! encoding = utf-8
+
+""" Benchmark the citation graph: building the bibkey matcher, finding the
+links of all notes, the cost added to a save, and the latency of cites /
+cited by / neighbourhood queries.
+
+Every note mentions a few other notes in its comment, preferring recent
+ones, so that some notes are cited much more often than others.
+
+Usage: python bench/bench_links.py [n_notes] [mentions_per_note]
+"""
+
+import random
+import statistics
+import sys
+import tempfile
+import time
+from os.path import dirname, realpath
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+from bench_fts_tokenizer import fill, synthetic_note
+
+
+def timed(f, *args, repeat=200):
+    """ Return the median latency of f(*args) in ms, and its last result """
+    latency = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        res = f(*args)
+        latency.append((time.perf_counter() - t0) * 1e3)
+    return statistics.median(latency), res
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn, c = ln.create_or_open_db(path_join(tmpdir, 'bench.db'))
+        fill(conn, c, n)
+        keys = list('key{:06d}'.format(i) for i in range(n))
+        c.executemany('UPDATE note SET comment = comment || (?) WHERE id = (?)',
+                      ((' see ' + ', '.join(keys[int(i * rnd.random() ** 0.5)]
+                                            for _ in range(k)), i + 1)
+                       for i in range(1, n)))
+        conn.commit()
+        print('{:d} notes, {:d} mentions each'.format(n, k))
+
+        t0 = time.perf_counter()
+        ln.db_rebuild_links(conn, c)
+        t_build = time.perf_counter() - t0
+        c.execute('SELECT COUNT(*) FROM note_link')
+        print('  find all links    {:6.1f} s, {:d} links'.format(t_build, c.fetchone()[0]))
+        ln._link_matchers.clear()
+        t0 = time.perf_counter()
+        with ln._link_lock:
+            ln._link_matcher(c)
+        print('  build matcher     {:6.2f} s'.format(time.perf_counter() - t0))
+
+        entry_dict = synthetic_note(rnd, n // 2)
+        entry_dict['comment'] += ' see ' + ', '.join(rnd.sample(keys, k))
+        id_ = ln.db_bibkey_id(c, entry_dict['bibkey'])
+        t_save, _ = timed(ln.db_update_entry, conn, c, id_, entry_dict, repeat=50)
+        t_find, _ = timed(ln._index_links, c, id_, repeat=50)
+        print('  save              {:6.2f} ms, of which links {:.2f} ms'.format(t_save, t_find))
+
+        # the most cited note, and a typical one
+        c.execute(""" SELECT dst_id FROM note_link GROUP BY dst_id
+        ORDER BY COUNT(*) DESC LIMIT 1""")
+        hub = 'key{:06d}'.format(c.fetchone()[0] - 1)
+        for label, bibkey in (('typical', keys[n // 2]), ('most cited', hub)):
+            print('  {:s} note {:s}'.format(label, bibkey))
+            t, res = timed(ln.db_links, c, bibkey)
+            print('    cites             {:7.2f} ms {:7d} notes'.format(t, len(res)))
+            t, res = timed(ln.db_links, c, bibkey, True)
+            print('    cited by          {:7.2f} ms {:7d} notes'.format(t, len(res)))
+            for hops in (1, 2, 3):
+                t, res = timed(ln.db_link_neighbourhood, c, bibkey, hops, repeat=20)
+                print('    {:d}-hop             {:7.2f} ms {:7d} notes'.format(
+                    hops, t, len(res)))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
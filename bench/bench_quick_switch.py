@@ -0,0 +1,70 @@
+#! encoding = utf-8
+
+""" Benchmark the quick switcher: loading the index, and the latency of a
+search after every keystroke while queries are typed, as in the dialog.
+
+Bibkeys are author-year keys drawn from a few common names, so that
+short queries match many notes and rare ones match almost none. One note
+in ten has been visited.
+
+Usage: python bench/bench_quick_switch.py [n_notes]
+"""
+
+import random
+import statistics
+import sys
+import time
+from os.path import dirname, realpath
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+
+NAMES = ['zou', 'smith', 'li', 'wang', 'mueller', 'obrien', 'lee', 'kim', 'garcia',
+         'chen', 'nguyen', 'patel', 'rossi', 'novak', 'tanaka']
+QUERIES = ['zou2020a', 'nguyen', 'tnk', 'zzqx', 'smith1999jcp4', 'kim, lee', 'x']
+
+
+def synthetic_rows(rnd, n):
+    now = time.time()
+    for i in range(n):
+        names = list(rnd.choice(NAMES).capitalize() for _ in range(3))
+        bibkey = '{:s}{:d}{:s}{:d}'.format(
+                names[0], rnd.randint(1950, 2025),
+                rnd.choice(['', 'a', 'b', 'c', 'jcp', 'apj']), i)
+        visits = rnd.randint(1, 50) if rnd.random() < 0.1 else 0
+        yield bibkey, ', '.join(names), visits, now - rnd.random() * 86400 * 365
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rnd = random.Random(0)
+    rows = list(synthetic_rows(rnd, n))
+    t0 = time.perf_counter()
+    index = ln.QuickIndex(rows)
+    print('{:d} notes, index built in {:.2f} s'.format(
+            len(index), time.perf_counter() - t0))
+    latency = []
+    for query in QUERIES:
+        typed = []
+        for k in range(1, len(query) + 1):
+            t0 = time.perf_counter()
+            res = index.search(query[:k])
+            typed.append((time.perf_counter() - t0) * 1e3)
+        latency.extend(typed)
+        print('  {:15s} {:s} ms  {:s}'.format(
+                repr(query), ' '.join('{:5.2f}'.format(t) for t in typed),
+                ', '.join(res[:3])))
+    latency.sort()
+    print('  keystroke  median {:.2f} ms   max {:.2f} ms'.format(
+            statistics.median(latency), latency[-1]))
+    visit = []
+    for _ in range(200):
+        bibkey = rows[rnd.randrange(n)][0]
+        t0 = time.perf_counter()
+        index.visit(bibkey)
+        visit.append((time.perf_counter() - t0) * 1e3)
+    print('  visit      median {:.2f} ms'.format(statistics.median(visit)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#! encoding = utf-8
+
+""" Benchmark the similarity index: offline build time, incremental update
+on save, and latency of top-10 related queries.
+
+Notes are drawn from topics, each a Zipf-weighted slice of a synthetic
+vocabulary, so that notes of the same topic share rare terms.
+
+Usage: python bench/bench_related.py [n_notes]
+"""
+
+import random
+import sys
+import tempfile
+import time
+from itertools import accumulate
+from os.path import dirname, realpath
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+
+N_VOCAB = 30000
+N_TOPICS = 300
+TOPIC_WORDS = 400
+
+
+def make_words(rnd, n):
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    return list(''.join(rnd.choice(letters) for _ in range(rnd.randint(4, 10)))
+                for _ in range(n))
+
+
+def fill(conn, c, n, rnd):
+    vocab = make_words(rnd, N_VOCAB)
+    common = list(accumulate(1 / (i + 1) for i in range(len(vocab))))
+    topics = list(rnd.sample(vocab, TOPIC_WORDS) for _ in range(N_TOPICS))
+
+    def text(topic, k):
+        words = rnd.choices(vocab, cum_weights=common, k=k // 2) + \
+                rnd.choices(topic, k=k - k // 2)
+        rnd.shuffle(words)
+        return ' '.join(words)
+
+    def rows():
+        for i in range(n):
+            topic = topics[i % N_TOPICS]
+            yield ('key{:06d}'.format(i), '', 'Theory', text(topic, 30),
+                   text(topic, 20), text(topic, 80), text(topic, 80), '', '')
+
+    c.executemany(""" INSERT INTO note (bibkey, author, genre, thesis, hypothesis,
+    method, finding, comment, img_linkstr) VALUES (?,?,?,?,?,?,?,?,?)""", rows())
+    conn.commit()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn, c = ln.create_or_open_db(path_join(tmpdir, 'bench.db'))
+        fill(conn, c, n, rnd)
+        t0 = time.perf_counter()
+        ln.db_rebuild_similar(conn, c, chunk=2000)
+        print('build    {:8.2f} s for {:d} notes'.format(time.perf_counter() - t0, n))
+
+        keys = list('key{:06d}'.format(rnd.randrange(n)) for _ in range(200))
+        t0 = time.perf_counter()
+        hits = 0
+        for key in keys:
+            related = ln.db_related(c, key, n=10)
+            topic = int(key[3:]) % N_TOPICS
+            hits += sum(int(k[3:]) % N_TOPICS == topic for k, _ in related)
+        t_query = (time.perf_counter() - t0) / len(keys)
+        print('related  {:8.2f} ms per top-10 query, {:.0%} same topic'.format(
+            t_query * 1e3, hits / len(keys) / 10))
+
+        t0 = time.perf_counter()
+        for key in keys[:50]:
+            entry, tags = ln.db_select_entry(c, key)
+            entry['finding'] += ' revised'
+            ln.db_update_entry(conn, c, ln.db_bibkey_id(c, key), entry, tags)
+        print('save     {:8.2f} ms per update incl. reindex'.format(
+            (time.perf_counter() - t0) / 50 * 1e3))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
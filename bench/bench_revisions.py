@@ -0,0 +1,78 @@
+#! encoding = utf-8
+
+""" Benchmark storage overhead and reconstruction latency of the note
+revision history on notes with many revisions.
+
+Usage: python bench/bench_revisions.py [n_notes] [n_revisions]
+"""
+
+import random
+import sys
+import tempfile
+import time
+from os.path import dirname, realpath
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+from bench_fts_tokenizer import synthetic_note, WORDS
+
+
+def edit(rnd, entry_dict):
+    """ A typical small edit: insert, replace or delete a few words """
+    entry_dict = dict(entry_dict)
+    field = rnd.choice(ln.FTS_FIELDS[1:])
+    text = entry_dict[field]
+    pos = rnd.randrange(len(text) + 1)
+    cut = rnd.choice([0, 0, 5, 30])
+    words = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randrange(1, 8)))
+    end = '. ' if rnd.random() < 0.3 else ' '
+    entry_dict[field] = text[:pos] + words + end + text[pos + cut:]
+    return entry_dict
+
+
+def main():
+    n_notes = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    n_revs = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    rnd = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        conn, c = ln.create_or_open_db(path_join(tmpdir, 'bench.db'))
+        full_bytes = 0
+        t0 = time.perf_counter()
+        for i in range(n_notes):
+            entry_dict = synthetic_note(rnd, i)
+            ln.db_insert_entry(conn, c, entry_dict)
+            id_ = ln.db_bibkey_id(c, entry_dict['bibkey'])
+            for _ in range(n_revs):
+                entry_dict = edit(rnd, entry_dict)
+                ln.db_update_entry(conn, c, id_, entry_dict)
+                full_bytes += sum(len(entry_dict[f].encode('utf-8'))
+                                  for f in ln.REV_FIELDS)
+        t_write = time.perf_counter() - t0
+        c.execute('SELECT SUM(LENGTH(data)), SUM(full), COUNT(*) FROM note_rev')
+        rev_bytes, n_full, n_rows = c.fetchone()
+        print('{:d} notes x {:d} revisions'.format(n_notes, n_revs))
+        print('  full copies {:.1f} MB, history {:.2f} MB ({:.1%}), '
+              '{:d} of {:d} rows are snapshots'.format(
+                full_bytes / 1e6, rev_bytes / 1e6, rev_bytes / full_bytes,
+                n_full, n_rows))
+        print('  {:.2f} ms per save with history'.format(
+            t_write / (n_notes * n_revs) * 1e3))
+
+        t0 = time.perf_counter()
+        n = 200
+        for _ in range(n):
+            bibkey = 'key{:06d}'.format(rnd.randrange(n_notes))
+            ln.db_select_revision(c, bibkey, rnd.randrange(1, n_revs + 2))
+        print('  {:.2f} ms per revision reconstruction'.format(
+            (time.perf_counter() - t0) / n * 1e3))
+
+        t0 = time.perf_counter()
+        n_pruned = ln.db_prune_revisions(conn, c, keep=100)
+        print('  pruned {:d} revisions to 100 per note in {:.2f} s'.format(
+            n_pruned, time.perf_counter() - t0))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
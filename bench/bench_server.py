@@ -0,0 +1,82 @@
+#! encoding = utf-8
+
+""" Load test of liternote-server on a synthetic library.
+
+Usage: python bench/bench_server.py [n_notes] [n_clients] [seconds]
+"""
+
+import http.client
+import random
+import sys
+import tempfile
+import threading
+import time
+from os.path import dirname, realpath
+from os.path import join as path_join
+from urllib.parse import quote
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+from liternote_server import LiternoteServer
+from bench_fts_tokenizer import fill, WORDS
+
+
+def client(port, n_notes, deadline, counts, idx, write_ratio):
+    rnd = random.Random(idx)
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    etags = {}
+    n = 0
+    while time.perf_counter() < deadline:
+        r = rnd.random()
+        key = 'key{:06d}'.format(rnd.randrange(n_notes))
+        if r < write_ratio:
+            body = '{{"comment": "{:s}"}}'.format(rnd.choice(WORDS))
+            conn.request('PUT', '/entry/' + key, body=body,
+                         headers={'Content-Type': 'application/json'})
+        elif r < 0.5:
+            headers = {'If-None-Match': etags[key]} if key in etags else {}
+            conn.request('GET', '/entry/' + quote(key), headers=headers)
+        else:
+            conn.request('GET', '/search?q=' + quote(rnd.choice(WORDS) + ' ' +
+                                                     rnd.choice(WORDS)))
+        res = conn.getresponse()
+        res.read()
+        if res.getheader('ETag'):
+            etags[key] = res.getheader('ETag')
+        n += 1
+    counts[idx] = n
+    conn.close()
+
+
+def main():
+    n_notes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    n_clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = path_join(tmpdir, 'bench.db')
+        conn, c = ln.create_or_open_db(filename)
+        fill(conn, c, n_notes)
+        conn.close()
+        for write_ratio in (0, 0.05):
+            server = LiternoteServer(('127.0.0.1', 0), filename, n_readers=n_clients)
+            port = server.server_address[1]
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            counts = [0] * n_clients
+            deadline = time.perf_counter() + seconds
+            clients = [threading.Thread(target=client,
+                                        args=(port, n_notes, deadline, counts, i,
+                                              write_ratio))
+                       for i in range(n_clients)]
+            for t in clients:
+                t.start()
+            for t in clients:
+                t.join()
+            server.shutdown()
+            server.server_close()
+            print('{:d} notes, {:d} clients, {:.0f}% writes: {:.0f} requests/s'.format(
+                n_notes, n_clients, write_ratio * 100, sum(counts) / seconds))
+
+
+if __name__ == '__main__':
+    main()
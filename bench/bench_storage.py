@@ -0,0 +1,114 @@
+#! encoding = utf-8
+
+""" Benchmark the storage modes of the note texts: file size, the time to
+convert a library, and the latency of searches (with snippets) and of
+entry loads, on a cold and a warm sqlite page cache.
+
+Cold means a new connection per operation, so sqlite reads every page
+again. The operating system cache is not dropped, so page reads are not
+disk reads.
+
+Notes are words drawn from a Zipf distribution over a few thousand made
+up words, which compresses about like English prose.
+
+Usage: python bench/bench_storage.py [n_notes]
+"""
+
+import random
+import statistics
+import sys
+import tempfile
+import time
+from os.path import dirname, realpath, getsize
+from os.path import join as path_join
+
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
+import liternote_db as ln
+
+QUERIES = ['spectrum', 'rotational transition', 'mol*', '"laboratory survey"']
+N_VOCABULARY = 5000
+
+
+def make_text(rnd, vocabulary, weights):
+    def text(n):
+        return ' '.join(rnd.choices(vocabulary, weights, k=n))
+    return text
+
+
+def fill(conn, c, n):
+    rnd = random.Random(0)
+    syllables = ['ra', 'to', 'ni', 'spe', 'ctr', 'mo', 'le', 'cu', 'lar', 'tion',
+                 'in', 'ter', 'stel', 'la', 'sur', 'vey', 'de', 'ns', 'ity', 'al']
+    vocabulary = ['spectrum', 'rotational', 'transition', 'molecule', 'laboratory',
+                  'survey'] + list(''.join(rnd.choices(syllables, k=rnd.randint(2, 4)))
+                                   for _ in range(N_VOCABULARY))
+    weights = list(1 / (i + 1) for i in range(len(vocabulary)))
+    text = make_text(rnd, vocabulary, weights)
+    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
+              'method', 'finding', 'comment', 'img_linkstr']
+    sql = 'INSERT INTO note ({:s}) VALUES (?,?,?,?,?,?,?,?,?)'.format(','.join(fields))
+    c.executemany(sql, (('key{:06d}'.format(i), text(6), 'Theory', text(40), text(30),
+                         text(rnd.randint(100, 1500)), text(rnd.randint(100, 800)),
+                         text(20), '') for i in range(n)))
+    conn.commit()
+
+
+def timed(f, args_list):
+    latency = []
+    for args in args_list:
+        t0 = time.perf_counter()
+        f(*args)
+        latency.append((time.perf_counter() - t0) * 1e3)
+    return statistics.median(latency)
+
+
+def search(conn, q):
+    return conn.execute(""" SELECT note.bibkey, snippet(fts, -1, '[', ']', '...', 8)
+    FROM fts JOIN note ON note.id = fts.rowid WHERE fts MATCH (?)
+    ORDER BY rank LIMIT 20""", (q,)).fetchall()
+
+
+def load(conn, bibkey):
+    c = conn.cursor()
+    a_dict, tags = ln.db_select_entry(c, bibkey, ln.ENTRY_HEADER_FIELDS)
+    return a_dict, list(ln.db_iter_entry_text(c, bibkey))
+
+
+def cold(filename, f):
+    def run(*args):
+        conn = ln.open_db_readonly(filename)
+        try:
+            f(conn, *args)
+        finally:
+            conn.close()
+    return run
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rnd = random.Random(1)
+    keys = list('key{:06d}'.format(rnd.randrange(n)) for _ in range(200))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = path_join(tmpdir, 'bench.db')
+        conn, c = ln.create_or_open_db(filename)
+        fill(conn, c, n)
+        c.execute('VACUUM')
+        print('{:d} notes'.format(n))
+        for mode in ln.STORAGE_MODES:
+            t0 = time.perf_counter()
+            ln.db_set_storage(conn, c, mode, vacuum=True)
+            t_convert = time.perf_counter() - t0
+            print('  {:5s}  {:6.1f} MB   converted in {:5.1f} s'.format(
+                    mode, getsize(filename) / 1e6, t_convert))
+            for q in QUERIES:
+                print('    search {:24s} cold {:6.2f} ms   warm {:6.2f} ms'.format(
+                        q, timed(cold(filename, search), [(q,)] * 20),
+                        timed(search, [(conn, q)] * 20)))
+            print('    load entry                      cold {:6.2f} ms   warm {:6.2f} ms'.format(
+                    timed(cold(filename, load), list((k,) for k in keys)),
+                    timed(load, list((conn, k) for k in keys))))
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
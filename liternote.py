@@ -6,25 +6,73 @@ One paper one day keeps the doctor away
 
 import sqlite3
 from PyQt5 import QtWidgets, QtCore
-from PyQt5.QtGui import QIcon, QTextOption, QPixmap, QImage
-from os.path import realpath, dirname, isfile
+from PyQt5.QtGui import (
+    QIcon, QTextOption, QPixmap, QImage, QImageWriter, QRegExpValidator,
+    QKeySequence,
+)
+from os.path import realpath, dirname
 from os.path import join as path_join
-from os import remove as os_remove
 import sys
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from liternote_db import (
+    FTS_TOKENIZERS, FTS_DEFAULT_TOKENIZER, create_or_open_db, db_get_setting,
+    db_set_setting,
+    db_rebuild_fts, db_insert_entry, db_update_entry, db_save_search,
+    db_delete_saved_search, db_list_saved_searches, db_open_saved_search,
+    db_bibkey_id, db_select_last_entry, db_select_entry, db_query_all_tags,
+    db_search_fulltext, db_search_bibkey, db_unreferenced_links,
+    db_img_digest_link, db_add_img_digests, db_remove_img_digests,
+    db_rebuild_similar, db_similar_missing, db_related, db_stats,
+    db_stats_months, db_stats_genre_length, db_tag_cooccurrence,
+    db_verify_stats, db_rebuild_stats, db_bulk_set_genre, db_bulk_add_tag,
+    db_bulk_remove_tag, db_rename_tag, db_delete_entries, db_rebuild_links,
+    db_links_missing, db_prepare_links, db_add_link, db_remove_link, db_links,
+    db_link_neighbourhood, db_load_quick_index, db_record_visit,
+    db_iter_entry_text, ENTRY_HEADER_FIELDS, db_search_hits,
+    db_list_attachments, db_remove_attachment,
+    RecoveryJournal, CheckpointWriter,
+)
+from liternote_img import (
+    IMAGE_DEFAULT_BACKEND, IMAGE_FORMATS, IMAGE_POLICY_DEFAULT, open_image_store,
+)
+from liternote_sync import SameSiteError, export_bundle, apply_bundle, reset_site
+from liternote_backup import BACKUP_INTERVAL_MIN, BACKUP_KEEP, BackupScheduler
+from liternote_attach import ATTACH_KINDS, AttachmentIngester, attachment_kind
 
 ROOT = dirname(realpath(__file__))
 
 COLOR_BLUE = '#0066cc'
 COLOR_RED = '#cc0000'
+# one stylesheet for the whole application. Tags pick their color through
+# the tagColor dynamic property, and toggled tags through :checked, so no
+# widget parses a stylesheet of its own.
+APP_STYLESHEET = """
+MainWindow, MainWindow * {{ font-size: 12pt; }}
+TagLabel, TagBtn:checked {{
+    border-style: solid; border-width: 2px; border-radius: 4px; padding: 1px;
+}}
+TagBtn {{ border-style: none; padding: 3px; }}
+{colors}
+""".format(colors='\n'.join(
+        'TagLabel[tagColor="{0:s}"], TagBtn[tagColor="{0:s}"]:checked '
+        '{{ border-color: {0:s}; }}'.format(color) for color in (COLOR_BLUE, COLOR_RED)))
+AUTOSAVE_DELAY_MS = 2000    # quiet period before edits are autosaved
+CLIPBOARD_DELAY_MS = 200    # coalesce bursts of clipboard change signals
 
 
 class MainWindow(QtWidgets.QMainWindow):
 
+    imgHashed = QtCore.pyqtSignal(object, object)
+    backupDone = QtCore.pyqtSignal(object, object)
+    attachDone = QtCore.pyqtSignal(object, object)
+
     def __init__(self):
         super().__init__()
 
         self.setWindowTitle('Literature Note')
-        self.setStyleSheet('font-size: 12pt')
         self.setMinimumWidth(600)
         self.setMinimumHeight(400)
         self.resize(QtCore.QSize(900, 600))
@@ -37,13 +85,40 @@ class MainWindow(QtWidgets.QMainWindow):
         self.dialogViewImg = DialogViewImg(parent=self)
         self.dialogDelImg = DialogDelImg(parent=self)
         self.dialogPatchKey = DialogPatchBibkey(parent=self)
+        self.dialogFtsSettings = DialogFtsSettings(parent=self)
+        self.dialogImgPolicy = DialogImgPolicy(parent=self)
+        self.dialogStats = DialogStats(parent=self)
+        self.dialogBulk = DialogBulk(parent=self)
+        self.dialogGraph = DialogGraph(parent=self)
+        self.dialogQuickSwitch = DialogQuickSwitch(parent=self)
+        self.dialogAttach = DialogAttach(parent=self)
         self.dialogDelImg.accepted.connect(self.del_img)
         self.dialogSearch.btnSearch.clicked.connect(self.search_fulltext)
         self.dialogSearch.btnLoad.clicked.connect(self.load_entry_fulltext)
         self.dialogSearch.btnSelTags.clicked.connect(self.select_search_tags)
+        self.dialogSearch.btnSaveSearch.clicked.connect(self.save_search)
+        self.dialogSearch.btnOpenSaved.clicked.connect(self.open_saved_search)
+        self.dialogSearch.btnDelSaved.clicked.connect(self.delete_saved_search)
         self.dialogBibKey.btnSearch.clicked.connect(self.search_bibkey)
         self.dialogBibKey.btnLoad.clicked.connect(self.load_entry_bibkey)
+        self.dialogSearch.btnBulk.clicked.connect(
+                lambda: self.bulk_edit(self.dialogSearch.listEntry))
+        self.dialogBibKey.btnBulk.clicked.connect(
+                lambda: self.bulk_edit(self.dialogBibKey.listEntry))
         self.dialogPatchKey.btnOk.clicked.connect(self.check_patchkey)
+        self.dialogGraph.comboMode.currentIndexChanged.connect(self.refresh_graph)
+        self.dialogGraph.spinHops.valueChanged.connect(self.refresh_graph)
+        self.dialogGraph.btnLoad.clicked.connect(self.load_entry_graph)
+        self.dialogGraph.listEntry.itemDoubleClicked.connect(self.load_entry_graph)
+        self.dialogGraph.btnLink.clicked.connect(self.link_note)
+        self.dialogGraph.btnUnlink.clicked.connect(self.unlink_note)
+        self.dialogQuickSwitch.inpQuery.textChanged.connect(self.quick_search)
+        self.dialogQuickSwitch.accepted.connect(self.load_entry_quick)
+        QtWidgets.QShortcut(QKeySequence('Ctrl+P'), self, self.open_dialog_quick_switch)
+        self.dialogAttach.btnAdd.clicked.connect(self.add_attachments)
+        self.dialogAttach.btnRemove.clicked.connect(self.remove_attachment)
+        # bibkeys and authors of all notes, loaded when first needed
+        self.quickIndex = None
         self.dialogPickSearchTags = DialogMultiTag(color=COLOR_BLUE, parent=self)
         self.dialogPickDelTags = DialogMultiTag(color=COLOR_RED, parent=self)
 
@@ -55,23 +130,107 @@ class MainWindow(QtWidgets.QMainWindow):
         toolBar.actionDeleteImg.triggered.connect(self.open_dialog_del_img)
         toolBar.actionSearchBibkey.triggered.connect(self.dialogBibKey.showNormal)
         toolBar.actionSearchDoc.triggered.connect(self.dialogSearch.showNormal)
-
+        toolBar.actionFtsSettings.triggered.connect(self.open_dialog_fts_settings)
+        toolBar.actionImgPolicy.triggered.connect(self.open_dialog_img_policy)
+        toolBar.actionStats.triggered.connect(self.open_dialog_stats)
+        toolBar.actionSyncExport.triggered.connect(self.sync_export)
+        toolBar.actionSyncApply.triggered.connect(self.sync_apply)
+        toolBar.actionBackup.triggered.connect(self.backup_now)
+        toolBar.actionGraph.triggered.connect(self.open_dialog_graph)
+        toolBar.actionAttach.triggered.connect(self.open_dialog_attach)
+        self.dialogStats.btnVerify.clicked.connect(self.verify_stats)
+
+        self.imgStore = open_image_store(
+                db_get_setting(self.cursor, 'image_backend', IMAGE_DEFAULT_BACKEND),
+                path_join(ROOT, 'img'))
+        self.imgEncoder = ImageEncoder(read_img_policy(self.cursor))
         self.mw = MainWidget(parent=self)
+        self.mw.gpImage.setStore(self.imgStore)
         self.setCentralWidget(self.mw)
         self.mw.tagBox.btnDel.clicked.connect(self.tagbox_del_tag)
         self.mw.tagBox.btnAdd.clicked.connect(self.tagbox_add_tag)
 
+        # clipboard: bursts of change signals are coalesced, then images are
+        # hashed in the background and duplicates are skipped
         self.clipboard = QtWidgets.QApplication.clipboard()
+        self.clipboardTimer = QtCore.QTimer(self)
+        self.clipboardTimer.setSingleShot(True)
+        self.clipboardTimer.setInterval(CLIPBOARD_DELAY_MS)
+        self.clipboardTimer.timeout.connect(self.ingest_clipboard)
         self.clipboard.dataChanged.connect(self.clipboardChanged)
+        self.imgHashed.connect(self.add_clipboard_img)
+
+        # autosave: edits are coalesced over a quiet period, journaled, and
+        # written to the database by a background thread
+        self.journal = RecoveryJournal(path_join(ROOT, 'liternote.journal'))
+        self.autosaveTimer = QtCore.QTimer(self)
+        self.autosaveTimer.setSingleShot(True)
+        self.autosaveTimer.setInterval(AUTOSAVE_DELAY_MS)
+        self.autosaveTimer.timeout.connect(self.autosave)
+        self.mw.entryEdited.connect(self.autosaveTimer.start)
+
+        self.mw.entryLoaded.connect(self.refresh_related)
+        self.mw.listRelated.itemDoubleClicked.connect(self.load_entry_related)
+        if db_similar_missing(self.cursor):
+            self.rebuild_similar()
+        self.mw.entryLoaded.connect(self.refresh_graph)
+        self.mw.entryLoaded.connect(self.refresh_attachments)
+        if db_links_missing(self.cursor):
+            self.rebuild_links()
+        else:
+            # the bibkey matcher is ready before the first save
+            threading.Thread(target=db_prepare_links,
+                             args=(path_join(ROOT, 'liternote.db'),), daemon=True).start()
 
         # load the last entry
         self.mw.loadEntry(*db_select_last_entry(self.cursor))
         self.refresh_all_tags()
+        self.refresh_saved_searches()
+        self.checkpointWriter = CheckpointWriter(path_join(ROOT, 'liternote.db'),
+                                                 journal=self.journal)
+        self.recover_journal()
+        self.mw.entryLoaded.connect(self.record_visit)
+        # snapshots are taken in the background while editing goes on
+        self.backupDone.connect(self.backup_done)
+        self.backupScheduler = BackupScheduler(
+                path_join(ROOT, 'liternote.db'), self.imgStore,
+                interval=int(db_get_setting(self.cursor, 'backup_interval_min',
+                                            str(BACKUP_INTERVAL_MIN))),
+                keep=int(db_get_setting(self.cursor, 'backup_keep', str(BACKUP_KEEP))),
+                done=self.backupDone.emit)
+        # attachments are read and indexed by worker processes
+        self.attachDone.connect(self.attach_done)
+        self.attachIngester = AttachmentIngester(path_join(ROOT, 'liternote.db'))
 
     def clipboardChanged(self):
+        self.clipboardTimer.start()
+
+    def ingest_clipboard(self):
+        # checking the mime type does not convert the clipboard data
+        mime = self.clipboard.mimeData()
+        if mime is None or not mime.hasImage():
+            return
         img = self.clipboard.image()
-        if not img.isNull():
-            self.mw.gpImage.add_sgl_img(img)
+        if img.isNull():
+            return
+        job = self.imgEncoder.submit_digest(img)
+        # queued to the GUI thread, the signal is emitted from the worker
+        job.add_done_callback(lambda job: self.imgHashed.emit(img, job))
+
+    def add_clipboard_img(self, img, job):
+        if job.cancelled() or job.exception():
+            return
+        digest = job.result()
+        if digest in self.mw.gpImage.get_digests():
+            return      # already attached to the current note
+        link = db_img_digest_link(self.cursor, digest)
+        if link and self.imgStore.exists(link):
+            if link not in self.mw.gpImage.get_links():
+                # stored for another note: share the file, not a second copy
+                self.mw.gpImage.add_sgl_img(img, digest=digest, link=link)
+            return
+        self.mw.gpImage.add_sgl_img(img, job=self.imgEncoder.submit(img),
+                                    digest=digest)
 
     def closeEvent(self, ev):
         # ask if save the last operation
@@ -79,11 +238,45 @@ class MainWindow(QtWidgets.QMainWindow):
         q = QtWidgets.QMessageBox.question(self, 'Save?', context,
                                            QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
                                            QtWidgets.QMessageBox.Yes)
+        self.autosaveTimer.stop()
         if q == QtWidgets.QMessageBox.Yes:
             self.save_entry()
+        self.checkpointWriter.close()
+        self.journal.clear()
+        self.imgEncoder.shutdown()
+        self.attachIngester.shutdown()
+        self.backupScheduler.close()
+        self.imgStore.close()
         self.conn.close()
         ev.accept()
 
+    def autosave(self):
+        entry_dict, tags = self.mw.getEntry()
+        # hand over to the writer first: if it clears the journal before the
+        # record below is appended, the record only repeats saved content
+        self.checkpointWriter.submit(entry_dict, tags)
+        self.journal.append(entry_dict, tags)
+        self.update_quick_index(entry_dict)
+
+    def recover_journal(self):
+        """ Offer to restore edits journaled before a crash """
+        records = self.journal.records()
+        if not records:
+            return
+        entry_dict = records[-1]['entry']
+        context = 'Liternote was not closed properly. Restore the unsaved ' \
+                  'edits of entry "{:s}"?'.format(entry_dict['bibkey'] or '(no bibkey)')
+        q = QtWidgets.QMessageBox.question(self, 'Recover?', context,
+                                           QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+                                           QtWidgets.QMessageBox.Yes)
+        if q == QtWidgets.QMessageBox.Yes:
+            # images pasted but never saved have no file to restore
+            links = list(l for l in entry_dict['img_linkstr'].split(',') if l)
+            entry_dict['img_linkstr'] = ','.join(links)
+            self.mw.loadEntry(entry_dict, records[-1]['tags'])
+            self.autosaveTimer.start()
+        self.journal.clear()
+
     def refresh_all_tags(self):
         # refresh the tag list
         all_tags = db_query_all_tags(self.cursor)
@@ -96,6 +289,7 @@ class MainWindow(QtWidgets.QMainWindow):
         newtag = self.mw.tagBox.comboTags.currentText()
         if newtag.strip():
             self.mw.tagBox.dispTags.addTag(newtag)
+            self.autosaveTimer.start()
 
     def tagbox_del_tag(self):
         """ Remove tags in the current tagbox """
@@ -107,6 +301,7 @@ class MainWindow(QtWidgets.QMainWindow):
             for tag in tags_to_del:
                 current_tags.remove(tag)
             self.mw.tagBox.dispTags.setTags(current_tags)
+            self.autosaveTimer.start()
 
     def select_search_tags(self):
         self.dialogPickSearchTags.exec()
@@ -120,28 +315,56 @@ class MainWindow(QtWidgets.QMainWindow):
         self.mw.clear_all()
 
     def save_entry(self):
+        self.autosaveTimer.stop()
+        # an older autosave must not land after this save
+        self.checkpointWriter.flush()
         entry_dict, tags = self.mw.getEntry()
         # check if bibkey is empty
         if entry_dict['bibkey']:
-            save_img_to_disk(entry_dict['bibkey'], self.mw.gpImage.get_list_img())
+            links = save_img_to_store(self.imgStore, entry_dict['bibkey'],
+                                      self.mw.gpImage.get_list_img(),
+                                      self.mw.gpImage.get_links(),
+                                      self.mw.gpImage.get_jobs())
+            self.mw.gpImage.set_links(links)
+            db_add_img_digests(self.conn, self.cursor,
+                               ((d, l) for d, l in zip(self.mw.gpImage.get_digests(), links)
+                                if d))
+            entry_dict['img_linkstr'] = ','.join(links)
             id_ = db_bibkey_id(self.cursor, entry_dict['bibkey'])
             if id_:     # bibkey already exists
                 try:
                     db_update_entry(self.conn, self.cursor, id_, entry_dict,
                                     tags=tags)
+                    self.journal.clear()
+                    self.update_quick_index(entry_dict)
+                    self.purge_removed_imgs()
                     self.refresh_all_tags()
+                    self.refresh_related()
                 except sqlite3.Error as err:
                     msg(title='Error', style='critical', context=str(err))
             else:
                 try:
                     db_insert_entry(self.conn, self.cursor, entry_dict,
                                     tags=tags)
+                    self.journal.clear()
+                    self.update_quick_index(entry_dict)
+                    self.purge_removed_imgs()
                     self.refresh_all_tags()
+                    self.refresh_related()
                 except sqlite3.Error as err:
                     msg(title='Error', style='critical', context=str(err))
         else:
             self.dialogPatchKey.exec()
 
+    def purge_removed_imgs(self):
+        """ Delete images removed from the saved entry, unless another note
+        still links to them """
+        links = self.mw.gpImage.take_removed_links()
+        links = db_unreferenced_links(self.cursor, links)
+        for link in links:
+            self.imgStore.delete(link)
+        db_remove_img_digests(self.conn, self.cursor, links)
+
     def check_patchkey(self):
         patch_key = self.dialogPatchKey.inpKey.text().strip()
         if not patch_key:
@@ -169,6 +392,362 @@ class MainWindow(QtWidgets.QMainWindow):
         self.dialogViewImg.load_imgs(self.mw.gpImage.get_list_img())
         self.dialogViewImg.showNormal()
 
+    def open_dialog_fts_settings(self):
+        tokenizer = db_get_setting(self.cursor, 'fts_tokenizer',
+                                   FTS_DEFAULT_TOKENIZER)
+        prefix = db_get_setting(self.cursor, 'fts_prefix', '')
+        self.dialogFtsSettings.setSettings(tokenizer, prefix)
+        self.dialogFtsSettings.exec()
+        if self.dialogFtsSettings.result():
+            new_tokenizer, new_prefix = self.dialogFtsSettings.getSettings()
+            if (new_tokenizer, new_prefix) != (tokenizer, prefix):
+                self.rebuild_fts(new_tokenizer, new_prefix)
+
+    def open_dialog_img_policy(self):
+        self.dialogImgPolicy.setPolicy(read_img_policy(self.cursor))
+        self.dialogImgPolicy.exec()
+        if self.dialogImgPolicy.result():
+            policy = self.dialogImgPolicy.getPolicy()
+            self.checkpointWriter.flush()
+            db_set_setting(self.conn, self.cursor, 'image_policy', json.dumps(policy))
+            self.imgEncoder.setPolicy(policy)
+
+    def bulk_edit(self, listEntry):
+        """ Apply a bulk operation to the notes selected in listEntry """
+        bibkeys = list(item.text() for item in listEntry.selectedItems())
+        if not bibkeys:
+            return
+        self.dialogBulk.setNotes(len(bibkeys), db_query_all_tags(self.cursor))
+        self.dialogBulk.exec()
+        if not self.dialogBulk.result():
+            return
+        op, tag, new_tag, genre = self.dialogBulk.getOperation()
+        if op == 'delete':
+            q = QtWidgets.QMessageBox.question(
+                    self, 'Delete?', 'Delete {:d} notes and their images?'.format(len(bibkeys)),
+                    QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+                    QtWidgets.QMessageBox.No)
+            if q != QtWidgets.QMessageBox.Yes:
+                return
+        elif op != 'genre' and not tag:
+            return
+        # the open note is saved first, and reloaded after the operation
+        current = self.mw.inpBibKey.text().strip()
+        reload = bool(current) and (current in bibkeys or op == 'rename_tag')
+        if reload:
+            self.save_entry()
+        self.checkpointWriter.flush()
+        try:
+            if op == 'genre':
+                db_bulk_set_genre(self.conn, self.cursor, bibkeys, genre)
+            elif op == 'add_tag':
+                db_bulk_add_tag(self.conn, self.cursor, bibkeys, tag)
+            elif op == 'remove_tag':
+                db_bulk_remove_tag(self.conn, self.cursor, bibkeys, tag)
+            elif op == 'rename_tag' and new_tag:
+                db_rename_tag(self.conn, self.cursor, tag, new_tag)
+            elif op == 'delete':
+                links = db_delete_entries(self.conn, self.cursor, bibkeys)
+                for link in links:
+                    self.imgStore.delete(link)
+                db_remove_img_digests(self.conn, self.cursor, links)
+                for item in listEntry.selectedItems():
+                    listEntry.takeItem(listEntry.row(item))
+                self.quickIndex = None
+        except sqlite3.Error as err:
+            msg(title='Error', style='critical', context=str(err))
+        if reload:
+            if db_bibkey_id(self.cursor, current):
+                self.load_entry(current)
+            else:
+                self.autosaveTimer.stop()
+                self.journal.clear()
+                self.mw.loadEntry(*db_select_last_entry(self.cursor))
+        self.refresh_all_tags()
+
+    def sync_export(self):
+        """ Write the changes since the last export to a bundle """
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(
+                self, 'Export Changes', 'liternote_sync.zip', 'Sync bundle (*.zip)')
+        if not filename:
+            return
+        self.save_entry()
+        try:
+            info = export_bundle(self.conn, self.cursor, self.imgStore, filename)
+        except (OSError, sqlite3.Error) as err:
+            msg(title='Error', style='critical', context=str(err))
+        else:
+            msg(title='Export Changes', style='info',
+                context='{:d} notes and {:d} images exported'.format(
+                        info['notes'], info['images']))
+
+    def sync_apply(self):
+        """ Merge a bundle exported by another copy of the library """
+        filename, _ = QtWidgets.QFileDialog.getOpenFileName(
+                self, 'Apply Changes', '', 'Sync bundle (*.zip)')
+        if not filename:
+            return
+        # local edits are saved first so that they take part in the merge
+        self.save_entry()
+        self.checkpointWriter.flush()
+        try:
+            try:
+                info = apply_bundle(self.conn, self.cursor, self.imgStore, filename)
+            except SameSiteError:
+                context = 'The bundle comes from this library, or from a copy of ' \
+                          'its database file. If it is a copy, give this library ' \
+                          'a new sync site and apply the bundle?'
+                q = QtWidgets.QMessageBox.question(
+                        self, 'Apply Changes', context,
+                        QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No,
+                        QtWidgets.QMessageBox.No)
+                if q != QtWidgets.QMessageBox.Yes:
+                    return
+                reset_site(self.conn, self.cursor)
+                info = apply_bundle(self.conn, self.cursor, self.imgStore, filename)
+        except (OSError, KeyError, ValueError, sqlite3.Error) as err:
+            msg(title='Error', style='critical', context=str(err))
+            return
+        self.quickIndex = None
+        current = self.mw.inpBibKey.text().strip()
+        if db_bibkey_id(self.cursor, current):
+            self.load_entry(current)
+        else:
+            self.autosaveTimer.stop()
+            self.journal.clear()
+            self.mw.loadEntry(*db_select_last_entry(self.cursor))
+        self.refresh_all_tags()
+        msg(title='Apply Changes', style='info',
+            context='{:d} notes and {:d} images merged'.format(
+                    info['notes'], info['images']))
+
+    def backup_now(self):
+        self.save_entry()
+        self.backupScheduler.run_now()
+
+    def backup_done(self, info, error):
+        if error is not None:
+            msg(title='Backup failed', style='warning', context=str(error))
+        else:
+            self.statusBar().showMessage('Backup {:s} done'.format(info['snapshot']), 5000)
+
+    def open_dialog_stats(self):
+        self.dialogStats.setStats(db_stats(self.cursor),
+                                  db_stats_genre_length(self.cursor),
+                                  db_stats_months(self.cursor),
+                                  db_tag_cooccurrence(self.cursor))
+        self.dialogStats.showNormal()
+
+    def verify_stats(self):
+        """ Recompute the statistics from scratch and repair any drift """
+        self.checkpointWriter.flush()
+        drift = db_verify_stats(self.cursor)
+        if drift:
+            db_rebuild_stats(self.conn, self.cursor)
+            msg(title='Statistics', style='warning',
+                context='Repaired {:d} drifted counts:\n{:s}'.format(
+                    len(drift), '\n'.join(drift[:20])))
+            self.open_dialog_stats()
+        else:
+            msg(title='Statistics', style='info', context='Statistics are up to date.')
+
+    def rebuild_fts(self, tokenizer, prefix):
+        """ Rebuild the search index and show the progress """
+        dialog = QtWidgets.QProgressDialog('Rebuilding search index...', '',
+                                           0, 100, self)
+        dialog.setWindowTitle('Search Index')
+        dialog.setCancelButton(None)
+        dialog.setMinimumDuration(500)
+
+        def progress(n_done, n_total):
+            dialog.setMaximum(max(n_total, 1))
+            dialog.setValue(n_done)
+            QtWidgets.QApplication.processEvents()
+
+        self.checkpointWriter.flush()
+        try:
+            db_rebuild_fts(self.conn, self.cursor, tokenizer, prefix,
+                           progress=progress)
+        except (sqlite3.Error, ValueError) as err:
+            msg(title='Error', style='critical', context=str(err))
+        dialog.close()
+
+    def rebuild_similar(self):
+        """ Build the related notes index and show the progress """
+        dialog = QtWidgets.QProgressDialog('Indexing related notes...', '',
+                                           0, 100, self)
+        dialog.setWindowTitle('Related Notes')
+        dialog.setCancelButton(None)
+        dialog.setMinimumDuration(500)
+
+        def progress(n_done, n_total):
+            dialog.setMaximum(max(n_total, 1))
+            dialog.setValue(n_done)
+            QtWidgets.QApplication.processEvents()
+
+        self.checkpointWriter.flush()
+        try:
+            db_rebuild_similar(self.conn, self.cursor, progress=progress)
+        except sqlite3.Error as err:
+            msg(title='Error', style='critical', context=str(err))
+        dialog.close()
+
+    def rebuild_links(self):
+        """ Find the links between all notes and show the progress """
+        dialog = QtWidgets.QProgressDialog('Finding links between notes...', '',
+                                           0, 100, self)
+        dialog.setWindowTitle('Citation Graph')
+        dialog.setCancelButton(None)
+        dialog.setMinimumDuration(500)
+
+        def progress(n_done, n_total):
+            dialog.setMaximum(max(n_total, 1))
+            dialog.setValue(n_done)
+            QtWidgets.QApplication.processEvents()
+
+        self.checkpointWriter.flush()
+        try:
+            db_rebuild_links(self.conn, self.cursor, progress=progress)
+        except sqlite3.Error as err:
+            msg(title='Error', style='critical', context=str(err))
+        dialog.close()
+
+    def open_dialog_graph(self):
+        self.dialogGraph.showNormal()
+        self.refresh_graph()
+
+    def refresh_graph(self):
+        if not self.dialogGraph.isVisible():
+            return      # refreshed when the dialog opens
+        bibkey = self.mw.inpBibKey.text().strip()
+        mode = self.dialogGraph.comboMode.currentData()
+        if not bibkey:
+            items = []
+        elif mode == 'hops':
+            items = list((key, 'distance {:d}'.format(d)) for key, d in
+                         db_link_neighbourhood(self.cursor, bibkey,
+                                               self.dialogGraph.spinHops.value()))
+        else:
+            items = db_links(self.cursor, bibkey, cited_by=mode == 'cited_by')
+        self.dialogGraph.setItems(bibkey, items)
+
+    def load_entry_graph(self):
+        item = self.dialogGraph.listEntry.currentItem()
+        if item is not None:
+            self.load_entry_related(item)
+
+    def link_note(self):
+        bibkey = self.mw.inpBibKey.text().strip()
+        target = self.dialogGraph.inpLink.text().strip()
+        if not (bibkey and target):
+            return
+        self.save_entry()
+        if not db_bibkey_id(self.cursor, target):
+            msg(title='Warning', style='warning',
+                context='Bibkey {:s} does not exist'.format(target))
+            return
+        self.checkpointWriter.flush()
+        db_add_link(self.conn, self.cursor, bibkey, target)
+        self.dialogGraph.inpLink.clear()
+        self.refresh_graph()
+
+    def unlink_note(self):
+        """ Remove the links added by hand between the current note and
+        the selected ones. Mentions go away by editing the text. """
+        bibkey = self.mw.inpBibKey.text().strip()
+        self.checkpointWriter.flush()
+        for item in self.dialogGraph.listEntry.selectedItems():
+            db_remove_link(self.conn, self.cursor, bibkey, item.text())
+            db_remove_link(self.conn, self.cursor, item.text(), bibkey)
+        self.refresh_graph()
+
+    def open_dialog_attach(self):
+        self.dialogAttach.showNormal()
+        self.refresh_attachments()
+
+    def refresh_attachments(self):
+        if not self.dialogAttach.isVisible():
+            return      # refreshed when the dialog opens
+        bibkey = self.mw.inpBibKey.text().strip()
+        self.dialogAttach.setAttachments(
+                bibkey, db_list_attachments(self.cursor, bibkey) if bibkey else [])
+
+    def add_attachments(self):
+        """ Attach sources to the current note, ingested in the background """
+        self.save_entry()
+        bibkey = self.mw.inpBibKey.text().strip()
+        if not db_bibkey_id(self.cursor, bibkey):
+            msg(title='Error', style='warning',
+                context='Save the note before attaching sources to it.')
+            return
+        filenames, _ = QtWidgets.QFileDialog.getOpenFileNames(
+                self.dialogAttach, 'Attach Sources', '',
+                'Sources ({:s})'.format(' '.join('*' + ext for ext in ATTACH_KINDS)))
+        for filename in filenames:
+            try:
+                attachment_kind(filename)
+            except ValueError as err:
+                msg(title='Error', style='warning', context=str(err))
+                continue
+            job = self.attachIngester.submit(bibkey, filename)
+            # queued to the GUI thread, the signal is emitted by the pool
+            job.add_done_callback(lambda job, key=bibkey: self.attachDone.emit(key, job))
+        self.refresh_attachments()
+
+    def attach_done(self, bibkey, job):
+        if job.cancelled():
+            return
+        if job.exception() is not None:
+            msg(title='Attachment failed', style='warning', context=str(job.exception()))
+        elif job.result() is not None:
+            self.statusBar().showMessage('Attached {:s} to {:s}, {:d} chunks'.format(
+                    job.result()['name'], bibkey, job.result()['chunks']), 5000)
+        self.refresh_attachments()
+
+    def remove_attachment(self):
+        name = self.dialogAttach.currentName()
+        bibkey = self.mw.inpBibKey.text().strip()
+        if name and bibkey:
+            self.checkpointWriter.flush()
+            db_remove_attachment(self.conn, self.cursor, bibkey, name)
+            self.refresh_attachments()
+
+    def open_dialog_quick_switch(self):
+        if self.quickIndex is None:
+            self.quickIndex = db_load_quick_index(self.cursor)
+        self.dialogQuickSwitch.inpQuery.clear()
+        self.quick_search()
+        self.dialogQuickSwitch.showNormal()
+        self.dialogQuickSwitch.activateWindow()
+        self.dialogQuickSwitch.inpQuery.setFocus()
+
+    def quick_search(self):
+        if self.quickIndex is not None:
+            self.dialogQuickSwitch.setItems(self.quickIndex.search(
+                    self.dialogQuickSwitch.inpQuery.text()))
+
+    def load_entry_quick(self):
+        item = self.dialogQuickSwitch.listEntry.currentItem()
+        if item is not None and db_bibkey_id(self.cursor, item.text()):
+            self.load_entry_related(item)
+
+    def update_quick_index(self, entry_dict):
+        """ Keep the quick switcher up to date with a saved note """
+        if self.quickIndex is not None and entry_dict['bibkey']:
+            self.quickIndex.add(entry_dict['bibkey'], entry_dict['author'])
+
+    def record_visit(self):
+        bibkey = self.mw.inpBibKey.text().strip()
+        if bibkey:
+            self.checkpointWriter.flush()
+            db_record_visit(self.conn, self.cursor, bibkey)
+            if self.quickIndex is not None:
+                self.quickIndex.visit(bibkey)
+
+    def refresh_related(self):
+        bibkey = self.mw.inpBibKey.text().strip()
+        self.mw.setRelated(db_related(self.cursor, bibkey) if bibkey else [])
+
     def search_bibkey(self):
         keyword = self.dialogBibKey.inpSearchWord.text().strip()
         if keyword:
@@ -183,7 +762,19 @@ class MainWindow(QtWidgets.QMainWindow):
         field = self.dialogSearch.comboFields.currentText()
         genre = self.dialogSearch.comboGenre.currentText()
         keyword = self.dialogSearch.inpSearchWord.text()
-        if keyword:
+        if keyword and self.dialogSearch.chkAttach.isChecked():
+            # ranked with the attachments, the snippets are shown as tooltips
+            hits = db_search_hits(self.cursor, field, genre, keyword,
+                                  tags=self.dialogPickSearchTags.getSelectedTags())
+            self.dialogSearch.listEntry.clear()
+            for hit in hits:
+                item = QtWidgets.QListWidgetItem(hit.bibkey)
+                if hit.snippet:     # only the best hits have one
+                    item.setToolTip('{:s}\n(in {:s})'.format(hit.snippet, hit.attachment)
+                                    if hit.attachment else hit.snippet)
+                self.dialogSearch.listEntry.addItem(item)
+            self.dialogSearch.listEntry.setCurrentRow(0)
+        elif keyword:
             selected_tags = self.dialogPickSearchTags.getSelectedTags()
             bibkeys = db_search_fulltext(self.cursor, field, genre, keyword,
                                          tags=selected_tags)
@@ -193,28 +784,73 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.dialogSearch.listEntry.clear()
 
+    def refresh_saved_searches(self):
+        self.dialogSearch.comboSaved.clear()
+        self.dialogSearch.comboSaved.addItems(db_list_saved_searches(self.cursor))
+
+    def save_search(self):
+        keyword = self.dialogSearch.inpSearchWord.text()
+        if not keyword:
+            return
+        name, ok = QtWidgets.QInputDialog.getText(
+                self.dialogSearch, 'Save Search', 'Name of the saved search',
+                text=keyword)
+        name = name.strip()
+        if ok and name:
+            self.checkpointWriter.flush()
+            try:
+                db_save_search(self.conn, self.cursor, name, keyword,
+                               field=self.dialogSearch.comboFields.currentText(),
+                               genre=self.dialogSearch.comboGenre.currentText(),
+                               tags=self.dialogPickSearchTags.getSelectedTags())
+            except sqlite3.Error as err:
+                msg(title='Error', style='critical', context=str(err))
+            self.refresh_saved_searches()
+            self.dialogSearch.comboSaved.setCurrentText(name)
+
+    def open_saved_search(self):
+        name = self.dialogSearch.comboSaved.currentText()
+        if name:
+            bibkeys = db_open_saved_search(self.cursor, name)
+            self.dialogSearch.listEntry.clear()
+            self.dialogSearch.listEntry.addItems(bibkeys)
+            self.dialogSearch.listEntry.setCurrentRow(0)
+
+    def delete_saved_search(self):
+        name = self.dialogSearch.comboSaved.currentText()
+        if name:
+            self.checkpointWriter.flush()
+            db_delete_saved_search(self.conn, self.cursor, name)
+            self.refresh_saved_searches()
+
     def load_entry_fulltext(self):
         # load an entry from fulltext search
         self.save_entry()
         try:    # avoid query empty stuff
-            bibkey = self.dialogSearch.listEntry.currentItem().text()
-            a_dict, tags = db_select_entry(self.cursor, bibkey)
-            self.mw.loadEntry(a_dict, tags)
-            self.dialogPickDelTags.setTags(tags)
+            self.load_entry(self.dialogSearch.listEntry.currentItem().text())
         except AttributeError:
             pass
 
+    def load_entry_related(self, item):
+        # load an entry from the related panel
+        self.save_entry()
+        self.load_entry(item.text())
+
     def load_entry_bibkey(self):
         # load an entry from bibkey search
         self.save_entry()
         try:    # avoid query empty stuff
-            bibkey = self.dialogBibKey.listEntry.currentItem().text()
-            a_dict, tags = db_select_entry(self.cursor, bibkey)
-            self.mw.loadEntry(a_dict, tags)
-            self.dialogPickDelTags.setTags(tags)
+            self.load_entry(self.dialogBibKey.listEntry.currentItem().text())
         except AttributeError:
             pass
 
+    def load_entry(self, bibkey):
+        """ Show the short fields of entry bibkey at once, and its long
+        texts as they are read """
+        a_dict, tags = db_select_entry(self.cursor, bibkey, ENTRY_HEADER_FIELDS)
+        self.mw.loadEntry(a_dict, tags, texts=db_iter_entry_text(self.cursor, bibkey))
+        self.dialogPickDelTags.setTags(tags)
+
 
 class DialogSearch(QtWidgets.QDialog):
 
@@ -241,6 +877,9 @@ class DialogSearch(QtWidgets.QDialog):
 
         self.btnSearch.setFixedWidth(100)
         self.inpSearchWord = QtWidgets.QLineEdit()
+        self.inpSearchWord.setToolTip(
+                'word  "a phrase"  word*  -word  a OR b  a NEAR b\n'
+                'field:word  tag:x  -tag:x  genre:y')
         barLayout = QtWidgets.QGridLayout()
         barLayout.addWidget(QtWidgets.QLabel('Fields'), 0, 0)
         barLayout.addWidget(self.comboFields, 1, 0)
@@ -251,14 +890,31 @@ class DialogSearch(QtWidgets.QDialog):
         barLayout.addWidget(QtWidgets.QLabel('Search Word'), 0, 3)
         barLayout.addWidget(self.inpSearchWord, 1, 3)
         barLayout.addWidget(self.btnSearch, 1, 4)
+        self.chkAttach = QtWidgets.QCheckBox('Attachments')
+        self.chkAttach.setToolTip('Search the attached sources too, and rank '
+                                  'the notes by relevance')
+        barLayout.addWidget(self.chkAttach, 0, 4)
+
+        self.comboSaved = QtWidgets.QComboBox()
+        self.btnOpenSaved = QtWidgets.QPushButton('Open')
+        self.btnSaveSearch = QtWidgets.QPushButton('Save Search')
+        self.btnDelSaved = QtWidgets.QPushButton('Delete')
+        savedLayout = QtWidgets.QHBoxLayout()
+        savedLayout.addWidget(QtWidgets.QLabel('Saved Searches'))
+        savedLayout.addWidget(self.comboSaved, 1)
+        savedLayout.addWidget(self.btnOpenSaved)
+        savedLayout.addWidget(self.btnDelSaved)
+        savedLayout.addWidget(self.btnSaveSearch)
 
         self.listEntry = QtWidgets.QListWidget()
-        self.listEntry.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.listEntry.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
 
+        self.btnBulk = QtWidgets.QPushButton('Edit Selected')
         self.btnLoad = QtWidgets.QPushButton('Load')
         self.btnClose = QtWidgets.QPushButton('Close')
         btnLayout = QtWidgets.QHBoxLayout()
         btnLayout.setAlignment(QtCore.Qt.AlignRight)
+        btnLayout.addWidget(self.btnBulk)
         btnLayout.addWidget(self.btnLoad)
         btnLayout.addWidget(self.btnClose)
         self.btnClose.clicked.connect(self.reject)
@@ -266,6 +922,7 @@ class DialogSearch(QtWidgets.QDialog):
         thisLayout = QtWidgets.QVBoxLayout()
         thisLayout.setAlignment(QtCore.Qt.AlignTop)
         thisLayout.addLayout(barLayout)
+        thisLayout.addLayout(savedLayout)
         thisLayout.addWidget(self.listEntry)
         thisLayout.addLayout(btnLayout)
         self.setLayout(thisLayout)
@@ -285,12 +942,14 @@ class DialogBibKey(QtWidgets.QDialog):
         barLayout.addWidget(self.btnSearch)
 
         self.listEntry = QtWidgets.QListWidget()
-        self.listEntry.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.listEntry.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
 
+        self.btnBulk = QtWidgets.QPushButton('Edit Selected')
         self.btnLoad = QtWidgets.QPushButton('Load')
         self.btnClose = QtWidgets.QPushButton('Close')
         btnLayout = QtWidgets.QHBoxLayout()
         btnLayout.setAlignment(QtCore.Qt.AlignRight)
+        btnLayout.addWidget(self.btnBulk)
         btnLayout.addWidget(self.btnLoad)
         btnLayout.addWidget(self.btnClose)
         self.btnClose.clicked.connect(self.reject)
@@ -424,10 +1083,376 @@ class DialogPatchBibkey(QtWidgets.QDialog):
         pass
 
 
+class DialogFtsSettings(QtWidgets.QDialog):
+    """ Choose tokenizer and prefix indexes of the full text search """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Search Index Settings')
+
+        self.comboTokenizer = QtWidgets.QComboBox()
+        self.comboTokenizer.addItems(list(FTS_TOKENIZERS.keys()))
+        self.inpPrefix = QtWidgets.QLineEdit()
+        self.inpPrefix.setPlaceholderText('e.g. 2 3')
+        self.inpPrefix.setValidator(QRegExpValidator(QtCore.QRegExp('[0-9 ]*')))
+        label = QtWidgets.QLabel('Porter stems words (spectroscopy matches '
+                                 'spectroscopic), fold diacritics matches accented '
+                                 'names without accents, trigram matches any '
+                                 'substring. Prefix indexes speed up term* '
+                                 'searches. Changing these rebuilds the index.')
+        label.setWordWrap(True)
+
+        btnBox = QtWidgets.QDialogButtonBox()
+        btnBox.addButton(QtWidgets.QDialogButtonBox.Cancel)
+        btnBox.addButton(QtWidgets.QDialogButtonBox.Ok)
+        btnBox.accepted.connect(self.accept)
+        btnBox.rejected.connect(self.reject)
+
+        formLayout = QtWidgets.QFormLayout()
+        formLayout.addRow('Tokenizer', self.comboTokenizer)
+        formLayout.addRow('Prefix lengths', self.inpPrefix)
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addLayout(formLayout)
+        thisLayout.addWidget(label)
+        thisLayout.addWidget(btnBox)
+        self.setLayout(thisLayout)
+
+    def setSettings(self, tokenizer, prefix):
+        self.comboTokenizer.setCurrentText(tokenizer)
+        self.inpPrefix.setText(prefix)
+
+    def getSettings(self):
+        prefix = ' '.join(self.inpPrefix.text().split())
+        return self.comboTokenizer.currentText(), prefix
+
+
+class DialogImgPolicy(QtWidgets.QDialog):
+    """ Set how pasted images are downscaled and encoded """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Image Settings')
+
+        self.inpMaxDim = QtWidgets.QSpinBox()
+        self.inpMaxDim.setRange(0, 10000)
+        self.inpMaxDim.setSingleStep(100)
+        self.inpMaxDim.setSpecialValueText('unlimited')
+        self.comboFormat = QtWidgets.QComboBox()
+        # only the formats this Qt build can write are offered
+        supported = QImageWriter.supportedImageFormats()
+        self.comboFormat.addItems(f for f in IMAGE_FORMATS
+                                  if f == 'auto' or f.encode('ascii') in supported)
+        self.inpQuality = QtWidgets.QSpinBox()
+        self.inpQuality.setRange(1, 100)
+        self.inpPngLevel = QtWidgets.QSpinBox()
+        self.inpPngLevel.setRange(0, 9)
+        self.ckQuantize = QtWidgets.QCheckBox('Reduce diagrams to a 256 color palette')
+        label = QtWidgets.QLabel('auto saves diagrams and screenshots of text as '
+                                 'PNG, and photos or plots with many colors as '
+                                 'WebP (JPEG if WebP is not available).')
+        label.setWordWrap(True)
+
+        btnBox = QtWidgets.QDialogButtonBox()
+        btnBox.addButton(QtWidgets.QDialogButtonBox.Cancel)
+        btnBox.addButton(QtWidgets.QDialogButtonBox.Ok)
+        btnBox.accepted.connect(self.accept)
+        btnBox.rejected.connect(self.reject)
+
+        formLayout = QtWidgets.QFormLayout()
+        formLayout.addRow('Maximum width / height (px)', self.inpMaxDim)
+        formLayout.addRow('Format', self.comboFormat)
+        formLayout.addRow('WebP / JPEG quality', self.inpQuality)
+        formLayout.addRow('PNG compression level', self.inpPngLevel)
+        formLayout.addRow('', self.ckQuantize)
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addLayout(formLayout)
+        thisLayout.addWidget(label)
+        thisLayout.addWidget(btnBox)
+        self.setLayout(thisLayout)
+
+    def setPolicy(self, policy):
+        self.inpMaxDim.setValue(policy['max_dim'])
+        self.comboFormat.setCurrentText(policy['format'])
+        self.inpQuality.setValue(policy['quality'])
+        self.inpPngLevel.setValue(policy['png_level'])
+        self.ckQuantize.setChecked(policy['quantize'])
+
+    def getPolicy(self):
+        return {'max_dim': self.inpMaxDim.value(),
+                'format': self.comboFormat.currentText(),
+                'quality': self.inpQuality.value(),
+                'png_level': self.inpPngLevel.value(),
+                'quantize': self.ckQuantize.isChecked()}
+
+
+class DialogGraph(QtWidgets.QDialog):
+    """ Notes the current note cites, is cited by, or is a few links away
+    from. A note cites another when it mentions its bibkey, or when the link
+    is added by hand. """
+
+    MODES = [('Cites', 'cites'), ('Cited by', 'cited_by'), ('Neighbourhood', 'hops')]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Citation Graph')
+        self.setWindowFlags(QtCore.Qt.Window)
+
+        self.labelNote = QtWidgets.QLabel()
+        self.comboMode = QtWidgets.QComboBox()
+        for label, mode in self.MODES:
+            self.comboMode.addItem(label, mode)
+        self.spinHops = QtWidgets.QSpinBox()
+        self.spinHops.setRange(1, 5)
+        self.spinHops.setValue(2)
+        self.spinHops.setSuffix(' links')
+        barLayout = QtWidgets.QHBoxLayout()
+        barLayout.addWidget(self.labelNote)
+        barLayout.addWidget(self.comboMode)
+        barLayout.addWidget(self.spinHops)
+
+        self.listEntry = QtWidgets.QListWidget()
+        self.listEntry.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+
+        self.inpLink = QtWidgets.QLineEdit()
+        self.inpLink.setPlaceholderText('bibkey')
+        self.btnLink = QtWidgets.QPushButton('Link')
+        self.btnUnlink = QtWidgets.QPushButton('Unlink Selected')
+        linkLayout = QtWidgets.QHBoxLayout()
+        linkLayout.addWidget(self.inpLink)
+        linkLayout.addWidget(self.btnLink)
+        linkLayout.addWidget(self.btnUnlink)
+
+        self.btnLoad = QtWidgets.QPushButton('Load')
+        self.btnClose = QtWidgets.QPushButton('Close')
+        btnLayout = QtWidgets.QHBoxLayout()
+        btnLayout.setAlignment(QtCore.Qt.AlignRight)
+        btnLayout.addWidget(self.btnLoad)
+        btnLayout.addWidget(self.btnClose)
+        self.btnClose.clicked.connect(self.reject)
+
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addLayout(barLayout)
+        thisLayout.addWidget(self.listEntry)
+        thisLayout.addLayout(linkLayout)
+        thisLayout.addLayout(btnLayout)
+        self.setLayout(thisLayout)
+
+        self.comboMode.currentIndexChanged.connect(
+                lambda: self.spinHops.setEnabled(self.comboMode.currentData() == 'hops'))
+        self.spinHops.setEnabled(False)
+
+    def setItems(self, bibkey, items):
+        """ Show items, a list of (bibkey, kind or distance) """
+        self.labelNote.setText(bibkey)
+        self.listEntry.clear()
+        for key, info in items:
+            item = QtWidgets.QListWidgetItem(key)
+            item.setToolTip(info)
+            self.listEntry.addItem(item)
+
+
+class DialogAttach(QtWidgets.QDialog):
+    """ Sources attached to the current note (plain text, Markdown, LaTeX),
+    searched with the notes """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Attachments')
+        self.setWindowFlags(QtCore.Qt.Window)
+        self.setMinimumWidth(500)
+
+        self.labelNote = QtWidgets.QLabel()
+        self.tableAttach = QtWidgets.QTableWidget(0, 4)
+        self.tableAttach.setHorizontalHeaderLabels(['Name', 'Type', 'KB', 'Chunks'])
+        self.tableAttach.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.tableAttach.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.tableAttach.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.tableAttach.verticalHeader().setVisible(False)
+
+        self.btnAdd = QtWidgets.QPushButton('Attach...')
+        self.btnRemove = QtWidgets.QPushButton('Remove')
+        self.btnClose = QtWidgets.QPushButton('Close')
+        btnLayout = QtWidgets.QHBoxLayout()
+        btnLayout.addWidget(self.btnAdd)
+        btnLayout.addWidget(self.btnRemove)
+        btnLayout.addStretch()
+        btnLayout.addWidget(self.btnClose)
+        self.btnClose.clicked.connect(self.reject)
+
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addWidget(self.labelNote)
+        thisLayout.addWidget(self.tableAttach)
+        thisLayout.addLayout(btnLayout)
+        self.setLayout(thisLayout)
+
+    def setAttachments(self, bibkey, attachments):
+        """ Show attachments, a list of (name, kind, size, n_chunks, added) """
+        self.labelNote.setText(bibkey)
+        _fill_table(self.tableAttach, (
+                (name, kind, round(size / 1024), 'reading...' if n is None else n)
+                for name, kind, size, n, added in attachments))
+
+    def currentName(self):
+        row = self.tableAttach.currentRow()
+        item = self.tableAttach.item(row, 0) if row >= 0 else None
+        return item.text() if item is not None else ''
+
+
+class DialogQuickSwitch(QtWidgets.QDialog):
+    """ Jump to a note by typing part of its bibkey or author, or some
+    letters of its bibkey. Up and Down pick a note, Enter loads it. """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Go to Note')
+        self.setMinimumWidth(400)
+
+        self.inpQuery = QtWidgets.QLineEdit()
+        self.inpQuery.setPlaceholderText('bibkey or author')
+        self.listEntry = QtWidgets.QListWidget()
+        self.inpQuery.returnPressed.connect(self.accept)
+        self.listEntry.itemActivated.connect(self.accept)
+
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addWidget(self.inpQuery)
+        thisLayout.addWidget(self.listEntry)
+        self.setLayout(thisLayout)
+
+    def setItems(self, bibkeys):
+        self.listEntry.clear()
+        self.listEntry.addItems(bibkeys)
+        self.listEntry.setCurrentRow(0)
+
+    def keyPressEvent(self, ev):
+        # the query keeps the focus, the arrows move in the list
+        if ev.key() in (QtCore.Qt.Key_Up, QtCore.Qt.Key_Down):
+            step = -1 if ev.key() == QtCore.Qt.Key_Up else 1
+            row = self.listEntry.currentRow() + step
+            if 0 <= row < self.listEntry.count():
+                self.listEntry.setCurrentRow(row)
+        else:
+            super().keyPressEvent(ev)
+
+
+class DialogBulk(QtWidgets.QDialog):
+    """ Pick an operation to apply to the selected notes """
+
+    OPERATIONS = [('Add tag', 'add_tag'), ('Remove tag', 'remove_tag'),
+                  ('Rename / merge tag (all notes)', 'rename_tag'),
+                  ('Set genre', 'genre'), ('Delete notes', 'delete')]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Edit Selected Notes')
+
+        self.labelNotes = QtWidgets.QLabel()
+        self.comboOp = QtWidgets.QComboBox()
+        for label, op in self.OPERATIONS:
+            self.comboOp.addItem(label, op)
+        self.comboTag = QtWidgets.QComboBox()
+        self.comboTag.setEditable(True)
+        self.inpNewTag = QtWidgets.QLineEdit()
+        self.comboGenre = QtWidgets.QComboBox()
+        self.comboGenre.addItems(['Code', 'Experiment', 'Instrum', 'Theory', 'Review'])
+
+        btnBox = QtWidgets.QDialogButtonBox()
+        btnBox.addButton(QtWidgets.QDialogButtonBox.Cancel)
+        btnBox.addButton(QtWidgets.QDialogButtonBox.Ok)
+        btnBox.accepted.connect(self.accept)
+        btnBox.rejected.connect(self.reject)
+
+        formLayout = QtWidgets.QFormLayout()
+        formLayout.addRow('Operation', self.comboOp)
+        formLayout.addRow('Tag', self.comboTag)
+        formLayout.addRow('New tag', self.inpNewTag)
+        formLayout.addRow('Genre', self.comboGenre)
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addWidget(self.labelNotes)
+        thisLayout.addLayout(formLayout)
+        thisLayout.addWidget(btnBox)
+        self.setLayout(thisLayout)
+
+        self.comboOp.currentIndexChanged.connect(self._update_inputs)
+        self._update_inputs()
+
+    def _update_inputs(self):
+        op = self.comboOp.currentData()
+        self.comboTag.setEnabled(op in ('add_tag', 'remove_tag', 'rename_tag'))
+        self.inpNewTag.setEnabled(op == 'rename_tag')
+        self.comboGenre.setEnabled(op == 'genre')
+
+    def setNotes(self, n, tags):
+        self.labelNotes.setText('{:d} notes selected'.format(n))
+        text = self.comboTag.currentText()
+        self.comboTag.clear()
+        self.comboTag.addItems(tags)
+        self.comboTag.setCurrentText(text)
+        self.inpNewTag.clear()
+
+    def getOperation(self):
+        """ Return (operation, tag, new tag, genre) """
+        return (self.comboOp.currentData(), self.comboTag.currentText().strip(),
+                self.inpNewTag.text().strip(), self.comboGenre.currentText())
+
+
+class DialogStats(QtWidgets.QDialog):
+    """ Library statistics """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle('Library Statistics')
+        self.setMinimumWidth(400)
+
+        self.labelSummary = QtWidgets.QLabel()
+        self.tableGenre = QtWidgets.QTableWidget(0, 3)
+        self.tableGenre.setHorizontalHeaderLabels(['Genre', 'Notes', 'Avg. length'])
+        self.tableMonth = QtWidgets.QTableWidget(0, 2)
+        self.tableMonth.setHorizontalHeaderLabels(['Month', 'Notes'])
+        self.tableTags = QtWidgets.QTableWidget(0, 3)
+        self.tableTags.setHorizontalHeaderLabels(['Tag', 'Tag', 'Notes'])
+        for table in (self.tableGenre, self.tableMonth, self.tableTags):
+            table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+            table.verticalHeader().setVisible(False)
+        tabs = QtWidgets.QTabWidget()
+        tabs.addTab(self.tableGenre, 'Genres')
+        tabs.addTab(self.tableMonth, 'Months')
+        tabs.addTab(self.tableTags, 'Tag pairs')
+        self.btnVerify = QtWidgets.QPushButton('Verify')
+        self.btnVerify.setToolTip('Recompute the statistics from scratch and '
+                                  'repair them if they drifted')
+        btnClose = QtWidgets.QPushButton('Close')
+        btnClose.clicked.connect(self.close)
+
+        btnLayout = QtWidgets.QHBoxLayout()
+        btnLayout.addWidget(self.btnVerify)
+        btnLayout.addStretch()
+        btnLayout.addWidget(btnClose)
+        thisLayout = QtWidgets.QVBoxLayout()
+        thisLayout.addWidget(self.labelSummary)
+        thisLayout.addWidget(tabs)
+        thisLayout.addLayout(btnLayout)
+        self.setLayout(thisLayout)
+
+    def setStats(self, stats, genre_length, months, tag_pairs):
+        self.labelSummary.setText(
+                '{:d} notes, {:d} tags, {:.0f} characters per note on average'.format(
+                    stats['notes'], stats['tags'], stats['avg_length']))
+        _fill_table(self.tableGenre, ((g, n, genre_length.get(g, 0))
+                                      for g, n in stats['genres'].items()))
+        _fill_table(self.tableMonth, ((m or 'unknown', n) for m, n in
+                                      sorted(months.items(), reverse=True)))
+        _fill_table(self.tableTags, tag_pairs)
+
+
 class MainWidget(QtWidgets.QWidget):
 
+    # emitted when the user edits the entry, not when an entry is loaded
+    entryEdited = QtCore.pyqtSignal()
+    entryLoaded = QtCore.pyqtSignal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
+        self._loading = False
 
         self.inpBibKey = QtWidgets.QLineEdit()
         self.tagBox = TagBox(parent=self)
@@ -453,6 +1478,9 @@ class MainWidget(QtWidgets.QWidget):
         self.editComment.setTextInteractionFlags(QtCore.Qt.TextEditorInteraction)
         self.editComment.setWordWrapMode(QTextOption.WordWrap)
         self.gpImage = GroupImage(parent=self)
+        self.listRelated = QtWidgets.QListWidget()
+        self.listRelated.setToolTip('Notes with similar thesis, hypothesis, '
+                                    'method and finding. Double click to open.')
 
         areaAuthor = QtWidgets.QScrollArea()
         areaAuthor.setWidgetResizable(True)
@@ -500,11 +1528,84 @@ class MainWidget(QtWidgets.QWidget):
         thisLayout.addWidget(areaFinding, 5, 1)
         thisLayout.addWidget(areaComment, 5, 2)
         thisLayout.addWidget(QtWidgets.QLabel('Images'), 2, 3)
-        thisLayout.addWidget(areaImg, 3, 3, 3, 1)
+        thisLayout.addWidget(areaImg, 3, 3)
+        thisLayout.addWidget(QtWidgets.QLabel('Related'), 4, 3)
+        thisLayout.addWidget(self.listRelated, 5, 3)
         self.setLayout(thisLayout)
 
+        for edit in (self.editAuthor, self.editThesis, self.editHypo,
+                     self.editMethod, self.editFinding, self.editComment):
+            edit.textChanged.connect(self._edited)
+        self.inpBibKey.textEdited.connect(self._edited)
+        self.comboGenre.activated.connect(self._edited)
+
+        # texts are set as plain text, and only once their field is painted:
+        # a field off screen keeps its text pending. The long texts of an
+        # entry are read one field per event loop pass after its header.
+        self._textEdits = {
+            'author': self.editAuthor, 'thesis': self.editThesis,
+            'hypothesis': self.editHypo, 'method': self.editMethod,
+            'finding': self.editFinding, 'comment': self.editComment,
+        }
+        self._pending = {}      # field: text not in its edit yet
+        self._texts = None      # (field, text) of the entry still to read
+        for field, edit in self._textEdits.items():
+            edit.viewport().setProperty('entryField', field)
+            edit.viewport().installEventFilter(self)
+        self.textTimer = QtCore.QTimer(self)
+        self.textTimer.setInterval(0)
+        self.textTimer.timeout.connect(self._readText)
+
+    def _edited(self):
+        if not self._loading:
+            self.entryEdited.emit()
+
+    def eventFilter(self, obj, ev):
+        if ev.type() == QtCore.QEvent.Paint:
+            field = obj.property('entryField')
+            if field in self._pending:
+                self._loading = True
+                self._textEdits[field].setPlainText(self._pending.pop(field))
+                self._loading = False
+        return False
+
+    def _setText(self, field, text):
+        edit = self._textEdits[field]
+        if edit.visibleRegion().isEmpty():
+            self._pending[field] = text
+            edit.clear()
+        else:
+            self._pending.pop(field, None)
+            edit.setPlainText(text)
+
+    def _readText(self):
+        """ Show the next long text of the entry """
+        try:
+            field, text = next(self._texts)
+        except StopIteration:
+            self._texts = None
+            self.textTimer.stop()
+            return
+        self._loading = True
+        self._setText(field, text)
+        self._loading = False
+
+    def _finishLoading(self):
+        """ Read the texts of the entry that have not arrived yet """
+        if self._texts is not None:
+            self.textTimer.stop()
+            texts, self._texts = self._texts, None
+            self._loading = True
+            for field, text in texts:
+                self._setText(field, text)
+            self._loading = False
+
     def clear_all(self):
         """ Clear all contents """
+        self.textTimer.stop()
+        self._texts = None
+        self._pending.clear()
+        self._loading = True
         self.inpBibKey.setText('')
         self.editThesis.clear()
         self.editComment.clear()
@@ -514,35 +1615,48 @@ class MainWidget(QtWidgets.QWidget):
         self.editAuthor.clear()
         self.gpImage.clear()
         self.tagBox.dispTags.setTags([])
+        self.listRelated.clear()
+        self._loading = False
 
     def getEntry(self):
         """ Get entry information """
+        self._finishLoading()
         a_dict = {
             'bibkey': self.inpBibKey.text().strip(),
             'genre': self.comboGenre.currentText(),
-            'author': self.editAuthor.toPlainText(),
-            'thesis': self.editThesis.toPlainText(),
-            'hypothesis': self.editHypo.toPlainText(),
-            'method': self.editMethod.toPlainText(),
-            'finding': self.editFinding.toPlainText(),
-            'comment': self.editComment.toPlainText(),
             'img_linkstr': self.gpImage.get_link_str()
         }
+        for field, edit in self._textEdits.items():
+            a_dict[field] = self._pending[field] if field in self._pending \
+                else edit.toPlainText()
         tags = self.tagBox.dispTags.tags()
         return a_dict, tags
 
-    def loadEntry(self, a_dict, tags):
-        """ Load entry information """
+    def loadEntry(self, a_dict, tags, texts=None):
+        """ Load entry information. The fields missing from a_dict come
+        from texts, an iterator of (field, text), after the entry is shown """
+        self.textTimer.stop()
+        self._texts = None
+        self._loading = True
         self.inpBibKey.setText(a_dict['bibkey'])
         self.comboGenre.setCurrentText(a_dict['genre'])
-        self.editAuthor.setText(a_dict['author'])
-        self.editThesis.setText(a_dict['thesis'])
-        self.editHypo.setText(a_dict['hypothesis'])
-        self.editMethod.setText(a_dict['method'])
-        self.editFinding.setText(a_dict['finding'])
-        self.editComment.setText(a_dict['comment'])
+        for field in self._textEdits:
+            self._setText(field, a_dict.get(field, ''))
         self.gpImage.load_imgs_from_disk(a_dict['img_linkstr'])
         self.tagBox.dispTags.setTags(tags)
+        self._loading = False
+        if texts is not None:
+            self._texts = texts
+            self.textTimer.start()
+        self.entryLoaded.emit()
+
+    def setRelated(self, related):
+        """ Show the related notes, a list of (bibkey, score) """
+        self.listRelated.clear()
+        for bibkey, score in related:
+            item = QtWidgets.QListWidgetItem(bibkey)
+            item.setToolTip('similarity {:.2f}'.format(score))
+            self.listRelated.addItem(item)
 
 
 class GroupImageInDialog(QtWidgets.QWidget):
@@ -553,6 +1667,8 @@ class GroupImageInDialog(QtWidgets.QWidget):
 
         self._layout = QtWidgets.QFormLayout()
         self._list_rows = []    # [(ckbox, qlabel)]
+        self._ckbox_pool = widget_pool(QtWidgets.QCheckBox)
+        self._label_pool = widget_pool(QtWidgets.QLabel)
         self.setLayout(self._layout)
 
     def load_imgs(self, list_img):
@@ -564,8 +1680,9 @@ class GroupImageInDialog(QtWidgets.QWidget):
                 ckbox.setChecked(0)
                 qlabel.setPixmap(QPixmap(img.scaledToWidth(300)))
             for img in list_img[n_old:]:
-                ckbox = QtWidgets.QCheckBox()
-                qlabel = QtWidgets.QLabel()
+                ckbox = self._ckbox_pool.acquire(self)
+                ckbox.setChecked(0)
+                qlabel = self._label_pool.acquire(self)
                 qlabel.setPixmap(QPixmap(img.scaledToWidth(300)))
                 self._list_rows.append((ckbox, qlabel))
                 self._layout.addRow(ckbox, qlabel)
@@ -576,10 +1693,11 @@ class GroupImageInDialog(QtWidgets.QWidget):
                 qlabel.setPixmap(QPixmap(img.scaledToWidth(300)))
             for i in range(n_new, n_old):
                 ckbox, qlabel = self._list_rows.pop()
-                self._layout.removeWidget(ckbox)
-                self._layout.removeWidget(qlabel)
-                ckbox.deleteLater()
-                qlabel.deleteLater()
+                # take the row out without deleting its widgets
+                self._layout.takeRow(len(self._list_rows))
+                qlabel.clear()
+                self._ckbox_pool.release(ckbox)
+                self._label_pool.release(qlabel)
 
     def get_checked_img_ids(self):
         checked_img_ids = []
@@ -598,45 +1716,68 @@ class GroupImage(QtWidgets.QWidget):
         self._list_img = []
         self._list_wdgs = []
         self._list_links = []
+        self._list_jobs = []        # pending encodings of new images
+        self._list_digests = []     # pixel digests of new images
+        self._removed_links = []
+        self._store = None
+        self._pool = widget_pool(QtWidgets.QLabel)
         self.setLayout(self._layout)
 
+    def setStore(self, store):
+        """ Set the image store images are loaded from """
+        self._store = store
+
+    def _imgWidth(self):
+        """ Images fit the visible width of the scroll area. The group
+        itself widens with its images, scaling to it grows them at each load """
+        area = self.parentWidget() or self
+        margins = self._layout.contentsMargins()
+        return max(area.width() - margins.left() - margins.right(), 1)
+
     def load_imgs_from_disk(self, img_links):
 
+        self._removed_links = []
         if img_links:
             self._list_links = img_links.split(',')
         else:
             self._list_links = []
         n_new = len(self._list_links)
         n_old = len(self._list_wdgs)
+        self._list_jobs = [None] * n_new
+        self._list_digests = [''] * n_new
         if n_new > n_old:
-            for img, wdg, link in zip(self._list_img, self._list_wdgs,
-                                      self._list_links[:n_old]):
-                img.load(path_join(ROOT, 'img', link))
-                wdg.setPixmap(QPixmap(img.scaledToWidth(self.width())))
+            for i, (wdg, link) in enumerate(zip(self._list_wdgs,
+                                                self._list_links[:n_old])):
+                img = load_img(self._store, link)
+                self._list_img[i] = img
+                wdg.setPixmap(QPixmap(img.scaledToWidth(self._imgWidth())))
             for link in self._list_links[n_old:]:
-                wdg = QtWidgets.QLabel()
-                img = QImage(path_join(ROOT, 'img', link))
-                wdg.setPixmap(QPixmap(img.scaledToWidth(self.width())))
+                wdg = self._pool.acquire(self)
+                img = load_img(self._store, link)
+                wdg.setPixmap(QPixmap(img.scaledToWidth(self._imgWidth())))
                 self._list_wdgs.append(wdg)
                 self._list_img.append(img)
                 self._layout.addWidget(wdg)
         else:
-            for img, wdg, link in zip(self._list_img, self._list_wdgs[:n_new],
-                                      self._list_links):
-                img.load(path_join(ROOT, 'img', link))
-                wdg.setPixmap(QPixmap(img.scaledToWidth(self.width())))
+            for i, (wdg, link) in enumerate(zip(self._list_wdgs[:n_new],
+                                                self._list_links)):
+                img = load_img(self._store, link)
+                self._list_img[i] = img
+                wdg.setPixmap(QPixmap(img.scaledToWidth(self._imgWidth())))
             for i in range(n_new, n_old):
                 self._list_img.pop()
-                wdg = self._list_wdgs.pop()
-                self._layout.removeWidget(wdg)
-                wdg.deleteLater()
-
-    def add_sgl_img(self, img):
-        """ add single image """
-        wdg = QtWidgets.QLabel()
-        wdg.setPixmap(QPixmap(img.scaledToWidth(self.width())))
+                self._release(self._list_wdgs.pop())
+
+    def add_sgl_img(self, img, job=None, digest='', link=''):
+        """ add single image, job is its pending encoding (a future) and
+        digest the hash of its pixels. link is given for an image that is
+        stored already """
+        wdg = self._pool.acquire(self)
+        wdg.setPixmap(QPixmap(img.scaledToWidth(self._imgWidth())))
         self._list_img.append(img)
-        self._list_links.append('') # new image from clipboard does not have link yet
+        self._list_links.append(link)   # '' until a new image is saved
+        self._list_jobs.append(job)
+        self._list_digests.append(digest)
         self._list_wdgs.append(wdg)
         self._layout.addWidget(wdg)
 
@@ -649,24 +1790,53 @@ class GroupImage(QtWidgets.QWidget):
         for id_ in checked_ids:
             self._list_img.pop(id_)
             link = self._list_links.pop(id_)
-            wdg = self._list_wdgs.pop(id_)
-            self._layout.removeWidget(wdg)
-            wdg.deleteLater()
-            fillename = path_join(ROOT, 'img', link)
-            if isfile(fillename):
-                os_remove(fillename)
+            job = self._list_jobs.pop(id_)
+            self._list_digests.pop(id_)
+            if job:
+                job.cancel()
+            self._release(self._list_wdgs.pop(id_))
+            # the stored image is deleted once the entry is saved without it
+            if link:
+                self._removed_links.append(link)
+
+    def _release(self, wdg):
+        self._layout.removeWidget(wdg)
+        wdg.clear()
+        self._pool.release(wdg)
 
     def clear(self):
         while self._list_wdgs:
-            wdg = self._list_wdgs.pop()
-            wdg.deleteLater()
+            self._release(self._list_wdgs.pop())
         self._list_links = []
+        self._list_jobs = []
+        self._list_digests = []
         self._list_img = []
+        self._removed_links = []
 
     def get_link_str(self):
         """ return the image links """
         return ','.join(self._list_links)
 
+    def get_links(self):
+        return list(self._list_links)
+
+    def get_jobs(self):
+        return list(self._list_jobs)
+
+    def get_digests(self):
+        return list(self._list_digests)
+
+    def set_links(self, links):
+        """ Set the links after the images are saved """
+        self._list_links = list(links)
+        self._list_jobs = [None] * len(links)
+
+    def take_removed_links(self):
+        """ Return and forget the links of the removed images """
+        links = self._removed_links
+        self._removed_links = []
+        return links
+
     def get_list_img(self):
         return self._list_img
 
@@ -688,6 +1858,22 @@ class ToolBar(QtWidgets.QToolBar):
                 QIcon(path_join(ROOT, 'icon', 'search.png')), 'Search Bibkey')
         self.actionSearchDoc = QtWidgets.QAction(
                 QIcon(path_join(ROOT, 'icon', 'search_doc.png')), 'Fulltext Search')
+        self.actionFtsSettings = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'fts_settings.png')), 'Search Index Settings')
+        self.actionImgPolicy = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'img_policy.png')), 'Image Settings')
+        self.actionStats = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'stats.png')), 'Library Statistics')
+        self.actionSyncExport = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'sync_export.png')), 'Export Changes')
+        self.actionSyncApply = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'sync_apply.png')), 'Apply Changes')
+        self.actionBackup = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'backup.png')), 'Back Up Now')
+        self.actionGraph = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'graph.png')), 'Citation Graph')
+        self.actionAttach = QtWidgets.QAction(
+                QIcon(path_join(ROOT, 'icon', 'attach.png')), 'Attachments')
 
         self.addAction(self.actionNewEntry)
         self.addAction(self.actionSaveEntry)
@@ -697,22 +1883,67 @@ class ToolBar(QtWidgets.QToolBar):
         self.addSeparator()
         self.addAction(self.actionSearchBibkey)
         self.addAction(self.actionSearchDoc)
+        self.addAction(self.actionFtsSettings)
+        self.addAction(self.actionImgPolicy)
+        self.addAction(self.actionStats)
+        self.addAction(self.actionGraph)
+        self.addAction(self.actionAttach)
+        self.addSeparator()
+        self.addAction(self.actionSyncExport)
+        self.addAction(self.actionSyncApply)
+        self.addAction(self.actionBackup)
         self.setMovable(False)
         self.setIconSize(QtCore.QSize(40, 40))
 
 
+class WidgetPool:
+    """ Recycle widgets instead of deleting and re-creating them. Released
+    widgets are hidden and kept for the next acquire, so switching entries
+    allocates no widgets once the pool has grown to the largest entry. """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._free = []
+        self.n_created = 0
+
+    def acquire(self, parent):
+        """ Return a widget, shown as a child of parent once laid out """
+        if self._free:
+            wdg = self._free.pop()
+            if wdg.parentWidget() is not parent:
+                wdg.setParent(parent)
+            wdg.show()
+        else:
+            wdg = self._factory()
+            self.n_created += 1
+        return wdg
+
+    def release(self, wdg):
+        wdg.hide()
+        self._free.append(wdg)
+
+
+_POOLS = {}
+
+
+def widget_pool(cls, color=None):
+    """ Return the shared pool of widgets of class cls (and tag color) """
+    key = (cls, color)
+    if key not in _POOLS:
+        if color is None:
+            _POOLS[key] = WidgetPool(cls)
+        else:
+            _POOLS[key] = WidgetPool(lambda: cls(color))
+    return _POOLS[key]
+
+
 class TagLabel(QtWidgets.QLabel):
     """ Reimplement QLable to display tags """
 
     def __init__(self, color, title='', parent=None):
         super().__init__(parent)
         self.setText(title)
-        self.setStyleSheet("""border-style: solid;
-                              border-width: 2px;
-                              border-radius: 4px;
-                              border-color: {:s};
-                              padding: 1px;
-                           """.format(color))
+        self.setProperty('tagColor', color)
 
 
 class TagBtn(QtWidgets.QPushButton):
@@ -721,27 +1952,10 @@ class TagBtn(QtWidgets.QPushButton):
     def __init__(self, color, title='', parent=None):
         super().__init__(parent)
 
-        self._color = color
         self.setText(title)
+        self.setProperty('tagColor', color)
         self.setCheckable(True)
         self.setChecked(False)
-        self.setStatus(False)
-        self.toggled[bool].connect(self.setStatus)
-
-    def setStatus(self, b):
-        """ Set color by bool """
-
-        if b:    # toggled
-            self.setStyleSheet("""border-style: solid;
-                                  border-width: 2px;
-                                  border-radius: 4px;
-                                  border-color: {:s};
-                                  padding: 1px;
-                               """.format(self._color))
-        else:   # untoggled
-            self.setStyleSheet("""border-style: none;
-                                  padding: 3px;
-                               """)
 
 
 class TagBox(QtWidgets.QWidget):
@@ -772,7 +1986,7 @@ class DispTags1Row(QtWidgets.QWidget):
     def __init__(self, color, parent=None):
         super().__init__(parent)
 
-        self._color = color
+        self._pool = widget_pool(TagLabel, color)
         self._layout = QtWidgets.QGridLayout()
         self._layout.setContentsMargins(0, 0, 0, 0)
         self._layout.setAlignment(QtCore.Qt.AlignLeft)
@@ -787,7 +2001,8 @@ class DispTags1Row(QtWidgets.QWidget):
             for tag, wdg in zip(tags[:n_wdg], self._list_widgets):
                 wdg.setText(tag)
             for i, tag in enumerate(tags[n_wdg:]):
-                wdg = TagLabel(self._color, title=tag)
+                wdg = self._pool.acquire(self)
+                wdg.setText(tag)
                 self._list_widgets.append(wdg)
                 self._layout.addWidget(wdg, 0, i+n_wdg)
         else:
@@ -796,12 +2011,13 @@ class DispTags1Row(QtWidgets.QWidget):
             for i in range(n_tag, n_wdg):
                 wdg = self._list_widgets.pop()
                 self._layout.removeWidget(wdg)
-                wdg.deleteLater()
+                self._pool.release(wdg)
 
     def addTag(self, tag):
         """ Add one tag """
         if tag not in self.tags():  # avoid duplicates
-            wdg = TagLabel(self._color, title=tag)
+            wdg = self._pool.acquire(self)
+            wdg.setText(tag)
             self._layout.addWidget(wdg, 0, self._layout.columnCount())
             self._list_widgets.append(wdg)
 
@@ -819,16 +2035,16 @@ class DialogMultiTag(QtWidgets.QDialog):
         self.setWindowTitle('Select Tags')
         self.setMinimumWidth(500)
 
-        self._color = color
+        self._pool = widget_pool(TagBtn, color)
         self._list_widgets = []
         self._layout = QtWidgets.QGridLayout()
         self._layout.setAlignment(QtCore.Qt.AlignTop)
-        central_widget = QtWidgets.QWidget()
-        central_widget.setLayout(self._layout)
+        self._central = QtWidgets.QWidget()
+        self._central.setLayout(self._layout)
 
         area = QtWidgets.QScrollArea()
         area.setWidgetResizable(True)
-        area.setWidget(central_widget)
+        area.setWidget(self._central)
 
         btnBox = QtWidgets.QDialogButtonBox()
         btnBox.addButton(QtWidgets.QDialogButtonBox.Cancel)
@@ -858,7 +2074,8 @@ class DialogMultiTag(QtWidgets.QDialog):
             for tag, wdg in zip(tags[:n_wdg], self._list_widgets):
                 wdg.setText(tag)
             for i, tag in enumerate(tags[n_wdg:]):
-                wdg = TagBtn(self._color, title=tag)
+                wdg = self._pool.acquire(self._central)
+                wdg.setText(tag)
                 self._list_widgets.append(wdg)
                 row = (i + n_wdg) // self.cols
                 col = (i + n_wdg) % self.cols
@@ -869,7 +2086,8 @@ class DialogMultiTag(QtWidgets.QDialog):
             for i in range(n_tag, n_wdg):
                 wdg = self._list_widgets.pop()
                 self._layout.removeWidget(wdg)
-                wdg.deleteLater()
+                wdg.setChecked(False)
+                self._pool.release(wdg)
 
     def getSelectedTags(self):
 
@@ -910,9 +2128,19 @@ def msg(title='', context='', style=''):
     d.exec_()
 
 
+def _fill_table(table, rows):
+    rows = list(rows)
+    table.setRowCount(len(rows))
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            table.setItem(i, j, QtWidgets.QTableWidgetItem(str(value)))
+    table.resizeColumnsToContents()
+
+
 def launch():
    
     app = QtWidgets.QApplication(sys.argv)
+    app.setStyleSheet(APP_STYLESHEET)
 
     window = MainWindow()
     window.show()
@@ -920,260 +2148,143 @@ def launch():
     sys.exit(app.exec_())
     
 
-def create_or_open_db(filename):
-    """ Create (1st time) or open database
-    :argument:
-        filename: str           database file
-    :returns:
-        conn: sqlite3 database connection
-        cursor: sqlite3 database cursor
-    """
-
-    conn = sqlite3.connect(filename)
-    cursor = conn.cursor()
-
-    sql = """ CREATE TABLE IF NOT EXISTS note (
-        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
-        bibkey TEXT UNIQUE NOT NULL,
-        author TEXT NOT NULL,
-        genre TEXT, 
-        thesis TEXT, 
-        hypothesis TEXT,
-        method TEXT,
-        finding TEXT, 
-        comment TEXT,
-        img_linkstr TEXT
-    );"""
-    cursor.execute(sql)
-    
-    sql = """ CREATE TABLE IF NOT EXISTS tags (
-        bibkey TEXT NOT NULL,
-        tag TEXT NOT NULL
-    );"""
-    cursor.execute(sql)
-
-    # create fts5 virtual table for full text search
-    sql = """ CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(
-        author,
-        thesis, 
-        hypothesis,
-        method, 
-        finding, 
-        comment,
-        content="note",
-        content_rowid="id"
-    );
-    """
-    cursor.execute(sql)
-
-    # create triggers
-    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS tbl_ai 
-    AFTER INSERT ON note BEGIN
-    INSERT INTO fts(rowid, author, thesis, hypothesis, method, 
-        finding, comment) VALUES (new.id, new.author, new.thesis, new.hypothesis,
-        new.method, new.finding, new.comment);
-    END;""")
-    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS tbl_ad 
-    AFTER DELETE ON note BEGIN
-      INSERT INTO fts(fts, rowid, author, thesis, hypothesis, method, 
-        finding, comment) VALUES ('delete', old.id, old.author, old.thesis, 
-        old.hypothesis, old.method, old.finding, old.comment);
-    END;""")
-    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS tbl_au 
-    AFTER UPDATE ON note BEGIN
-      INSERT INTO fts(fts, rowid, author, thesis, hypothesis, method, 
-        finding, comment) VALUES ('delete', old.id, old.author, old.thesis, 
-        old.hypothesis, old.method, old.finding, old.comment);
-      INSERT INTO fts(rowid, author, thesis, hypothesis, method, 
-        finding, comment) VALUES (new.id, new.author, new.thesis, new.hypothesis,
-        new.method, new.finding, new.comment);
-    END;""")
-
-    conn.commit()
-
-    return conn, cursor
-
-
-def db_insert_entry(conn, c, entry_dict, tags=None):
-    """ Insert new entry into database """
-
-    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
-              'method', 'finding', 'comment', 'img_linkstr']
-    sql = """ INSERT INTO note ({:s}) VALUES (?,?,?,?,?,?,?,?,?) 
-            """.format(','.join(fields))
-    c.execute(sql, tuple(entry_dict[field] for field in fields))
-    conn.commit()
-
-    if tags:
-        sql = """ INSERT INTO tags (bibkey, tag) VALUES ({:s}, ?) """.format(entry_dict['bibkey'])
-        c.executemany(sql, ((tag,) for tag in tags))
-        conn.commit()
-
-
-def db_update_entry(conn, c, id_, entry_dict, tags=None):
-    """ Update entry in database """
-
-    fields = ['author', 'genre', 'thesis', 'hypothesis',
-              'method', 'finding', 'comment', 'img_linkstr']
-    sql = """ UPDATE note SET {:s} WHERE id = (?) 
-            """.format(','.join('{:s} = (?)'.format(field) for field in fields))
-    c.execute(sql, tuple(list(entry_dict[field] for field in fields) + [id_]))
-    conn.commit()
-
-    # remove old tags
-    c.execute("DELETE FROM tags WHERE bibkey = (?)", (entry_dict['bibkey'],))
-    if tags:
-        # write in new tags
-        sql = """ INSERT INTO tags (bibkey, tag) VALUES ('{:s}', ?) """.format(entry_dict['bibkey'])
-        c.executemany(sql, ((tag,) for tag in tags))
-        conn.commit()
-
-
-def db_bibkey_id(c, bibkey):
-    """ Return the id of tbe bibkey. Reture None if not found """
-    c.execute('SELECT id FROM note WHERE bibkey = (?)', (bibkey,))
-    res = c.fetchall()
-    if res:
-        return res[0][0]
-    else:
-        return None
-
-
-def db_select_last_entry(c):
-    """ Seletc the last entry from database """
-    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
-              'method', 'finding', 'comment', 'img_linkstr']
-    sql = "SELECT {:s} FROM note ORDER BY id DESC LIMIT 1".format(','.join(fields))
-    c.execute(sql)
-    result = c.fetchall()
-    a_dict = {}
-    if result:
-        for field, value in zip(fields, result[0]):
-            a_dict[field] = value
-    else:
-        for field in fields:
-            a_dict[field] = ''
-
-    # get tags
-    if a_dict:
-        c.execute("SELECT tag FROM tags WHERE bibkey = (?) ORDER BY tag ASC",
-                  (a_dict['bibkey'], ))
-        tags = tuple(r[0] for r in c.fetchall())
-    else:
-        tags = ()
-
-    return a_dict, tags
-
-
-def db_select_entry(c, bibkey):
-    """ Select entry from database
+def load_img(store, link):
+    """ Load image link from the image store. Return a null image if it is
+    missing """
+    data = store.read(link) if link else None
+    if data is None:
+        return QImage()
+    return QImage.fromData(data)
+
+
+def read_img_policy(c):
+    """ Return the image ingest policy of the library """
+    policy = dict(IMAGE_POLICY_DEFAULT)
+    policy.update(json.loads(db_get_setting(c, 'image_policy', '{}')))
+    return policy
+
+
+def is_diagram(img):
+    """ Guess if an image is a diagram / text screenshot rather than a photo,
+    by counting the colors of a small sample """
+    sample = img.scaled(64, 64, QtCore.Qt.IgnoreAspectRatio,
+                        QtCore.Qt.FastTransformation)
+    colors = set()
+    for y in range(sample.height()):
+        for x in range(sample.width()):
+            colors.add(sample.pixel(x, y))
+        if len(colors) > 64:
+            return False
+    return True
+
+
+def img_digest(img):
+    """ Return the hash of the pixels of an image, independent of the
+    pixel format it was delivered in """
+    img = img.convertToFormat(QImage.Format_ARGB32)
+    bits = img.constBits()
+    bits.setsize(img.sizeInBytes())
+    h = hashlib.sha1('{:d}x{:d}'.format(img.width(), img.height()).encode('ascii'))
+    h.update(bits)
+    return h.hexdigest()
+
+
+def encode_img(img, policy):
+    """ Downscale and encode an image according to the ingest policy
     :argument
-        c: sqlite3 cursor
+        img: QImage
+        policy: dict            see IMAGE_POLICY_DEFAULT
     :returns
-        entry_dict: dict
+        data: bytes             encoded image
+        ext: str                file extension of the format
     """
-    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
-              'method', 'finding', 'comment', 'img_linkstr']
-    sql = "SELECT {:s} FROM note WHERE bibkey = (?)".format(','.join(fields))
-    c.execute(sql, (bibkey,))
-    result = c.fetchall()[0]
-    a_dict = {}
-    for field, value in zip(fields, result):
-        a_dict[field] = value
-    c.execute("SELECT tag FROM tags WHERE bibkey = (?) ORDER BY tag ASC",
-              (a_dict['bibkey'],))
-    tags = tuple(r[0] for r in c.fetchall())
-    return a_dict, tags
-
-
-def db_query_all_tags(c):
-    """ Query all tags """
+    max_dim = policy['max_dim']
+    if max_dim and max(img.width(), img.height()) > max_dim:
+        img = img.scaled(max_dim, max_dim, QtCore.Qt.KeepAspectRatio,
+                         QtCore.Qt.SmoothTransformation)
+    fmt = policy['format']
+    diagram = None
+    if fmt == 'auto':
+        diagram = is_diagram(img)
+        if diagram:
+            fmt = 'png'
+        elif b'webp' in QImageWriter.supportedImageFormats():
+            fmt = 'webp'
+        else:
+            fmt = 'jpeg'
+    if fmt == 'png' and policy['quantize']:
+        if diagram is None:
+            diagram = is_diagram(img)
+        if diagram:
+            img = img.convertToFormat(QImage.Format_Indexed8,
+                                      QtCore.Qt.ThresholdDither | QtCore.Qt.AutoColor)
+    elif fmt == 'jpeg':
+        img = img.convertToFormat(QImage.Format_RGB32)
+
+    buffer = QtCore.QBuffer()
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    writer = QImageWriter(buffer, fmt.encode('ascii'))
+    if fmt == 'png':
+        # Qt maps png quality 0..100 to zlib level 9..0
+        writer.setQuality((9 - policy['png_level']) * 100 // 9)
+    else:
+        writer.setQuality(policy['quality'])
+    if not writer.write(img):
+        raise ValueError(writer.errorString())
+    return bytes(buffer.data()), 'jpg' if fmt == 'jpeg' else fmt
 
-    c.execute("SELECT DISTINCT tag FROM tags ORDER BY tag ASC")
-    return tuple(r[0] for r in c.fetchall())
 
+class ImageEncoder:
+    """ Encode pasted images in background threads """
 
-def db_search_fulltext(c, field, genre, keyword, tags=None):
-    """ Query bibkeys that matches fields with keyword
-    :argument
-        c: sqlite3 cursor
-        field: str
-        genre: str
-        keyword: str
-        tags: list of strings
-    :returns
-        bibkeys: list of matched bibkeys
-    """
-    if genre == 'ALL':
-        genre_cond = ''
-    else:
-        genre_cond = " genre = '{:s}' AND ".format(genre)
-
-    if tags:
-        tag_str = ", ".join(list("'{:s}'".format(t) for t in tags))
-        if field == 'ALL':
-            all_fields = '{author thesis hypothesis method finding comment}'
-            sql = """ SELECT DISTINCT note.bibkey FROM note 
-            JOIN tags ON note.bibkey = tags.bibkey
-            WHERE {:s} id IN 
-            (SELECT rowid FROM fts WHERE fts MATCH '{:s}: {:s}' ORDER BY RANK DESC)
-            AND tags.tag IN ({:s})
-            ORDER BY note.bibkey ASC
-            """.format(genre_cond, all_fields, keyword, tag_str)
-        else:
-            sql = """ SELECT DISTINCT note.bibkey FROM note
-            JOIN tags ON note.bibkey = tags.bibkey 
-            WHERE {:s} id IN 
-            (SELECT rowid FROM fts WHERE {:s} MATCH '{:s}' ORDER BY RANK DESC)
-            AND tags.tag IN ({:s})
-            ORDER BY note.bibkey ASC
-            """.format(genre_cond, field, keyword, tag_str)
-    else:
-        if field == 'ALL':
-            all_fields = '{author thesis hypothesis method finding comment}'
-            sql = """ SELECT bibkey FROM note WHERE {:s} id IN 
-            (SELECT rowid FROM fts WHERE fts MATCH '{:s}: {:s}' ORDER BY RANK DESC)
-            ORDER BY bibkey ASC
-            """.format(genre_cond, all_fields, keyword)
-        else:
-            sql = """ SELECT bibkey FROM note WHERE {:s} id IN 
-            (SELECT rowid FROM fts WHERE {:s} MATCH '{:s}' ORDER BY RANK DESC)
-            ORDER BY bibkey ASC
-            """.format(genre_cond, field, keyword)
+    def __init__(self, policy):
+        self._policy = dict(policy)
+        self._pool = ThreadPoolExecutor(max_workers=2)
 
-    c.execute(sql)
-    return list(res[0] for res in c.fetchall())
+    def setPolicy(self, policy):
+        self._policy = dict(policy)
 
+    def submit(self, img):
+        """ Return a future of encode_img(img) """
+        return self._pool.submit(encode_img, QImage(img), dict(self._policy))
 
-def db_search_bibkey(c, keyword):
-    """ Query bibkeys that matches fields with keyword
-    :argument
-        c: sqlite3 cursor
-        keyword: str
-    :returns
-        bibkeys: list of matched bibkeys
-    """
+    def submit_digest(self, img):
+        """ Return a future of img_digest(img) """
+        return self._pool.submit(img_digest, QImage(img))
 
-    sql = """ SELECT bibkey FROM note WHERE like('%{:s}%', bibkey) 
-    ORDER BY bibkey ASC """.format(keyword)
-    c.execute(sql)
-    return list(res[0] for res in c.fetchall())
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
 
 
-def save_img_to_disk(bibkey, list_img):
-    """ Save image to disk
+def save_img_to_store(store, bibkey, list_img, links, jobs):
+    """ Save new images to the image store
     :argument
-        img_pairs:  [(link, QImage)]
+        store: image store
+        bibkey: str
+        list_img:  [QImage]
+        links: [str]            links of the images, '' for unsaved ones
+        jobs: [Future]          pending encodings of the unsaved images
+    :returns
+        links: [str]            links of all images
     """
 
-    for img in list_img:
-        link = '.'.join(['{:s}_{:d}'.format(bibkey, img.cacheKey()), 'png'])
-        # check if this link is already on disk
-        filename = path_join(ROOT, 'img', link)
-        if isfile(filename):
-            pass
-        else:
-            img.save(filename)
+    new_links = []
+    for img, link, job in zip(list_img, links, jobs):
+        if not link:
+            try:
+                if job and not job.cancelled():
+                    data, ext = job.result()
+                else:
+                    data, ext = encode_img(img, IMAGE_POLICY_DEFAULT)
+            except ValueError:
+                # the format cannot be written by this Qt build
+                data, ext = encode_img(img, dict(IMAGE_POLICY_DEFAULT, format='png'))
+            link = '.'.join(['{:s}_{:d}'.format(bibkey, img.cacheKey()), ext])
+            # check if this link is already stored
+            if not store.exists(link):
+                store.write(link, data)
+        new_links.append(link)
+    return new_links
 
 
 if __name__ == '__main__':
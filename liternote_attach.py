@@ -0,0 +1,174 @@
+#! encoding = utf-8
+
+""" Attachments of liternote: the sources of a paper (plain text, Markdown
+or LaTeX) attached to its note and searched with it.
+
+A source is read line by line, stripped of its markup, and cut into chunks
+of about ATTACH_CHUNK_CHARS characters at paragraph boundaries, which are
+indexed as they are read (see liternote_db.db_add_attachment). Long
+sources are ingested by a pool of worker processes, each with its own
+database connection, so that reading and indexing a whole thesis never
+holds up the GUI.
+
+Only depends on the standard library.
+"""
+
+import re
+from os.path import basename, getsize, splitext
+
+from liternote_db import create_or_open_db, db_add_attachment
+
+ATTACH_KINDS = {
+    '.txt': 'text', '.text': 'text',
+    '.md': 'markdown', '.markdown': 'markdown',
+    '.tex': 'latex', '.ltx': 'latex',
+}
+ATTACH_CHUNK_CHARS = 2000
+ATTACH_WORKERS = 2
+
+_RE_SPACES = re.compile(r'\s+')
+_RE_TEX_COMMENT = re.compile(r'(?<!\\)%.*')
+# commands dropped with their arguments: references, layout, files
+_RE_TEX_DROP = re.compile(
+        r'\\(?:label|ref|eqref|cref|Cref|pageref|includegraphics|usepackage|'
+        r'documentclass|bibliographystyle|bibliography|input|include|url|'
+        r'begin|end|vspace|hspace|newcommand|renewcommand)\*?'
+        r'\s*(?:\[[^\]]*\])?\s*(?:\{[^}]*\})?')
+# other commands are dropped, their arguments are kept as text
+_RE_TEX_COMMAND = re.compile(r'\\[a-zA-Z@]+\*?(?:\[[^\]]*\])?')
+_RE_TEX_ESCAPE = re.compile(r'\\([%&_#$])')
+_RE_TEX_SYMBOLS = re.compile(r'\\\\|[{}$~^]')
+_RE_MD_IMAGE = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+_RE_MD_LINK = re.compile(r'\[([^\]]*)\]\([^)]*\)')
+_RE_MD_TAG = re.compile(r'<[^>]+>')
+_RE_MD_PREFIX = re.compile(r'^\s*(?:#{1,6}\s+|>\s?|[-*+]\s+|\d+\.\s+)*')
+_RE_MD_RULE = re.compile(r'^\s*(?:[-*_]\s*){3,}$')
+_RE_MD_MARKS = re.compile(r'[*`~]+')
+
+
+def attachment_kind(filename):
+    """ Return the kind of source of filename, by its extension """
+    ext = splitext(filename)[1].lower()
+    if ext not in ATTACH_KINDS:
+        raise ValueError('Unsupported attachment type: {:s}'.format(
+                ext or basename(filename)))
+    return ATTACH_KINDS[ext]
+
+
+def _tex_lines(lines):
+    """ Strip LaTeX markup line by line. The preamble is skipped. """
+    in_preamble = False
+    for line in lines:
+        line = _RE_TEX_COMMENT.sub('', line)
+        if '\\documentclass' in line:
+            in_preamble = True
+        if in_preamble:
+            if '\\begin{document}' in line:
+                in_preamble = False
+            continue
+        if '\\end{document}' in line:
+            break
+        line = _RE_TEX_DROP.sub(' ', line)
+        line = _RE_TEX_COMMAND.sub(' ', line)
+        line = _RE_TEX_ESCAPE.sub(r'\1', line)
+        yield _RE_TEX_SYMBOLS.sub(' ', line)
+
+
+def _md_lines(lines):
+    """ Strip Markdown markup line by line, keeping the text of links and
+    the content of code blocks """
+    for line in lines:
+        if line.lstrip().startswith('```') or _RE_MD_RULE.match(line):
+            yield ''
+            continue
+        line = _RE_MD_IMAGE.sub(r'\1', line)
+        line = _RE_MD_LINK.sub(r'\1', line)
+        line = _RE_MD_TAG.sub(' ', line)
+        line = _RE_MD_PREFIX.sub('', line)
+        yield _RE_MD_MARKS.sub('', line)
+
+
+_CLEANERS = {'text': iter, 'markdown': _md_lines, 'latex': _tex_lines}
+
+
+def iter_paragraphs(lines, kind='text'):
+    """ Yield the paragraphs of a source read line by line, without markup
+    and with their white space collapsed """
+    para = []
+    for line in _CLEANERS[kind](lines):
+        line = line.strip()
+        if line:
+            para.append(line)
+        elif para:
+            yield _RE_SPACES.sub(' ', ' '.join(para))
+            para = []
+    if para:
+        yield _RE_SPACES.sub(' ', ' '.join(para))
+
+
+def iter_chunks(lines, kind='text', size=ATTACH_CHUNK_CHARS):
+    """ Yield the text of a source in chunks of about size characters.
+    Paragraphs are kept whole unless longer than size, which are cut at
+    a space. """
+    chunk = []
+    n = 0
+    for para in iter_paragraphs(lines, kind):
+        if chunk and n + len(para) > size:
+            yield '\n'.join(chunk)
+            chunk = []
+            n = 0
+        while len(para) > size:
+            cut = para.rfind(' ', 0, size)
+            if cut <= 0:
+                cut = size
+            yield para[:cut]
+            para = para[cut:].lstrip()
+        if para:
+            chunk.append(para)
+            n += len(para) + 1
+    if chunk:
+        yield '\n'.join(chunk)
+
+
+def ingest_attachment(db_file, bibkey, filename, name=None):
+    """ Attach the source filename to note bibkey and index it. Runs in a
+    worker process of AttachmentIngester, or in the caller.
+    :argument
+        db_file: str            database file
+        bibkey: str
+        filename: str           the source
+        name: str               name of the attachment, default the file name
+    :returns
+        info: dict              see db_add_attachment
+    """
+    kind = attachment_kind(filename)
+    conn, c = create_or_open_db(db_file)
+    try:
+        with open(filename, encoding='utf-8', errors='replace') as f:
+            return db_add_attachment(conn, c, bibkey, name or basename(filename),
+                                     kind, iter_chunks(f, kind),
+                                     size=getsize(filename))
+    finally:
+        conn.close()
+
+
+class AttachmentIngester:
+    """ Ingest attachments in worker processes. The processes are started
+    by the first submit, and never forked from the (threaded) caller. """
+
+    def __init__(self, db_file, workers=ATTACH_WORKERS):
+        # imported here, the command line only ingests in its own process
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        self._db_file = db_file
+        self._pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, bibkey, filename, name=None):
+        """ Return a future of ingest_attachment """
+        return self._pool.submit(ingest_attachment, self._db_file, bibkey,
+                                 filename, name)
+
+    def shutdown(self):
+        """ Drop the queued sources, the ones being read are finished """
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,324 @@
+#! encoding = utf-8
+
+""" Online backups of a liternote library.
+
+A snapshot is a directory backup/YYYYmmdd-HHMMSS/ holding
+
+    liternote.db        copy of the database made with the sqlite backup API
+    img/NAME            the images, hardlinked to backup/objects/
+    manifest.json       sha1 of every image, and the store signature it had
+
+The database is copied a few pages at a time, so that the GUI and the
+autosave thread are never locked out for long. In WAL mode the copy keeps
+a read transaction open: it sees one consistent state of the database
+and is not restarted by concurrent writes, which do not wait for it.
+
+Images are stored once in backup/objects/ under their sha1 and hardlinked
+into every snapshot that has them, so a snapshot only costs the space of
+the images added since the previous one. Images whose store signature is
+unchanged since the previous snapshot are not read again.
+
+Only depends on the standard library.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from os.path import dirname, realpath, isdir, isfile
+from os.path import join as path_join
+
+BACKUP_PAGES = 256          # database pages copied per step
+BACKUP_SLEEP = 0.005        # seconds between steps, others get the lock
+BACKUP_KEEP = 7             # snapshots kept by rotation
+BACKUP_INTERVAL_MIN = 60    # minutes between scheduled backups, 0 disables
+BACKUP_MAX_RESTARTS = 3     # restarts tolerated before copying in one step
+_DB_NAME = 'liternote.db'
+_MANIFEST = 'manifest.json'
+_TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+
+class _Restarted(Exception):
+    pass
+
+
+def backup_root(db_file):
+    """ Backups are kept in backup/ next to the database """
+    return path_join(dirname(realpath(db_file)), 'backup')
+
+
+def list_backups(root):
+    """ Return the names of the complete snapshots in root, oldest first """
+    if not isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if isfile(path_join(root, name, _MANIFEST)))
+
+
+def _sha1_file(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for part in iter(lambda: f.read(1 << 20), b''):
+            h.update(part)
+    return h.hexdigest()
+
+
+def _copy_db(db_file, target, pages, sleep, progress):
+    """ Copy database db_file to target with the backup API """
+    src = sqlite3.connect('file:{:s}?mode=ro'.format(db_file), uri=True,
+                          isolation_level=None)
+    dst = sqlite3.connect(target)
+    try:
+        wal = src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        if wal:
+            # pin one snapshot of the database for the whole copy
+            src.execute('BEGIN')
+            src.execute('SELECT COUNT(*) FROM sqlite_master').fetchall()
+        last = [None, 0]    # pages remaining at the last step, restarts
+
+        def step(status, n_remaining, n_total):
+            # a write by another connection restarts the copy from page 1
+            if last[0] is not None and n_remaining > last[0]:
+                last[1] += 1
+                if last[1] > BACKUP_MAX_RESTARTS:
+                    raise _Restarted()
+            last[0] = n_remaining
+            if progress:
+                progress(n_total - n_remaining, n_total)
+
+        try:
+            src.backup(dst, pages=pages, progress=step, sleep=sleep)
+        except _Restarted:
+            # edits keep coming: copy the rest in one step
+            src.backup(dst, pages=-1)
+        if wal:
+            src.execute('COMMIT')
+        # a snapshot is one self-contained file
+        dst.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        src.close()
+        dst.close()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:     # no hardlinks on this file system
+        shutil.copyfile(src, dst)
+
+
+def _snapshot_images(store, root, target, previous):
+    """ Write the images of store into target/img, reusing the objects of
+    the previous manifest when the store signature is unchanged
+    :returns
+        images: dict            {name: [sha1, signature]}
+        n_new: int              number of objects written
+    """
+    img_dir = path_join(target, 'img')
+    os.makedirs(img_dir)
+    images = {}
+    n_new = 0
+    for name in store.names():
+        signature = store.signature(name)
+        old = previous.get(name)
+        if old and old[1] == signature and \
+                isfile(path_join(root, 'objects', old[0][:2], old[0])):
+            sha = old[0]
+        else:
+            data = store.read(name)
+            if data is None:    # deleted meanwhile
+                continue
+            sha = hashlib.sha1(data).hexdigest()
+            obj = path_join(root, 'objects', sha[:2], sha)
+            if not isfile(obj):
+                os.makedirs(dirname(obj), exist_ok=True)
+                with open(obj + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(obj + '.tmp', obj)
+                n_new += 1
+        _link_or_copy(path_join(root, 'objects', sha[:2], sha), path_join(img_dir, name))
+        images[name] = [sha, signature]
+    return images, n_new
+
+
+def _read_manifest(snapshot):
+    with open(path_join(snapshot, _MANIFEST), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def create_backup(db_file, store, root=None, keep=BACKUP_KEEP,
+                  pages=BACKUP_PAGES, sleep=BACKUP_SLEEP, progress=None):
+    """ Take a snapshot of the database and images, then rotate old ones.
+    Safe to run while the library is in use, from any thread.
+    :argument
+        db_file: str            database file
+        store: image store
+        root: str               backup directory, default backup_root(db_file)
+        keep: int               snapshots kept, None keeps all
+        pages: int              database pages copied per step
+        sleep: float            seconds between steps
+        progress: callable      progress(n_pages_done, n_pages)
+    :returns
+        info: dict              snapshot name, pages, images, new images,
+                                removed snapshots
+    """
+    root = root or backup_root(db_file)
+    os.makedirs(root, exist_ok=True)
+    names = list_backups(root)
+    previous = _read_manifest(path_join(root, names[-1]))['images'] if names else {}
+    name = time.strftime(_TIME_FORMAT)
+    while name in names or isdir(path_join(root, name)):
+        name += '_'
+    # built under a temporary name, a torn snapshot is never listed
+    tmp = path_join(root, name + '.tmp')
+    if isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    n_pages = [0]
+
+    def db_progress(done, total):
+        n_pages[0] = total
+        if progress:
+            progress(done, total)
+
+    _copy_db(db_file, path_join(tmp, _DB_NAME), pages, sleep, db_progress)
+    images, n_new = _snapshot_images(store, root, tmp, previous)
+    with open(path_join(tmp, _MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump({'time': time.time(), 'image_backend': store.backend,
+                   'images': images}, f)
+    os.rename(tmp, path_join(root, name))
+    removed = rotate_backups(root, keep) if keep else []
+    return {'snapshot': name, 'pages': n_pages[0], 'images': len(images),
+            'new_images': n_new, 'removed': removed}
+
+
+def rotate_backups(root, keep=BACKUP_KEEP):
+    """ Delete all but the keep latest snapshots, and the image objects no
+    snapshot links to any more
+    :returns
+        removed: list of str    names of the deleted snapshots
+    """
+    names = list_backups(root)
+    removed = names[:-keep] if keep > 0 else names
+    for name in removed:
+        shutil.rmtree(path_join(root, name))
+    objects = path_join(root, 'objects')
+    if removed and isdir(objects):
+        with os.scandir(objects) as it:
+            subdirs = list(entry.path for entry in it if entry.is_dir())
+        for subdir in subdirs:
+            with os.scandir(subdir) as it:
+                for entry in it:
+                    # only the object itself is left
+                    if entry.stat().st_nlink == 1:
+                        os.remove(entry.path)
+    return removed
+
+
+def verify_backup(snapshot):
+    """ Check the database integrity and the images of a snapshot
+    :returns
+        problems: list of str   empty if the snapshot is sound
+    """
+    problems = []
+    db_file = path_join(snapshot, _DB_NAME)
+    if not isfile(db_file):
+        return ['missing database']
+    conn = sqlite3.connect('file:{:s}?mode=ro'.format(db_file), uri=True)
+    try:
+        res = list(r[0] for r in conn.execute('PRAGMA integrity_check'))
+        if res != ['ok']:
+            problems.extend('database: ' + r for r in res)
+    except sqlite3.Error as err:
+        problems.append('database: ' + str(err))
+    finally:
+        conn.close()
+    try:
+        images = _read_manifest(snapshot)['images']
+    except (OSError, ValueError, KeyError) as err:
+        return problems + ['manifest: ' + str(err)]
+    for name, (sha, signature) in images.items():
+        filename = path_join(snapshot, 'img', name)
+        if not isfile(filename):
+            problems.append('missing image: ' + name)
+        elif _sha1_file(filename) != sha:
+            problems.append('corrupt image: ' + name)
+    return problems
+
+
+def restore_backup(snapshot, db_file, store):
+    """ Replace the database with the one of a snapshot, and write back the
+    images that are missing from the store or differ from the snapshot.
+    Images the snapshot does not have are left for garbage collection.
+    The library must not be in use.
+    :returns
+        info: dict              number of images written
+    """
+    problems = verify_backup(snapshot)
+    if problems:
+        raise ValueError('Snapshot {:s} is damaged: {:s}'.format(
+                snapshot, '; '.join(problems[:5])))
+    src = sqlite3.connect('file:{:s}?mode=ro'.format(path_join(snapshot, _DB_NAME)),
+                          uri=True)
+    dst = sqlite3.connect(db_file)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+    n = 0
+    for name, (sha, signature) in _read_manifest(snapshot)['images'].items():
+        data = store.read(name)
+        if data is None or hashlib.sha1(data).hexdigest() != sha:
+            with open(path_join(snapshot, 'img', name), 'rb') as f:
+                store.write(name, f.read())
+            n += 1
+    return {'images': n}
+
+
+class BackupScheduler:
+    """ Background thread that takes a snapshot every interval minutes.
+    done(info, error) is called from the thread after each backup. """
+
+    def __init__(self, db_file, store, root=None, interval=BACKUP_INTERVAL_MIN,
+                 keep=BACKUP_KEEP, done=None):
+        self._db_file = db_file
+        self._store = store
+        self._root = root
+        self._interval = interval
+        self._keep = keep
+        self._done = done
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def run_now(self):
+        """ Take a snapshot as soon as possible """
+        self._wake.set()
+
+    def close(self):
+        """ Stop the thread, after the backup in progress if any """
+        self._stop = True
+        self._wake.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            # interval 0: only backups asked for with run_now
+            self._wake.wait(self._interval * 60 if self._interval > 0 else None)
+            self._wake.clear()
+            if self._stop:
+                break
+            try:
+                info = create_backup(self._db_file, self._store, self._root,
+                                     keep=self._keep)
+                error = None
+            except (OSError, sqlite3.Error) as err:
+                info = None
+                error = err
+            if self._done:
+                self._done(info, error)
@@ -0,0 +1,571 @@
+#! encoding = utf-8
+
+""" Command line interface of liternote. Prints JSON to stdout and never
+imports the GUI, so it starts quickly enough for shell loops and editor
+integrations.
+
+Usage:
+    liternote-cli search [--field F] [--genre G] [--tag T ...] [--attachments] QUERY
+    liternote-cli show BIBKEY
+    liternote-cli add BIBKEY [--author A] [--genre G] [--thesis T] ... [--tag T ...]
+    liternote-cli add --json FILE      (use - for stdin)
+    liternote-cli tags
+    liternote-cli stats [--full] [--verify] [--rebuild]
+    liternote-cli saved [NAME]
+    liternote-cli history BIBKEY [--rev N]
+    liternote-cli prune-history [--keep N] [BIBKEY]
+    liternote-cli related [-n N] BIBKEY
+    liternote-cli bulk (--add-tag T | --remove-tag T | --set-genre G | --delete) BIBKEY ...
+    liternote-cli rename-tag OLD NEW
+    liternote-cli rebuild-related
+    liternote-cli links [--cited-by | --hops N] BIBKEY
+    liternote-cli link [--remove] [--kind K] SRC DST
+    liternote-cli rebuild-links
+    liternote-cli attach BIBKEY FILE ...
+    liternote-cli attachments BIBKEY
+    liternote-cli detach BIBKEY NAME
+    liternote-cli migrate-images --to BACKEND [--keep-source]
+    liternote-cli gc [--apply] [--fix-dangling] [--list]
+    liternote-cli sync-export [--since V] BUNDLE
+    liternote-cli sync-apply BUNDLE
+    liternote-cli sync-reset-site
+    liternote-cli backup [--keep N]
+    liternote-cli backup-list
+    liternote-cli backup-verify [SNAPSHOT]
+    liternote-cli backup-restore SNAPSHOT
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+from os.path import dirname, realpath
+from os.path import join as path_join
+
+from liternote_db import (
+    DB_FILE, FTS_FIELDS, create_or_open_db, db_get_setting, db_set_setting, db_bibkey_id, db_insert_entry,
+    db_select_entry, db_query_all_tags, db_search_fulltext, db_stats,
+    db_list_saved_searches, db_open_saved_search, db_list_revisions,
+    db_select_revision, db_prune_revisions, db_iter_img_links,
+    db_remove_img_links, db_remove_img_digests, db_rebuild_similar,
+    db_similar_missing, db_related, db_stats_months, db_stats_genre_length,
+    db_tag_cooccurrence, db_verify_stats, db_rebuild_stats, db_bulk_set_genre,
+    db_bulk_add_tag, db_bulk_remove_tag, db_rename_tag, db_delete_entries,
+    db_rebuild_links, db_links_missing, db_add_link, db_remove_link, db_links,
+    db_link_neighbourhood, db_set_storage, db_storage_info, STORAGE_MODES,
+    db_search_hits, db_list_attachments, db_remove_attachment,
+)
+# the image, sync, attachment and backup modules are imported by the
+# commands that use them, which keeps --help and queries fast
+
+GENRES = ['Code', 'Experiment', 'Instrum', 'Theory', 'Review']
+ENTRY_FIELDS = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
+                'method', 'finding', 'comment', 'img_linkstr']
+
+
+class CliError(Exception):
+    pass
+
+
+def cmd_search(conn, c, args):
+    if args.attachments:
+        return list(hit._asdict() for hit in
+                    db_search_hits(c, args.field, args.genre, args.query,
+                                   tags=args.tag, snippets=None))
+    return db_search_fulltext(c, args.field, args.genre, args.query,
+                              tags=args.tag)
+
+
+def cmd_show(conn, c, args):
+    if not db_bibkey_id(c, args.bibkey):
+        raise CliError('Bibkey not found: {:s}'.format(args.bibkey))
+    entry_dict, tags = db_select_entry(c, args.bibkey)
+    entry_dict['tags'] = list(tags)
+    return entry_dict
+
+
+def cmd_add(conn, c, args):
+    if args.json:
+        if args.json == '-':
+            entry_dict = json.load(sys.stdin)
+        else:
+            with open(args.json, encoding='utf-8') as f:
+                entry_dict = json.load(f)
+        tags = entry_dict.pop('tags', [])
+    else:
+        entry_dict = {field: getattr(args, field) for field in ENTRY_FIELDS
+                      if field != 'img_linkstr'}
+        tags = args.tag
+    entry_dict = {field: entry_dict.get(field) or '' for field in ENTRY_FIELDS}
+    entry_dict['bibkey'] = entry_dict['bibkey'].strip()
+    if not entry_dict['bibkey']:
+        raise CliError('A bibkey is required')
+    if entry_dict['genre'] not in GENRES:
+        raise CliError('Genre must be one of: {:s}'.format(', '.join(GENRES)))
+    if db_bibkey_id(c, entry_dict['bibkey']):
+        raise CliError('Bibkey already exists: {:s}'.format(entry_dict['bibkey']))
+    db_insert_entry(conn, c, entry_dict, tags=tags)
+    return {'bibkey': entry_dict['bibkey'], 'id': db_bibkey_id(c, entry_dict['bibkey'])}
+
+
+def cmd_tags(conn, c, args):
+    return list(db_query_all_tags(c))
+
+
+def cmd_stats(conn, c, args):
+    if args.rebuild:
+        db_rebuild_stats(conn, c)
+    if args.verify:
+        return {'drift': db_verify_stats(c)}
+    stats = db_stats(c)
+    if args.full:
+        stats['genre_length'] = db_stats_genre_length(c)
+        stats['months'] = db_stats_months(c)
+        stats['tag_pairs'] = db_tag_cooccurrence(c, n=args.pairs)
+    return stats
+
+
+def cmd_saved(conn, c, args):
+    if args.name:
+        return db_open_saved_search(c, args.name)
+    else:
+        return db_list_saved_searches(c)
+
+
+def cmd_history(conn, c, args):
+    if not db_bibkey_id(c, args.bibkey):
+        raise CliError('Bibkey not found: {:s}'.format(args.bibkey))
+    if args.rev is None:
+        return list({'rev': rev, 'time': t, 'fields': fields}
+                    for rev, t, fields in db_list_revisions(c, args.bibkey))
+    fields = db_select_revision(c, args.bibkey, args.rev)
+    if fields is None:
+        raise CliError('Revision not found: {:d}'.format(args.rev))
+    return fields
+
+
+def cmd_prune_history(conn, c, args):
+    if args.bibkey and not db_bibkey_id(c, args.bibkey):
+        raise CliError('Bibkey not found: {:s}'.format(args.bibkey))
+    return {'pruned': db_prune_revisions(conn, c, keep=args.keep,
+                                         bibkey=args.bibkey or None)}
+
+
+def cmd_related(conn, c, args):
+    if not db_bibkey_id(c, args.bibkey):
+        raise CliError('Bibkey not found: {:s}'.format(args.bibkey))
+    if db_similar_missing(c):
+        db_rebuild_similar(conn, c)
+    return list({'bibkey': bibkey, 'score': round(score, 4)}
+                for bibkey, score in db_related(c, args.bibkey, n=args.n))
+
+
+def cmd_rebuild_related(conn, c, args):
+    db_rebuild_similar(conn, c)
+    return {'indexed': db_stats(c)['notes']}
+
+
+def cmd_links(conn, c, args):
+    if not db_bibkey_id(c, args.bibkey):
+        raise CliError('Bibkey not found: {:s}'.format(args.bibkey))
+    if db_links_missing(c):
+        db_rebuild_links(conn, c)
+    if args.hops:
+        return list({'bibkey': bibkey, 'distance': d}
+                    for bibkey, d in db_link_neighbourhood(c, args.bibkey, args.hops))
+    return list({'bibkey': bibkey, 'kind': kind}
+                for bibkey, kind in db_links(c, args.bibkey, cited_by=args.cited_by))
+
+
+def cmd_link(conn, c, args):
+    for bibkey in (args.src, args.dst):
+        if not db_bibkey_id(c, bibkey):
+            raise CliError('Bibkey not found: {:s}'.format(bibkey))
+    if args.remove:
+        db_remove_link(conn, c, args.src, args.dst, args.kind)
+        return {'removed': True}
+    return {'added': db_add_link(conn, c, args.src, args.dst, args.kind)}
+
+
+def cmd_rebuild_links(conn, c, args):
+    db_rebuild_links(conn, c)
+    c.execute('SELECT COUNT(*) FROM note_link')
+    return {'links': c.fetchone()[0]}
+
+
+def cmd_storage(conn, c, args):
+    if args.to:
+        info = db_storage_info(c)
+        n = db_set_storage(conn, c, args.to, vacuum=args.vacuum)
+        return {'from': info['mode'], 'to': args.to, 'notes': n,
+                'packed': db_storage_info(c)['packed']}
+    return db_storage_info(c)
+
+
+def img_dir(args):
+    """ Images are kept in img/ next to the database """
+    return path_join(dirname(realpath(args.db)), 'img')
+
+
+def open_store(c, args):
+    """ Open the image store of the library with its configured backend """
+    from liternote_img import IMAGE_DEFAULT_BACKEND, open_image_store
+    return open_image_store(db_get_setting(c, 'image_backend', IMAGE_DEFAULT_BACKEND),
+                            img_dir(args))
+
+
+def cmd_attach(conn, c, args):
+    from liternote_attach import ingest_attachment
+    if not db_bibkey_id(c, args.bibkey):
+        raise CliError('Bibkey not found: {:s}'.format(args.bibkey))
+    try:
+        return list(ingest_attachment(args.db, args.bibkey, filename)
+                    for filename in args.files)
+    except OSError as err:
+        raise CliError(str(err))
+
+
+def cmd_attachments(conn, c, args):
+    return list({'name': name, 'kind': kind, 'size': size, 'chunks': n, 'added': added}
+                for name, kind, size, n, added in db_list_attachments(c, args.bibkey))
+
+
+def cmd_detach(conn, c, args):
+    if not db_remove_attachment(conn, c, args.bibkey, args.name):
+        raise CliError('No attachment {:s} of {:s}'.format(args.name, args.bibkey))
+    return {'removed': args.name}
+
+
+def cmd_bulk(conn, c, args):
+    if args.add_tag:
+        return {'changed': db_bulk_add_tag(conn, c, args.bibkeys, args.add_tag)}
+    elif args.remove_tag:
+        return {'changed': db_bulk_remove_tag(conn, c, args.bibkeys, args.remove_tag)}
+    elif args.set_genre:
+        return {'changed': db_bulk_set_genre(conn, c, args.bibkeys, args.set_genre)}
+    n = db_stats(c)['notes']
+    links = db_delete_entries(conn, c, args.bibkeys)
+    store = open_store(c, args)
+    try:
+        for link in links:
+            store.delete(link)
+    finally:
+        store.close()
+    db_remove_img_digests(conn, c, links)
+    return {'deleted': n - db_stats(c)['notes'], 'removed_images': len(links)}
+
+
+def cmd_rename_tag(conn, c, args):
+    return {'changed': db_rename_tag(conn, c, args.old, args.new)}
+
+
+def cmd_migrate_images(conn, c, args):
+    from liternote_img import (
+        IMAGE_BACKENDS, IMAGE_DEFAULT_BACKEND, open_image_store, migrate_images,
+    )
+    if args.to not in IMAGE_BACKENDS:
+        raise CliError('Backend must be one of: {:s}'.format(', '.join(IMAGE_BACKENDS)))
+    backend = db_get_setting(c, 'image_backend', IMAGE_DEFAULT_BACKEND)
+    if backend == args.to:
+        raise CliError('Images are already stored with backend {:s}'.format(backend))
+    src = open_image_store(backend, img_dir(args))
+    dst = open_image_store(args.to, img_dir(args))
+    try:
+        n = migrate_images(src, dst, delete_src=not args.keep_source)
+    finally:
+        src.close()
+        dst.close()
+    db_set_setting(conn, c, 'image_backend', args.to)
+    return {'from': backend, 'to': args.to, 'images': n}
+
+
+def cmd_gc(conn, c, args):
+    from liternote_img import collect_garbage
+    store = open_store(c, args)
+    try:
+        orphans, dangling = collect_garbage(
+                store, (link for id_, link in db_iter_img_links(c)),
+                dry_run=not args.apply)
+    finally:
+        store.close()
+    if args.apply:
+        db_remove_img_digests(conn, c, orphans)
+    result = {'orphans': len(orphans), 'dangling': len(dangling),
+              'removed_orphans': 0 if not args.apply else len(orphans),
+              'fixed_notes': 0}
+    if args.fix_dangling and dangling:
+        result['fixed_notes'] = db_remove_img_links(conn, c, dangling)
+    if args.list:
+        result['orphan_list'] = orphans
+        result['dangling_list'] = dangling
+    return result
+
+
+def cmd_sync_export(conn, c, args):
+    from liternote_sync import export_bundle
+    store = open_store(c, args)
+    try:
+        return export_bundle(conn, c, store, args.bundle, since=args.since)
+    finally:
+        store.close()
+
+
+def cmd_sync_apply(conn, c, args):
+    from liternote_sync import apply_bundle
+    store = open_store(c, args)
+    try:
+        return apply_bundle(conn, c, store, args.bundle)
+    finally:
+        store.close()
+
+
+def cmd_sync_reset_site(conn, c, args):
+    from liternote_sync import reset_site
+    return {'site': reset_site(conn, c)}
+
+
+def cmd_backup(conn, c, args):
+    from liternote_backup import BACKUP_KEEP, create_backup
+    keep = args.keep if args.keep is not None else \
+        int(db_get_setting(c, 'backup_keep', str(BACKUP_KEEP)))
+    store = open_store(c, args)
+    try:
+        return create_backup(args.db, store, keep=keep)
+    finally:
+        store.close()
+
+
+def cmd_backup_list(conn, c, args):
+    from liternote_backup import backup_root, list_backups
+    return list_backups(backup_root(args.db))
+
+
+def cmd_backup_verify(conn, c, args):
+    from liternote_backup import backup_root, list_backups, verify_backup
+    root = backup_root(args.db)
+    names = [args.snapshot] if args.snapshot else list_backups(root)
+    return {name: verify_backup(path_join(root, name)) for name in names}
+
+
+def cmd_backup_restore(conn, c, args):
+    from liternote_backup import (
+        backup_root, list_backups, create_backup, restore_backup,
+    )
+    root = backup_root(args.db)
+    if args.snapshot not in list_backups(root):
+        raise CliError('No such snapshot: {:s}'.format(args.snapshot))
+    store = open_store(c, args)
+    try:
+        # the current state is kept as a snapshot of its own
+        saved = create_backup(args.db, store, keep=None)['snapshot']
+        conn.close()
+        result = restore_backup(path_join(root, args.snapshot), args.db, store)
+    finally:
+        store.close()
+    result['saved_as'] = saved
+    return result
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='liternote-cli',
+                                     description='Query liternote from the terminal')
+    parser.add_argument('--db', default=DB_FILE, help='database file')
+    parser.add_argument('--indent', type=int, default=None,
+                        help='indent the JSON output')
+    sub = parser.add_subparsers(dest='command', metavar='command')
+    sub.required = True
+
+    p = sub.add_parser('search', help='full text search, prints bibkeys')
+    p.add_argument('query')
+    p.add_argument('--field', default='ALL', choices=['ALL'] + FTS_FIELDS)
+    p.add_argument('--genre', default='ALL', choices=['ALL'] + GENRES)
+    p.add_argument('--tag', action='append', default=[],
+                   help='notes must have one of these tags')
+    p.add_argument('--attachments', action='store_true',
+                   help='search the attachments too, prints ranked hits with snippets')
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser('show', help='print one note')
+    p.add_argument('bibkey')
+    p.set_defaults(func=cmd_show)
+
+    p = sub.add_parser('add', help='add a new note')
+    p.add_argument('bibkey', nargs='?', default='')
+    p.add_argument('--json', help='read the note from a JSON file, - for stdin')
+    p.add_argument('--genre', default='Theory', choices=GENRES)
+    for field in FTS_FIELDS:
+        p.add_argument('--' + field, default='')
+    p.add_argument('--tag', action='append', default=[])
+    p.set_defaults(func=cmd_add)
+
+    p = sub.add_parser('tags', help='list all tags')
+    p.set_defaults(func=cmd_tags)
+
+    p = sub.add_parser('stats', help='library statistics')
+    p.add_argument('--full', action='store_true',
+                   help='add note length per genre, notes per month and tag pairs')
+    p.add_argument('--pairs', type=int, default=20, help='number of tag pairs')
+    p.add_argument('--verify', action='store_true',
+                   help='recompute from scratch and list the counts that drifted')
+    p.add_argument('--rebuild', action='store_true',
+                   help='recompute the statistics from scratch')
+    p.set_defaults(func=cmd_stats)
+
+    p = sub.add_parser('saved', help='list saved searches, or open one')
+    p.add_argument('name', nargs='?', default='')
+    p.set_defaults(func=cmd_saved)
+
+    p = sub.add_parser('history', help='list the revisions of a note, or show one')
+    p.add_argument('bibkey')
+    p.add_argument('--rev', type=int, default=None)
+    p.set_defaults(func=cmd_history)
+
+    p = sub.add_parser('prune-history', help='drop old revisions')
+    p.add_argument('bibkey', nargs='?', default='')
+    p.add_argument('--keep', type=int, default=100,
+                   help='number of revisions kept per note')
+    p.set_defaults(func=cmd_prune_history)
+
+    p = sub.add_parser('related', help='notes similar to a note')
+    p.add_argument('bibkey')
+    p.add_argument('-n', type=int, default=10, help='number of notes')
+    p.set_defaults(func=cmd_related)
+
+    p = sub.add_parser('rebuild-related',
+                       help='rebuild the related notes index from scratch')
+    p.set_defaults(func=cmd_rebuild_related)
+
+    p = sub.add_parser('links', help='notes a note cites (mentions or links '
+                                     'to), or is cited by')
+    p.add_argument('bibkey')
+    group = p.add_mutually_exclusive_group()
+    group.add_argument('--cited-by', action='store_true')
+    group.add_argument('--hops', type=int, default=0,
+                       help='notes within this many links, either direction')
+    p.set_defaults(func=cmd_links)
+
+    p = sub.add_parser('link', help='link a note to another by hand')
+    p.add_argument('src')
+    p.add_argument('dst')
+    p.add_argument('--kind', default='cites')
+    p.add_argument('--remove', action='store_true')
+    p.set_defaults(func=cmd_link)
+
+    p = sub.add_parser('rebuild-links',
+                       help='find the bibkeys mentioned in all notes from scratch')
+    p.set_defaults(func=cmd_rebuild_links)
+
+    p = sub.add_parser('bulk', help='change or delete several notes at once '
+                                    '(close the GUI first to delete)')
+    p.add_argument('bibkeys', nargs='+')
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument('--add-tag')
+    group.add_argument('--remove-tag')
+    group.add_argument('--set-genre', choices=GENRES)
+    group.add_argument('--delete', action='store_true',
+                       help='delete the notes and the images only they link to')
+    p.set_defaults(func=cmd_bulk)
+
+    p = sub.add_parser('rename-tag', help='rename a tag, or merge it into another')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.set_defaults(func=cmd_rename_tag)
+
+    p = sub.add_parser('migrate-images',
+                       help='move images to another storage backend '
+                            '(close the GUI first)')
+    p.add_argument('--to', required=True, metavar='BACKEND',
+                   help='file, sqlite or pack')
+    p.add_argument('--keep-source', action='store_true',
+                   help='do not delete images from the old backend')
+    p.set_defaults(func=cmd_migrate_images)
+
+    p = sub.add_parser('storage', help='show how the note texts are stored, '
+                                       'or convert them, safe while the GUI is open')
+    p.add_argument('--to', choices=STORAGE_MODES, default=None,
+                   help='zlib compresses the long texts; only liternote can '
+                        'write to a zlib library')
+    p.add_argument('--vacuum', action='store_true',
+                   help='shrink the file afterwards (locks the library meanwhile)')
+    p.set_defaults(func=cmd_storage)
+
+    p = sub.add_parser('attach', help='attach text, Markdown or LaTeX sources '
+                                      'to a note and index them for search')
+    p.add_argument('bibkey')
+    p.add_argument('files', nargs='+')
+    p.set_defaults(func=cmd_attach)
+
+    p = sub.add_parser('attachments', help='list the attachments of a note')
+    p.add_argument('bibkey')
+    p.set_defaults(func=cmd_attachments)
+
+    p = sub.add_parser('detach', help='remove an attachment from a note')
+    p.add_argument('bibkey')
+    p.add_argument('name')
+    p.set_defaults(func=cmd_detach)
+
+    p = sub.add_parser('gc', help='find images no note links to, and links '
+                                  'to missing images (close the GUI first)')
+    p.add_argument('--apply', action='store_true',
+                   help='delete the orphaned images (default is a dry run)')
+    p.add_argument('--fix-dangling', action='store_true',
+                   help='remove links to missing images from the notes')
+    p.add_argument('--list', action='store_true', help='list the names')
+    p.set_defaults(func=cmd_gc)
+
+    p = sub.add_parser('sync-export', help='write the changes since the last '
+                                           'export to a bundle')
+    p.add_argument('bundle')
+    p.add_argument('--since', type=int, default=None,
+                   help='export the changes after this version (0 for all)')
+    p.set_defaults(func=cmd_sync_export)
+
+    p = sub.add_parser('sync-apply', help='merge a bundle exported by another '
+                                          'copy of the library')
+    p.add_argument('bundle')
+    p.set_defaults(func=cmd_sync_apply)
+
+    p = sub.add_parser('sync-reset-site', help='give the library a new site, '
+                                               'after copying its database file')
+    p.set_defaults(func=cmd_sync_reset_site)
+
+    p = sub.add_parser('backup', help='snapshot the database and images, '
+                                      'safe while the GUI is open')
+    p.add_argument('--keep', type=int, default=None,
+                   help='number of snapshots kept (default: the backup_keep setting)')
+    p.set_defaults(func=cmd_backup)
+
+    p = sub.add_parser('backup-list', help='list the snapshots, oldest first')
+    p.set_defaults(func=cmd_backup_list)
+
+    p = sub.add_parser('backup-verify', help='check the database and images '
+                                             'of the snapshots')
+    p.add_argument('snapshot', nargs='?', default='')
+    p.set_defaults(func=cmd_backup_verify)
+
+    p = sub.add_parser('backup-restore', help='restore a snapshot, after taking '
+                                              'one of the current state '
+                                              '(close the GUI first)')
+    p.add_argument('snapshot')
+    p.set_defaults(func=cmd_backup_restore)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    conn, c = create_or_open_db(args.db)
+    try:
+        result = args.func(conn, c, args)
+    except (CliError, sqlite3.Error, ValueError) as err:
+        json.dump({'error': str(err)}, sys.stderr)
+        sys.stderr.write('\n')
+        return 1
+    finally:
+        conn.close()
+    json.dump(result, sys.stdout, ensure_ascii=False, indent=args.indent)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
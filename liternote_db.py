@@ -0,0 +1,2767 @@
+#! encoding = utf-8
+
+""" Database layer of liternote. Only depends on the standard library so
+that it can be used without the GUI.
+"""
+
+import sqlite3
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+import zlib
+import re
+from array import array
+from collections import Counter
+from math import log, sqrt
+from difflib import SequenceMatcher
+from collections import namedtuple
+from functools import lru_cache
+from os.path import realpath, dirname, isfile
+from os.path import join as path_join
+
+ROOT = dirname(realpath(__file__))
+DB_FILE = path_join(ROOT, 'liternote.db')
+JOURNAL_FILE = path_join(ROOT, 'liternote.journal')
+
+FTS_FIELDS = ['author', 'thesis', 'hypothesis', 'method', 'finding', 'comment']
+# tokenizer presets of the fts index, selectable per library
+FTS_TOKENIZERS = {
+    'unicode61': 'unicode61',
+    'unicode61 (fold diacritics)': 'unicode61 remove_diacritics 2',
+    'porter': 'porter unicode61',
+    'porter (fold diacritics)': 'porter unicode61 remove_diacritics 2',
+    'trigram': 'trigram',
+}
+FTS_DEFAULT_TOKENIZER = 'unicode61'
+# fields kept in the revision history, and the longest delta chain per field
+REV_FIELDS = ['genre'] + FTS_FIELDS
+REV_SNAPSHOT_EVERY = 20
+_RE_DELTA_SPLIT = re.compile(r'(?<=[\n.!?])')
+# similarity index: fields compared, terms kept per note, and the fraction
+# of notes above which a term is too common to scan its postings
+SIM_FIELDS = ['thesis', 'hypothesis', 'method', 'finding']
+SIM_TOP_TERMS = 32
+SIM_MAX_DF = 0.2
+_RE_SIM_WORD = re.compile(r'[^\W\d_]{3,}')
+_SIM_STOPWORDS = frozenset('''
+    the and for are but not you all any can had her was one our out has him
+    his how its may new now old see two who did get let say she too use that
+    with have this will your from they been were which their there what when
+    than then them these those into also such more most some only over very
+    both each other about after before between under while where would could
+    should being does done here just well using used based show shows shown
+'''.split())
+# note columns synced between libraries, each merged on its own
+SYNC_FIELDS = ['author', 'genre', 'thesis', 'hypothesis', 'method', 'finding',
+               'comment', 'img_linkstr']
+# fields counted in the note length of the statistics
+STATS_LENGTH_FIELDS = ['thesis', 'hypothesis', 'method', 'finding', 'comment']
+# fields searched for the bibkeys of other notes, and the number of keys
+# added since the matcher was built that are searched for one by one
+LINK_FIELDS = ['thesis', 'hypothesis', 'method', 'finding', 'comment']
+LINK_MAX_EXTRA = 200
+# columns of an entry: the short ones shown at once, and the long texts
+# loaded after them
+ENTRY_HEADER_FIELDS = ['bibkey', 'author', 'genre', 'img_linkstr']
+ENTRY_TEXT_FIELDS = ['thesis', 'hypothesis', 'method', 'finding', 'comment']
+# storage modes of the long texts. In 'zlib' mode texts of PACK_MIN_BYTES
+# or more are kept as zlib blobs, read back through the note_plain view.
+# The view and triggers of a zlib library call liternote's sql functions,
+# so only liternote can write to it; a plain library is ordinary sqlite
+STORAGE_MODES = ['plain', 'zlib']
+PACK_FIELDS = FTS_FIELDS
+PACK_MIN_BYTES = 256
+PACK_CACHE_SIZE = 256
+# attachments are indexed in chunks, written ATTACH_BATCH chunks per
+# transaction. Searches merge the ranks of notes and attachment chunks by
+# reciprocal rank fusion with constant ATTACH_RRF_K
+ATTACH_BATCH = 100
+ATTACH_RRF_K = 60
+SNIPPET_TOKENS = 12
+SNIPPET_HITS = 50       # best hits of a search that get a snippet
+# upserts need 3.24, window functions 3.25
+SQLITE_MIN_VERSION = (3, 25, 0)
+
+
+def create_or_open_db(filename, check_same_thread=True):
+    """ Create (1st time) or open database
+    :argument:
+        filename: str           database file
+        check_same_thread: bool set False to hand the connection between
+                                threads (one thread at a time)
+    :returns:
+        conn: sqlite3 database connection
+        cursor: sqlite3 database cursor
+    """
+
+    _check_sqlite_version()
+    conn = sqlite3.connect(filename, check_same_thread=check_same_thread)
+    _register_functions(conn)
+    cursor = conn.cursor()
+
+    sql = """ CREATE TABLE IF NOT EXISTS note (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        bibkey TEXT UNIQUE NOT NULL,
+        author TEXT NOT NULL,
+        genre TEXT, 
+        thesis TEXT, 
+        hypothesis TEXT,
+        method TEXT,
+        finding TEXT, 
+        comment TEXT,
+        img_linkstr TEXT
+    );"""
+    cursor.execute(sql)
+    
+    sql = """ CREATE TABLE IF NOT EXISTS tags (
+        bibkey TEXT NOT NULL,
+        tag TEXT NOT NULL
+    );"""
+    cursor.execute(sql)
+
+    sql = """ CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );"""
+    cursor.execute(sql)
+
+    # note with its texts decoded, whatever the storage mode
+    packed = _storage_packed(cursor)
+    _create_note_plain(cursor, packed)
+
+    # create fts5 virtual table for full text search
+    tokenizer = db_get_setting(cursor, 'fts_tokenizer', FTS_DEFAULT_TOKENIZER)
+    prefix = db_get_setting(cursor, 'fts_prefix', '')
+    cursor.execute(_sql_create_fts('fts', tokenizer, prefix,
+                                   content='note_plain' if packed else 'note'))
+
+    # create triggers. Older versions re-indexed a note on any update,
+    # not only of the indexed columns
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'tbl_au'")
+    res = cursor.fetchall()
+    if res and 'UPDATE OF' not in res[0][0]:
+        cursor.execute('DROP TRIGGER tbl_au')
+    _drop_storage_triggers(cursor, ['tbl_ai', 'tbl_ad', 'tbl_au'], packed)
+    _create_fts_triggers(cursor, 'fts', 'tbl', packed=packed)
+
+    # saved searches and their materialized results
+    sql = """ CREATE TABLE IF NOT EXISTS saved_search (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        name TEXT UNIQUE NOT NULL,
+        query TEXT NOT NULL,
+        field TEXT NOT NULL,
+        genre TEXT NOT NULL,
+        tags TEXT NOT NULL
+    );"""
+    cursor.execute(sql)
+    sql = """ CREATE TABLE IF NOT EXISTS saved_result (
+        search_id INTEGER NOT NULL,
+        note_id INTEGER NOT NULL,
+        PRIMARY KEY (search_id, note_id)
+    ) WITHOUT ROWID;"""
+    cursor.execute(sql)
+    cursor.execute(""" CREATE INDEX IF NOT EXISTS saved_result_note
+    ON saved_result (note_id);""")
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS saved_ad
+    AFTER DELETE ON note BEGIN
+      DELETE FROM saved_result WHERE note_id = old.id;
+    END;""")
+
+    # revision history: per field text deltas with periodic full snapshots
+    sql = """ CREATE TABLE IF NOT EXISTS note_rev (
+        note_id INTEGER NOT NULL,
+        field TEXT NOT NULL,
+        rev INTEGER NOT NULL,
+        full INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (note_id, field, rev)
+    ) WITHOUT ROWID;"""
+    cursor.execute(sql)
+    sql = """ CREATE TABLE IF NOT EXISTS note_rev_info (
+        note_id INTEGER NOT NULL,
+        rev INTEGER NOT NULL,
+        time REAL NOT NULL,
+        PRIMARY KEY (note_id, rev)
+    ) WITHOUT ROWID;"""
+    cursor.execute(sql)
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS rev_ad
+    AFTER DELETE ON note BEGIN
+      DELETE FROM note_rev WHERE note_id = old.id;
+      DELETE FROM note_rev_info WHERE note_id = old.id;
+    END;""")
+    # tf-idf similarity index: the terms of each note and their document
+    # frequencies, the top weighted terms of each note as packed arrays, and
+    # the inverted postings of those top terms
+    sql = """ CREATE TABLE IF NOT EXISTS sim_term (
+        id INTEGER PRIMARY KEY,
+        term TEXT UNIQUE NOT NULL,
+        df INTEGER NOT NULL DEFAULT 0
+    );"""
+    cursor.execute(sql)
+    sql = """ CREATE TABLE IF NOT EXISTS sim_doc (
+        note_id INTEGER PRIMARY KEY,
+        terms TEXT NOT NULL,
+        vec_terms BLOB NOT NULL,
+        vec_weights BLOB NOT NULL
+    );"""
+    cursor.execute(sql)
+    sql = """ CREATE TABLE IF NOT EXISTS sim_post (
+        term_id INTEGER NOT NULL,
+        note_id INTEGER NOT NULL,
+        weight REAL NOT NULL,
+        PRIMARY KEY (term_id, note_id)
+    ) WITHOUT ROWID;"""
+    cursor.execute(sql)
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS sim_ad
+    AFTER DELETE ON note BEGIN
+      DELETE FROM sim_post WHERE note_id = old.id AND term_id IN (
+        SELECT value FROM json_each((SELECT terms FROM sim_doc WHERE note_id = old.id)));
+      UPDATE sim_term SET df = df - 1 WHERE id IN (
+        SELECT value FROM json_each((SELECT terms FROM sim_doc WHERE note_id = old.id)));
+      UPDATE settings SET value = CAST(value AS INTEGER) - 1 WHERE key = 'sim_n_docs'
+        AND EXISTS (SELECT 1 FROM sim_doc WHERE note_id = old.id);
+      DELETE FROM sim_doc WHERE note_id = old.id;
+    END;""")
+
+    # pixel digests of stored images, to skip pasting duplicates
+    sql = """ CREATE TABLE IF NOT EXISTS img_digest (
+        digest TEXT PRIMARY KEY,
+        link TEXT NOT NULL
+    ) WITHOUT ROWID;"""
+    cursor.execute(sql)
+
+    # links between notes: 'mention' links are found in the note text,
+    # other kinds are added by hand
+    sql = """ CREATE TABLE IF NOT EXISTS note_link (
+        src_id INTEGER NOT NULL,
+        dst_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        PRIMARY KEY (src_id, dst_id, kind)
+    ) WITHOUT ROWID;"""
+    cursor.execute(sql)
+    cursor.execute(""" CREATE INDEX IF NOT EXISTS note_link_dst
+    ON note_link (dst_id, src_id);""")
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS link_ad
+    AFTER DELETE ON note BEGIN
+      DELETE FROM note_link WHERE src_id = old.id OR dst_id = old.id;
+    END;""")
+    if db_get_setting(cursor, 'links_built') is None:
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM note)')
+        if not cursor.fetchone()[0]:
+            # nothing to find in a new library
+            cursor.execute("INSERT INTO settings (key, value) VALUES ('links_built', '1')")
+
+    # visits of each note, to rank the quick switcher
+    sql = """ CREATE TABLE IF NOT EXISTS note_visit (
+        note_id INTEGER PRIMARY KEY,
+        n INTEGER NOT NULL,
+        last REAL NOT NULL
+    );"""
+    cursor.execute(sql)
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS visit_ad
+    AFTER DELETE ON note BEGIN
+      DELETE FROM note_visit WHERE note_id = old.id;
+    END;""")
+
+    # attachments: texts of the sources of a note, indexed in chunks by a
+    # second fts table. n_chunks is NULL while an attachment is ingested
+    sql = """ CREATE TABLE IF NOT EXISTS attachment (
+        id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+        note_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        n_chunks INTEGER,
+        added REAL NOT NULL,
+        UNIQUE (note_id, name)
+    );"""
+    cursor.execute(sql)
+    sql = """ CREATE TABLE IF NOT EXISTS attachment_chunk (
+        id INTEGER PRIMARY KEY,
+        attachment_id INTEGER NOT NULL,
+        note_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        body TEXT NOT NULL
+    );"""
+    cursor.execute(sql)
+    cursor.execute(""" CREATE INDEX IF NOT EXISTS attachment_chunk_att
+    ON attachment_chunk (attachment_id, seq);""")
+    cursor.execute(_sql_create_fts('fts_att', tokenizer, prefix, ['body'],
+                                   'attachment_chunk'))
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS att_chunk_ai
+    AFTER INSERT ON attachment_chunk BEGIN
+      INSERT INTO fts_att(rowid, body) VALUES (new.id, new.body);
+    END;""")
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS att_chunk_ad
+    AFTER DELETE ON attachment_chunk BEGIN
+      INSERT INTO fts_att(fts_att, rowid, body) VALUES ('delete', old.id, old.body);
+    END;""")
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS att_ad
+    AFTER DELETE ON attachment BEGIN
+      DELETE FROM attachment_chunk WHERE attachment_id = old.id;
+    END;""")
+    cursor.execute(""" CREATE TRIGGER IF NOT EXISTS note_att_ad
+    AFTER DELETE ON note BEGIN
+      DELETE FROM attachment WHERE note_id = old.id;
+    END;""")
+
+    # aggregate statistics, kept up to date by triggers
+    _drop_storage_triggers(cursor, ['stat_note_ai', 'stat_note_ad', 'stat_note_au'],
+                           packed)
+    _create_stats(cursor, packed)
+    if db_get_setting(cursor, 'stats_built') is None:
+        db_rebuild_stats(conn, cursor)
+
+    # change log to sync with other copies of the library
+    _drop_outdated_triggers(cursor, ['sync_note_au'], 'storage_packing')
+    _create_sync(cursor)
+
+    conn.commit()
+    if packed != (db_get_setting(cursor, 'storage', 'plain') == 'zlib'):
+        # an interrupted conversion, or a plain library whose triggers a
+        # previous version made read through lt_unz
+        db_set_storage(conn, cursor, db_get_setting(cursor, 'storage', 'plain'))
+
+    return conn, cursor
+
+
+def open_db_readonly(filename):
+    """ Open a read-only connection to an existing database, which may be
+    shared between threads (one thread at a time).
+    :argument:
+        filename: str           database file
+    :returns:
+        conn: sqlite3 database connection
+    """
+    from urllib.request import pathname2url     # slow import, only needed here
+    _check_sqlite_version()
+    uri = 'file:{:s}?mode=ro'.format(pathname2url(realpath(filename)))
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    _register_functions(conn)
+    return conn
+
+
+def _check_sqlite_version():
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise sqlite3.NotSupportedError(
+                'liternote needs SQLite {:s} or newer, this Python has {:s}'.format(
+                        '.'.join(map(str, SQLITE_MIN_VERSION)), sqlite3.sqlite_version))
+
+
+@lru_cache(maxsize=PACK_CACHE_SIZE)
+def _unpack_blob(data):
+    return zlib.decompress(data).decode('utf-8')
+
+
+def _unpack_text(value):
+    """ sql function lt_unz: the text of a note column as stored """
+    if isinstance(value, bytes):
+        return _unpack_blob(value)
+    return value
+
+
+def _pack_text(value):
+    """ sql function lt_z: the value of a note column in zlib mode. Short
+    texts, and texts that do not compress, are kept as they are. """
+    if not isinstance(value, str):
+        return value
+    data = value.encode('utf-8')
+    if len(data) < PACK_MIN_BYTES:
+        return value
+    packed = zlib.compress(data)
+    return packed if len(packed) < len(data) else value
+
+
+def _register_functions(conn):
+    conn.create_function('lt_unz', 1, _unpack_text, deterministic=True)
+    conn.create_function('lt_z', 1, _pack_text, deterministic=True)
+
+
+def _stored_values(c, entry_dict, fields):
+    """ Return the values of fields of entry_dict as written to note """
+    if db_get_setting(c, 'storage', 'plain') == 'zlib':
+        return tuple(_pack_text(entry_dict[f]) if f in PACK_FIELDS else entry_dict[f]
+                     for f in fields)
+    return tuple(entry_dict[f] for f in fields)
+
+
+def _storage_packed(c):
+    """ Whether the note_plain view, and the triggers on note, are made for
+    packed texts: they decode the columns through lt_unz """
+    c.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'note_plain'")
+    res = c.fetchall()
+    return bool(res) and 'lt_unz' in res[0][0]
+
+
+def _create_note_plain(c, packed):
+    c.execute(""" CREATE VIEW IF NOT EXISTS note_plain AS
+    SELECT id, bibkey, {:s}, img_linkstr FROM note""".format(', '.join(
+            'lt_unz({0:s}) AS {0:s}'.format(f) if packed and f in PACK_FIELDS else f
+            for f in ['author', 'genre'] + ENTRY_TEXT_FIELDS)))
+
+
+def _drop_storage_triggers(c, names, packed):
+    """ Drop the triggers names that do not match the storage mode, so that
+    they are created again """
+    c.execute(""" SELECT name, sql FROM sqlite_master WHERE type = 'trigger'
+    AND name IN (SELECT value FROM json_each(?))""", (json.dumps(names),))
+    for name, sql in c.fetchall():
+        if ('lt_unz' in sql) != packed:
+            c.execute('DROP TRIGGER {:s}'.format(name))
+
+
+def _install_storage(conn, c, packed):
+    """ Replace the note_plain view and the statistics triggers, and
+    rebuild the fts index with its triggers, for the storage mode """
+    _begin_write(conn, c)
+    c.execute('DROP VIEW IF EXISTS note_plain')
+    _create_note_plain(c, packed)
+    _drop_storage_triggers(c, ['stat_note_ai', 'stat_note_ad', 'stat_note_au'], packed)
+    _create_stats(c, packed)
+    conn.commit()
+    db_rebuild_fts(conn, c, db_get_setting(c, 'fts_tokenizer', FTS_DEFAULT_TOKENIZER),
+                   db_get_setting(c, 'fts_prefix', ''))
+
+
+def _drop_outdated_triggers(c, names, marker):
+    """ Drop the triggers names created by an older version, recognized
+    by marker missing from their sql, so that they are created again """
+    c.execute(""" SELECT name, sql FROM sqlite_master WHERE type = 'trigger'
+    AND name IN (SELECT value FROM json_each(?))""", (json.dumps(names),))
+    for name, sql in c.fetchall():
+        if marker not in sql:
+            c.execute('DROP TRIGGER {:s}'.format(name))
+
+
+def _sql_create_fts(table, tokenizer, prefix, columns=FTS_FIELDS, content='note'):
+    """ Return the sql to create the fts5 table with tokenizer & prefix indexes
+    :argument
+        table: str              name of the fts table
+        tokenizer: str          key of FTS_TOKENIZERS
+        prefix: str             space separated prefix lengths, e.g. '2 3'
+        columns: list of str    indexed columns of content
+        content: str            table or view indexed, by its id
+    """
+    options = ['content="{:s}"'.format(content), 'content_rowid="id"',
+               "tokenize='{:s}'".format(FTS_TOKENIZERS[tokenizer])]
+    if prefix:
+        options.append("prefix='{:s}'".format(prefix))
+    return """ CREATE VIRTUAL TABLE IF NOT EXISTS {:s} USING fts5(
+        {:s},
+        {:s}
+    );""".format(table, ', '.join(columns), ', '.join(options))
+
+
+def _create_fts_triggers(c, table, name, cond='', packed=False):
+    """ Create the triggers that keep fts table in sync with note
+    :argument
+        c: sqlite3 cursor
+        table: str              name of the fts table
+        name: str               prefix of the trigger names
+        cond: str               extra WHEN condition of the triggers, written
+                                with {row} in place of new / old
+        packed: bool            decode the texts, for the zlib storage mode
+    """
+    cols = ', '.join(FTS_FIELDS)
+    value = 'lt_unz({:s}.{:s})' if packed else '{:s}.{:s}'
+    new_vals = ', '.join(value.format('new', f) for f in FTS_FIELDS)
+    old_vals = ', '.join(value.format('old', f) for f in FTS_FIELDS)
+    when_new = 'WHEN ' + cond.format(row='new') if cond else ''
+    when_old = 'WHEN ' + cond.format(row='old') if cond else ''
+    # packing the texts does not change them
+    when_update = (when_old + ' AND ' if when_old else 'WHEN ') + _NOT_PACKING
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS {name}_ai
+    AFTER INSERT ON note {when_new} BEGIN
+      INSERT INTO {t}(rowid, {cols}) VALUES (new.id, {new_vals});
+    END;""".format(name=name, t=table, cols=cols, new_vals=new_vals,
+                   when_new=when_new))
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS {name}_ad
+    AFTER DELETE ON note {when_old} BEGIN
+      INSERT INTO {t}({t}, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+    END;""".format(name=name, t=table, cols=cols, old_vals=old_vals,
+                   when_old=when_old))
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS {name}_au
+    AFTER UPDATE OF {cols} ON note {when_update} BEGIN
+      INSERT INTO {t}({t}, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+      INSERT INTO {t}(rowid, {cols}) VALUES (new.id, {new_vals});
+    END;""".format(name=name, t=table, cols=cols, old_vals=old_vals,
+                   new_vals=new_vals, when_update=when_update))
+
+
+_NOT_PACKING = "(SELECT value FROM settings WHERE key = 'storage_packing') IS NULL"
+
+
+def _drop_fts_triggers(c, name):
+    for suffix in ('ai', 'ad', 'au'):
+        c.execute('DROP TRIGGER IF EXISTS {:s}_{:s}'.format(name, suffix))
+
+
+def db_get_setting(c, key, default=None):
+    """ Return the library setting of key. Return default if not set """
+    c.execute('SELECT value FROM settings WHERE key = (?)', (key,))
+    res = c.fetchall()
+    if res:
+        return res[0][0]
+    else:
+        return default
+
+
+def db_set_setting(conn, c, key, value):
+    """ Write a library setting """
+    c.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+              (key, value))
+    conn.commit()
+
+
+def db_rebuild_fts(conn, c, tokenizer, prefix='', progress=None, chunk=500):
+    """ Rebuild the fts index with a new tokenizer and prefix indexes.
+    The new index is filled in chunks next to the old one, which keeps
+    serving searches until it is swapped in. Rows behind the fill mark are
+    kept up to date by temporary triggers, so edits made in the meantime
+    are not lost. The attachment index is rebuilt in one go at the swap.
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        tokenizer: str          key of FTS_TOKENIZERS
+        prefix: str             space separated prefix lengths, e.g. '2 3'
+        progress: callable      progress(n_done, n_total) called every chunk
+        chunk: int              number of notes indexed per transaction
+    """
+    if tokenizer not in FTS_TOKENIZERS:
+        raise ValueError('Unknown tokenizer: {:s}'.format(tokenizer))
+    prefix = ' '.join(str(int(n)) for n in prefix.split())
+    conn.commit()
+
+    # clean up an interrupted rebuild
+    _drop_fts_triggers(c, 'tbl_new')
+    c.execute('DROP TABLE IF EXISTS fts_new')
+    # a zlib library is indexed through the view that decodes its texts
+    packed = _storage_packed(c)
+    c.execute(_sql_create_fts('fts_new', tokenizer, prefix,
+                              content='note_plain' if packed else 'note'))
+    db_set_setting(conn, c, 'fts_rebuild_mark', 0)
+    mark_cond = """{row}.id <= (SELECT CAST(value AS INTEGER) FROM settings
+        WHERE key = 'fts_rebuild_mark')"""
+    _create_fts_triggers(c, 'fts_new', 'tbl_new', cond=mark_cond, packed=packed)
+    conn.commit()
+
+    c.execute('SELECT COUNT(*) FROM note')
+    n_total = c.fetchone()[0]
+    n_done = 0
+    mark = 0
+    sql_fill = """ INSERT INTO fts_new(rowid, {0:s})
+        SELECT id, {0:s} FROM note_plain WHERE id > (?) AND id <= (?)
+        """.format(', '.join(FTS_FIELDS))
+    while True:
+        c.execute('SELECT id FROM note WHERE id > (?) ORDER BY id LIMIT (?)',
+                  (mark, chunk))
+        ids = c.fetchall()
+        if not ids:
+            break
+        c.execute(sql_fill, (mark, ids[-1][0]))
+        mark = ids[-1][0]
+        c.execute("UPDATE settings SET value = (?) WHERE key = 'fts_rebuild_mark'",
+                  (mark,))
+        conn.commit()
+        n_done += len(ids)
+        if progress:
+            progress(min(n_done, n_total), n_total)
+
+    # swap in the new index
+    c.execute('BEGIN')
+    _drop_fts_triggers(c, 'tbl')
+    _drop_fts_triggers(c, 'tbl_new')
+    c.execute('DROP TABLE fts')
+    c.execute('ALTER TABLE fts_new RENAME TO fts')
+    _create_fts_triggers(c, 'fts', 'tbl', packed=packed)
+    # the triggers of the attachment index refer to it by name, and fire
+    # on the new table
+    c.execute('DROP TABLE fts_att')
+    c.execute(_sql_create_fts('fts_att', tokenizer, prefix, ['body'],
+                              'attachment_chunk'))
+    c.execute("INSERT INTO fts_att(fts_att) VALUES ('rebuild')")
+    c.execute("DELETE FROM settings WHERE key = 'fts_rebuild_mark'")
+    c.executemany('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                  (('fts_tokenizer', tokenizer), ('fts_prefix', prefix)))
+    conn.commit()
+    # the tokenizer changes what saved searches match
+    db_rematerialize_saved_searches(conn, c)
+
+
+def db_set_storage(conn, c, mode, progress=None, chunk=200, vacuum=False):
+    """ Switch the storage mode of the long texts, and convert the notes
+    in chunks, one transaction each, so that the library stays usable. New
+    writes use the new mode at once. The texts do not change: the fts index,
+    statistics and change log are left alone while notes are converted.
+    An interrupted conversion is finished by calling again, or by opening
+    the library.
+    The note_plain view, the fts index and the triggers on note decode the
+    texts with lt_unz in zlib mode only: they are replaced before the notes
+    are packed, and after they are unpacked. A zlib library can then only
+    be written to by liternote.
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        mode: str               one of STORAGE_MODES
+        progress: callable      progress(n_done, n_total) called every chunk
+        chunk: int              number of notes converted per transaction
+        vacuum: bool            give the freed pages back to the file system,
+                                which locks the library while it runs
+    :returns
+        n: int                  number of notes converted
+    """
+    if mode not in STORAGE_MODES:
+        raise ValueError('Unknown storage mode: {:s}'.format(mode))
+    packed = mode == 'zlib'
+    if packed and not _storage_packed(c):
+        # an index over the note table would read the packed texts
+        _install_storage(conn, c, True)
+    db_set_setting(conn, c, 'storage', mode)
+    func = 'lt_z' if mode == 'zlib' else 'lt_unz'
+    sql = 'UPDATE note SET {:s} WHERE id > (?) AND id <= (?)'.format(
+            ', '.join('{0:s} = {1:s}({0:s})'.format(f, func) for f in PACK_FIELDS))
+    c.execute('SELECT COUNT(*) FROM note')
+    n_total = c.fetchone()[0]
+    n_done = 0
+    mark = 0
+    while True:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('SELECT id FROM note WHERE id > (?) ORDER BY id LIMIT (?)',
+                  (mark, chunk))
+        ids = c.fetchall()
+        if not ids:
+            conn.commit()
+            break
+        c.execute("INSERT INTO settings (key, value) VALUES ('storage_packing', '1')")
+        c.execute(sql, (mark, ids[-1][0]))
+        c.execute("DELETE FROM settings WHERE key = 'storage_packing'")
+        conn.commit()
+        mark = ids[-1][0]
+        n_done += len(ids)
+        if progress:
+            progress(min(n_done, n_total), n_total)
+    if not packed and _storage_packed(c):
+        # no packed text is left
+        _install_storage(conn, c, False)
+    if vacuum:
+        c.execute('VACUUM')
+    return n_done
+
+
+def db_storage_info(c):
+    """ Return the storage mode, and the number of texts stored packed """
+    c.execute('SELECT {:s} FROM note'.format(' + '.join(
+            "SUM(typeof({:s}) = 'blob')".format(f) for f in PACK_FIELDS)))
+    packed = c.fetchone()[0] or 0
+    return {'mode': db_get_setting(c, 'storage', 'plain'), 'packed': packed}
+
+
+def _begin_write(conn, c):
+    """ Take the write lock now, unless a transaction is already open, so
+    that what is read next (e.g. the last revision number) cannot change
+    under another writer before it is written back """
+    if not conn.in_transaction:
+        c.execute('BEGIN IMMEDIATE')
+
+
+def db_insert_entry(conn, c, entry_dict, tags=None):
+    """ Insert new entry into database """
+
+    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
+              'method', 'finding', 'comment', 'img_linkstr']
+    sql = """ INSERT INTO note ({:s}) VALUES (?,?,?,?,?,?,?,?,?) 
+            """.format(','.join(fields))
+    try:
+        _begin_write(conn, c)
+        c.execute(sql, _stored_values(c, entry_dict, fields))
+        id_ = c.lastrowid
+        _record_revision(c, id_, entry_dict, is_new=True)
+
+        if tags:
+            sql = """ INSERT INTO tags (bibkey, tag) VALUES (?, ?) """
+            c.executemany(sql, ((entry_dict['bibkey'], tag) for tag in tags))
+        _index_similar(c, id_)
+        _index_links(c, id_, is_new=True)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    db_refresh_saved_searches(conn, c, id_)
+
+
+def db_update_entry(conn, c, id_, entry_dict, tags=None):
+    """ Update entry in database """
+
+    fields = ['author', 'genre', 'thesis', 'hypothesis',
+              'method', 'finding', 'comment', 'img_linkstr']
+    sql = """ UPDATE note SET {:s} WHERE id = (?) 
+            """.format(','.join('{:s} = (?)'.format(field) for field in fields))
+    try:
+        _begin_write(conn, c)
+        _record_revision(c, id_, entry_dict)
+        c.execute(sql, _stored_values(c, entry_dict, fields) + (id_,))
+
+        # remove old tags
+        c.execute("DELETE FROM tags WHERE bibkey = (?)", (entry_dict['bibkey'],))
+        if tags:
+            # write in new tags
+            sql = """ INSERT INTO tags (bibkey, tag) VALUES (?, ?) """
+            c.executemany(sql, ((entry_dict['bibkey'], tag) for tag in tags))
+        _index_similar(c, id_)
+        _index_links(c, id_)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    db_refresh_saved_searches(conn, c, id_)
+
+
+def _delta_tokens(text):
+    """ Split text into lines and sentences, the units of text deltas """
+    return list(t for t in _RE_DELTA_SPLIT.split(text) if t)
+
+
+def _encode_delta(old, new):
+    """ Encode new as a delta against old: a list of [i1, i2] to copy old
+    tokens i1:i2, and strings to insert """
+    a = _delta_tokens(old)
+    b = _delta_tokens(new)
+    ops = []
+    matcher = SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return zlib.compress(json.dumps(ops, ensure_ascii=False).encode('utf-8'))
+
+
+def _apply_delta(old, data):
+    a = _delta_tokens(old)
+    return ''.join(''.join(a[op[0]:op[1]]) if isinstance(op, list) else op
+                   for op in json.loads(zlib.decompress(data).decode('utf-8')))
+
+
+def _encode_full(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def _record_revision(c, id_, entry_dict, is_new=False):
+    """ Record the fields of entry_dict that differ from the note row as a
+    new revision. Must be called before the row is updated. """
+    c.execute('SELECT MAX(rev) FROM note_rev_info WHERE note_id = (?)', (id_,))
+    last = c.fetchone()[0] or 0
+    now = time.time()
+    if is_new:
+        old = None
+    else:
+        c.execute('SELECT {:s} FROM note_plain WHERE id = (?)'.format(','.join(REV_FIELDS)),
+                  (id_,))
+        old = dict(zip(REV_FIELDS, c.fetchone()))
+        if not last:
+            # note written before history existed: keep its content as rev 1
+            c.executemany('INSERT INTO note_rev VALUES (?, ?, 1, 1, ?)',
+                          ((id_, f, _encode_full(old[f] or '')) for f in REV_FIELDS))
+            c.execute('INSERT INTO note_rev_info VALUES (?, 1, ?)', (id_, now))
+            last = 1
+    changed = list(f for f in REV_FIELDS
+                   if old is None or (entry_dict[f] or '') != (old[f] or ''))
+    if not changed:
+        return
+    rev = last + 1
+    for field in changed:
+        new_text = entry_dict[field] or ''
+        full = _encode_full(new_text)
+        data, is_full = full, 1
+        if old is not None:
+            c.execute(""" SELECT full FROM note_rev WHERE note_id = (?)
+            AND field = (?) ORDER BY rev DESC LIMIT (?)""",
+                      (id_, field, REV_SNAPSHOT_EVERY - 1))
+            chain = list(r[0] for r in c.fetchall())
+            if any(chain) or len(chain) < REV_SNAPSHOT_EVERY - 1:
+                delta = _encode_delta(old[field] or '', new_text)
+                if len(delta) < len(full):
+                    data, is_full = delta, 0
+        c.execute('INSERT INTO note_rev VALUES (?, ?, ?, ?, ?)',
+                  (id_, field, rev, is_full, data))
+    c.execute('INSERT INTO note_rev_info VALUES (?, ?, ?)', (id_, rev, now))
+
+
+def _reconstruct_field(c, id_, field, rev):
+    """ Return the text of field at revision rev """
+    c.execute(""" SELECT full, data FROM note_rev WHERE note_id = (?)
+    AND field = (?) AND rev <= (?) ORDER BY rev DESC LIMIT (?)""",
+              (id_, field, rev, REV_SNAPSHOT_EVERY))
+    chain = []
+    for full, data in c.fetchall():
+        chain.append((full, data))
+        if full:
+            break
+    if not chain or not chain[-1][0]:
+        return ''
+    text = zlib.decompress(chain[-1][1]).decode('utf-8')
+    for full, data in reversed(chain[:-1]):
+        text = _apply_delta(text, data)
+    return text
+
+
+def db_list_revisions(c, bibkey):
+    """ List the revisions of a note
+    :returns
+        revisions: list of (rev, time, changed fields), newest first
+    """
+    c.execute(""" SELECT info.rev, info.time, group_concat(note_rev.field)
+    FROM note_rev_info AS info JOIN note ON note.id = info.note_id
+    LEFT JOIN note_rev ON note_rev.note_id = info.note_id
+        AND note_rev.rev = info.rev
+    WHERE note.bibkey = (?) GROUP BY info.rev ORDER BY info.rev DESC""", (bibkey,))
+    return list((rev, t, fields.split(',') if fields else [])
+                for rev, t, fields in c.fetchall())
+
+
+def db_select_revision(c, bibkey, rev):
+    """ Return the text fields of a note at revision rev, or None if that
+    revision does not exist (or was pruned) """
+    c.execute(""" SELECT note.id FROM note JOIN note_rev_info AS info
+    ON info.note_id = note.id WHERE note.bibkey = (?) AND info.rev = (?)""",
+              (bibkey, rev))
+    res = c.fetchall()
+    if not res:
+        return None
+    return dict((f, _reconstruct_field(c, res[0][0], f, rev)) for f in REV_FIELDS)
+
+
+def db_prune_revisions(conn, c, keep=100, bibkey=None):
+    """ Drop all but the newest keep revisions of each note (or one note).
+    The oldest kept revision of every field is turned into a full snapshot
+    so that the remaining revisions can still be reconstructed.
+    :returns
+        n: int                  number of revisions dropped
+    """
+    if bibkey is None:
+        c.execute(""" SELECT note_id FROM note_rev_info GROUP BY note_id
+        HAVING COUNT(*) > (?)""", (keep,))
+        ids = list(r[0] for r in c.fetchall())
+    else:
+        ids = [db_bibkey_id(c, bibkey)]
+    n = 0
+    for id_ in ids:
+        c.execute(""" SELECT rev FROM note_rev_info WHERE note_id = (?)
+        ORDER BY rev DESC LIMIT 1 OFFSET (?)""", (id_, max(keep, 1) - 1))
+        res = c.fetchall()
+        if not res:
+            continue
+        cut = res[0][0]
+        for field in REV_FIELDS:
+            c.execute(""" SELECT rev, full FROM note_rev WHERE note_id = (?)
+            AND field = (?) AND rev <= (?) ORDER BY rev DESC LIMIT 1""",
+                      (id_, field, cut))
+            row = c.fetchone()
+            if not row:
+                continue
+            if not row[1]:
+                text = _reconstruct_field(c, id_, field, row[0])
+                c.execute(""" UPDATE note_rev SET full = 1, data = (?)
+                WHERE note_id = (?) AND field = (?) AND rev = (?)""",
+                          (_encode_full(text), id_, field, row[0]))
+            c.execute(""" DELETE FROM note_rev WHERE note_id = (?)
+            AND field = (?) AND rev < (?)""", (id_, field, row[0]))
+        c.execute('DELETE FROM note_rev_info WHERE note_id = (?) AND rev < (?)',
+                  (id_, cut))
+        n += c.rowcount
+    conn.commit()
+    return n
+
+
+def db_checkpoint_entry(conn, c, entry_dict, tags):
+    """ Fold autosaved content into an existing note. Only the columns that
+    actually changed are written, and nothing is written if none did.
+    Images are left to the regular save.
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        entry_dict: dict        entry as returned by MainWidget.getEntry
+        tags: list of str
+    :returns
+        exists: bool            False if the bibkey is not in the database yet
+    """
+    fields = ['genre'] + FTS_FIELDS
+    try:
+        _begin_write(conn, c)
+        c.execute('SELECT id, {:s} FROM note_plain WHERE bibkey = (?)'.format(','.join(fields)),
+                  (entry_dict['bibkey'],))
+        res = c.fetchall()
+        if not res:
+            conn.commit()
+            return False
+        id_ = res[0][0]
+        changed = list(f for f, v in zip(fields, res[0][1:]) if entry_dict[f] != v)
+        c.execute("SELECT tag FROM tags WHERE bibkey = (?)", (entry_dict['bibkey'],))
+        tags_changed = sorted(r[0] for r in c.fetchall()) != sorted(tags)
+        if not (changed or tags_changed):
+            conn.commit()
+            return True
+        if changed:
+            _record_revision(c, id_, entry_dict)
+            sql = 'UPDATE note SET {:s} WHERE id = (?)'.format(
+                    ','.join('{:s} = (?)'.format(f) for f in changed))
+            c.execute(sql, _stored_values(c, entry_dict, changed) + (id_,))
+            if set(changed) & set(SIM_FIELDS):
+                _index_similar(c, id_)
+            if set(changed) & set(LINK_FIELDS):
+                _index_links(c, id_)
+        if tags_changed:
+            c.execute("DELETE FROM tags WHERE bibkey = (?)", (entry_dict['bibkey'],))
+            c.executemany("INSERT INTO tags (bibkey, tag) VALUES (?, ?)",
+                          ((entry_dict['bibkey'], tag) for tag in tags))
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    db_refresh_saved_searches(conn, c, id_)
+    return True
+
+
+class RecoveryJournal:
+    """ Append-only journal of autosaved entries, one JSON record per line.
+    It is replayed after a crash and cleared once its content is safely in
+    the database. """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = threading.Lock()
+
+    def append(self, entry_dict, tags):
+        record = {'time': time.time(), 'entry': entry_dict, 'tags': list(tags)}
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self._filename, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def records(self):
+        """ Return the journaled records, skipping a torn last line """
+        a_list = []
+        with self._lock:
+            if not isfile(self._filename):
+                return a_list
+            with open(self._filename, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        a_list.append(json.loads(line))
+                    except ValueError:
+                        pass
+        return a_list
+
+    def clear(self):
+        with self._lock:
+            if isfile(self._filename):
+                os.remove(self._filename)
+
+
+class CheckpointWriter:
+    """ Background thread that folds autosaved entries into the database.
+    Entries submitted while a write is in progress are coalesced so that
+    only the latest content of each bibkey is written. """
+
+    def __init__(self, filename, journal=None):
+        self._filename = filename
+        self._journal = journal
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, entry_dict, tags):
+        self._queue.put((dict(entry_dict), list(tags)))
+
+    def flush(self):
+        """ Block until the entries submitted so far are written. Called
+        before a synchronous write, which must not be overwritten by an
+        older autosave. """
+        if not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """ Write the pending entries and stop the thread """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn, c = create_or_open_db(self._filename)
+        conn.execute('PRAGMA journal_mode=WAL')
+        stop = False
+        while not stop:
+            pending = {}
+            flushed = []
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    pending[item[0]['bibkey']] = item
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            all_written = True
+            for bibkey, (entry_dict, tags) in pending.items():
+                try:
+                    if not (bibkey and db_checkpoint_entry(conn, c, entry_dict, tags)):
+                        all_written = False     # not in database yet
+                except sqlite3.Error as err:
+                    conn.rollback()
+                    all_written = False
+                    sys.stderr.write('Autosave failed: {:s}\n'.format(str(err)))
+            if pending and all_written and self._queue.empty() and self._journal:
+                self._journal.clear()
+            for done in flushed:
+                done.set()
+        conn.close()
+
+
+def _saved_search_plan(query, field, genre, tags):
+    return compile_query(query, field, genre, tuple(json.loads(tags)))
+
+
+def db_save_search(conn, c, name, query, field='ALL', genre='ALL', tags=None):
+    """ Save a search under name and materialize its result set.
+    An existing saved search with the same name is replaced.
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        name: str               name of the saved search
+        query, field, genre, tags: search parameters, see db_search_fulltext
+    """
+    tags_str = json.dumps(sorted(tags) if tags else [])
+    plan = _saved_search_plan(query, field, genre, tags_str)
+    c.execute('SELECT id FROM saved_search WHERE name = (?)', (name,))
+    res = c.fetchall()
+    if res:
+        c.execute('DELETE FROM saved_result WHERE search_id = (?)', (res[0][0],))
+        c.execute("""UPDATE saved_search SET query = (?), field = (?),
+        genre = (?), tags = (?) WHERE id = (?)""",
+                  (query, field, genre, tags_str, res[0][0]))
+        id_ = res[0][0]
+    else:
+        c.execute("""INSERT INTO saved_search (name, query, field, genre, tags)
+        VALUES (?,?,?,?,?)""", (name, query, field, genre, tags_str))
+        id_ = c.lastrowid
+    c.execute("""INSERT INTO saved_result (search_id, note_id)
+    SELECT ?, note.id FROM note WHERE {:s}""".format(plan.where),
+              (id_,) + plan.params)
+    conn.commit()
+
+
+def db_delete_saved_search(conn, c, name):
+    """ Delete the saved search name and its results """
+    c.execute("""DELETE FROM saved_result WHERE search_id IN
+    (SELECT id FROM saved_search WHERE name = (?))""", (name,))
+    c.execute('DELETE FROM saved_search WHERE name = (?)', (name,))
+    conn.commit()
+
+
+def db_list_saved_searches(c):
+    """ Return the names of all saved searches """
+    c.execute('SELECT name FROM saved_search ORDER BY name ASC')
+    return list(r[0] for r in c.fetchall())
+
+
+def db_open_saved_search(c, name):
+    """ Return the bibkeys in the stored result set of saved search name """
+    c.execute(""" SELECT note.bibkey FROM saved_search
+    JOIN saved_result ON saved_result.search_id = saved_search.id
+    JOIN note ON note.id = saved_result.note_id
+    WHERE saved_search.name = (?) ORDER BY note.bibkey ASC""", (name,))
+    return list(r[0] for r in c.fetchall())
+
+
+def db_refresh_saved_searches(conn, c, note_id):
+    """ Re-check one note against every saved search and update the
+    stored result sets. Called after the note is inserted or updated. """
+    _refresh_saved_results(c, [note_id])
+    conn.commit()
+
+
+def _refresh_saved_results(c, note_ids):
+    """ Re-check the notes note_ids against every saved search, in the
+    current transaction """
+    c.execute('SELECT id, query, field, genre, tags FROM saved_search')
+    for id_, query, field, genre, tags in c.fetchall():
+        plan = _saved_search_plan(query, field, genre, tags)
+        # the fts lookups are by rowid, never a scan of all matches
+        if plan.fts_expr:
+            match = 'EXISTS (SELECT 1 FROM fts WHERE fts MATCH ? AND rowid = ?)'
+            match_params = (plan.fts_expr,)
+        elif plan.neg_expr:
+            match = 'NOT EXISTS (SELECT 1 FROM fts WHERE fts MATCH ? AND rowid = ?)'
+            match_params = (plan.neg_expr,)
+        else:
+            match = '1'
+            match_params = None
+        sql = 'SELECT 1 FROM note WHERE note.id = (?) AND {:s} AND {:s}'.format(
+                match, plan.filter_where)
+        for note_id in note_ids:
+            c.execute(sql, (note_id,) + (match_params + (note_id,) if match_params else ())
+                      + plan.filter_params)
+            if c.fetchall():
+                c.execute("""INSERT OR IGNORE INTO saved_result (search_id, note_id)
+                VALUES (?, ?)""", (id_, note_id))
+            else:
+                c.execute("""DELETE FROM saved_result WHERE search_id = (?)
+                AND note_id = (?)""", (id_, note_id))
+
+
+def db_rematerialize_saved_searches(conn, c):
+    """ Recompute the result sets of all saved searches from scratch """
+    c.execute('SELECT name, query, field, genre, tags FROM saved_search')
+    for name, query, field, genre, tags in c.fetchall():
+        db_save_search(conn, c, name, query, field, genre, json.loads(tags))
+
+
+def db_upsert_entry(conn, c, entry_dict, tags=None):
+    """ Insert the entry, or update it if the bibkey already exists.
+    Return the id of the entry """
+    id_ = db_bibkey_id(c, entry_dict['bibkey'])
+    if id_:
+        db_update_entry(conn, c, id_, entry_dict, tags=tags)
+    else:
+        db_insert_entry(conn, c, entry_dict, tags=tags)
+        id_ = db_bibkey_id(c, entry_dict['bibkey'])
+    return id_
+
+
+def _bulk(conn, c, statements, changed=None, prepare=None):
+    """ Run (sql, params) statements in one transaction
+    :argument
+        statements: list        (sql, params) run in order
+        changed: tuple          (sql, params) selecting the ids of the notes
+                                the statements change, read first. Their
+                                saved search results are checked again in
+                                the same transaction.
+        prepare: callable       prepare(ids) called before the statements
+    :returns
+        n: int                  rows changed by all statements
+    """
+    n = 0
+    try:
+        _begin_write(conn, c)
+        ids = []
+        if changed:
+            c.execute(*changed)
+            ids = list(r[0] for r in c.fetchall())
+        if prepare:
+            prepare(ids)
+        for sql, params in statements:
+            c.execute(sql, params)
+            n += c.rowcount
+        _refresh_saved_results(c, ids)
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    return n
+
+
+# the notes of a bulk operation, by bibkeys
+_SQL_BULK_CHANGED = """ SELECT id FROM note WHERE bibkey IN
+    (SELECT value FROM json_each(?))"""
+
+
+def db_bulk_set_genre(conn, c, bibkeys, genre):
+    """ Set the genre of the notes bibkeys. Genre is not indexed for full
+    text search, so the fts index is left alone. A revision is recorded
+    for each changed note.
+    :returns
+        n: int                  number of notes changed
+    """
+    keys = json.dumps(list(bibkeys))
+
+    def record(ids):
+        for id_ in ids:
+            c.execute('SELECT {:s} FROM note_plain WHERE id = (?)'.format(
+                    ','.join(REV_FIELDS)), (id_,))
+            entry_dict = dict(zip(REV_FIELDS, c.fetchone()))
+            entry_dict['genre'] = genre
+            _record_revision(c, id_, entry_dict)
+
+    sql = """ UPDATE note SET genre = (?) WHERE bibkey IN
+    (SELECT value FROM json_each(?)) AND genre IS NOT (?)"""
+    changed = """ SELECT id FROM note WHERE bibkey IN
+    (SELECT value FROM json_each(?)) AND genre IS NOT (?)"""
+    return _bulk(conn, c, [(sql, (genre, keys, genre))],
+                 changed=(changed, (keys, genre)), prepare=record)
+
+
+def db_bulk_add_tag(conn, c, bibkeys, tag):
+    """ Add tag to the notes bibkeys that do not have it yet
+    :returns
+        n: int                  number of notes tagged
+    """
+    keys = json.dumps(list(bibkeys))
+    sql = """ INSERT INTO tags (bibkey, tag)
+    SELECT DISTINCT value, (?) FROM json_each(?)
+    WHERE value IN (SELECT bibkey FROM note)
+      AND value NOT IN (SELECT bibkey FROM tags WHERE tag = (?))"""
+    return _bulk(conn, c, [(sql, (tag, keys, tag))],
+                 changed=(_SQL_BULK_CHANGED, (keys,)))
+
+
+def db_bulk_remove_tag(conn, c, bibkeys, tag):
+    """ Remove tag from the notes bibkeys
+    :returns
+        n: int                  number of notes untagged
+    """
+    keys = json.dumps(list(bibkeys))
+    sql = """ DELETE FROM tags WHERE tag = (?)
+    AND bibkey IN (SELECT value FROM json_each(?))"""
+    return _bulk(conn, c, [(sql, (tag, keys))], changed=(_SQL_BULK_CHANGED, (keys,)))
+
+
+def db_rename_tag(conn, c, old, new, bibkeys=None):
+    """ Rename tag old to new, or merge it into new if new already exists.
+    Notes that have both tags keep one.
+    :argument
+        bibkeys: list of str    only rename on these notes, default all
+    :returns
+        n: int                  number of notes renamed
+    """
+    if old == new:
+        return 0
+    if bibkeys is None:
+        scope = ''
+        params = ()
+    else:
+        scope = 'AND bibkey IN (SELECT value FROM json_each(?))'
+        params = (json.dumps(list(bibkeys)),)
+    changed = """ SELECT id FROM note WHERE bibkey IN
+    (SELECT bibkey FROM tags WHERE tag = (?) {:s})""".format(scope)
+    return _bulk(conn, c, [
+        (""" DELETE FROM tags WHERE tag = (?) {:s}
+        AND bibkey IN (SELECT bibkey FROM tags WHERE tag = (?))""".format(scope),
+         (old,) + params + (new,)),
+        ('UPDATE tags SET tag = (?) WHERE tag = (?) {:s}'.format(scope),
+         (new, old) + params)],
+                 changed=(changed, (old,) + params))
+
+
+def db_delete_entries(conn, c, bibkeys):
+    """ Delete the notes bibkeys with their tags. The fts index, revision
+    history, similarity index, statistics and saved results follow by
+    triggers.
+    :returns
+        links: list of str      image links of the deleted notes that no
+                                other note links to, for the caller to
+                                remove from the image store
+    """
+    keys = json.dumps(list(bibkeys))
+    c.execute(""" SELECT img_linkstr FROM note WHERE img_linkstr != ''
+    AND bibkey IN (SELECT value FROM json_each(?))""", (keys,))
+    links = list(l for r in c.fetchall() for l in r[0].split(',') if l)
+    _bulk(conn, c, [
+        ('DELETE FROM tags WHERE bibkey IN (SELECT value FROM json_each(?))', (keys,)),
+        ('DELETE FROM note WHERE bibkey IN (SELECT value FROM json_each(?))', (keys,))])
+    return db_unreferenced_links(c, links)
+
+
+def _create_sync(c):
+    """ Create the change log used to sync libraries, and the triggers on
+    note and tags that fill it. sync_log keeps the last change of every
+    (bibkey, field): its local version, and the time and site of the edit
+    that resolves conflicts. Fields are the columns of SYNC_FIELDS, 'tags'
+    for the tag set, and '_deleted' for the existence of the note. """
+    c.execute(""" CREATE TABLE IF NOT EXISTS sync_log (
+        bibkey TEXT NOT NULL,
+        field TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        time REAL NOT NULL,
+        site TEXT NOT NULL,
+        PRIMARY KEY (bibkey, field)
+    ) WITHOUT ROWID;""")
+    c.execute('CREATE INDEX IF NOT EXISTS sync_log_version ON sync_log (version)')
+    if db_get_setting(c, 'sync_site') is None:
+        # a new library, or one from before sync: log what it has so far,
+        # older than any real edit
+        c.execute("INSERT INTO settings (key, value) VALUES ('sync_site', ?)",
+                  (uuid.uuid4().hex,))
+        c.execute(""" INSERT OR IGNORE INTO sync_log
+        SELECT note.bibkey, f.value, 1, 0, '' FROM note, json_each(?) AS f""",
+                  (json.dumps(SYNC_FIELDS + ['tags', '_deleted']),))
+
+    upsert = """ INSERT INTO sync_log (bibkey, field, version, time, site)
+        SELECT {bibkey}, {field}, (SELECT COALESCE(MAX(version), 0) + 1 FROM sync_log),
+          (julianday('now') - 2440587.5) * 86400.0,
+          (SELECT value FROM settings WHERE key = 'sync_site') {source}
+        ON CONFLICT (bibkey, field) DO UPDATE SET version = excluded.version,
+          time = excluded.time, site = excluded.site;"""
+    # changes written by db_apply_changes carry the remote time and site
+    when = "WHEN (SELECT value FROM settings WHERE key = 'sync_applying') IS NULL"
+    all_fields = ', '.join("('{:s}')".format(f) for f in SYNC_FIELDS + ['tags', '_deleted'])
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS sync_note_ai
+    AFTER INSERT ON note {when} BEGIN {upsert} END;""".format(
+            when=when, upsert=upsert.format(
+                bibkey='new.bibkey', field='column1',
+                source='FROM (VALUES {:s}) WHERE 1'.format(all_fields))))
+    changed = ', '.join("('{0:s}', old.{0:s} IS NOT new.{0:s})".format(f)
+                        for f in SYNC_FIELDS)
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS sync_note_au
+    AFTER UPDATE OF {fields} ON note {when} BEGIN {upsert} END;""".format(
+            fields=', '.join(SYNC_FIELDS), when=when + ' AND ' + _NOT_PACKING,
+            upsert=upsert.format(
+                bibkey='new.bibkey', field='column1',
+                source='FROM (VALUES {:s}) WHERE column2'.format(changed))))
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS sync_note_ad
+    AFTER DELETE ON note {when} BEGIN {upsert} END;""".format(
+            when=when, upsert=upsert.format(bibkey='old.bibkey', field="'_deleted'",
+                                            source='WHERE 1')))
+    for event, row in (('INSERT', 'new'), ('DELETE', 'old')):
+        c.execute(""" CREATE TRIGGER IF NOT EXISTS sync_tags_{name}
+        AFTER {event} ON tags {when} BEGIN {upsert} END;""".format(
+                name='ai' if event == 'INSERT' else 'ad', event=event, when=when,
+                upsert=upsert.format(bibkey=row + '.bibkey', field="'tags'",
+                                     source='WHERE 1')))
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS sync_tags_au
+    AFTER UPDATE ON tags {when} BEGIN {old} {new} END;""".format(
+            when=when,
+            old=upsert.format(bibkey='old.bibkey', field="'tags'", source='WHERE 1'),
+            new=upsert.format(bibkey='new.bibkey', field="'tags'", source='WHERE 1')))
+
+
+def db_sync_version(c):
+    """ Return the latest version of the change log """
+    c.execute('SELECT COALESCE(MAX(version), 0) FROM sync_log')
+    return c.fetchone()[0]
+
+
+def db_sync_changes(c, since=0):
+    """ Return the changes made after version since, with their current
+    values. Only the changed rows of sync_log are read.
+    :returns
+        changes: dict           {bibkey: {field: [value, time, site]}}
+    """
+    c.execute(""" SELECT bibkey, field, time, site FROM sync_log
+    WHERE version > (?) ORDER BY bibkey""", (since,))
+    changes = {}
+    for bibkey, field, t, site in c.fetchall():
+        changes.setdefault(bibkey, {})[field] = [None, t, site]
+    fields = ', '.join(SYNC_FIELDS)
+    for bibkey, entry in changes.items():
+        c.execute('SELECT {:s} FROM note_plain WHERE bibkey = (?)'.format(fields), (bibkey,))
+        res = c.fetchall()
+        row = dict(zip(SYNC_FIELDS, res[0])) if res else None
+        for field, change in entry.items():
+            if field == '_deleted':
+                change[0] = row is None
+            elif field == 'tags':
+                c.execute('SELECT tag FROM tags WHERE bibkey = (?) ORDER BY tag', (bibkey,))
+                change[0] = list(r[0] for r in c.fetchall())
+            elif row is not None:
+                change[0] = row[field]
+    return changes
+
+
+def db_apply_changes(conn, c, changes):
+    """ Merge changes from another library, as returned by db_sync_changes.
+    Conflicts are resolved per field: the edit with the later time wins
+    (ties broken by site). Applied changes are logged with their original
+    time and site, so that they propagate further but do not win again.
+    :returns
+        applied: dict           {bibkey: [fields taken from changes]}
+    """
+    applied = {}
+    try:
+        _begin_write(conn, c)
+        version = db_sync_version(c) + 1
+        c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('sync_applying', '1')")
+        for bibkey, entry in changes.items():
+            c.execute('SELECT field, time, site FROM sync_log WHERE bibkey = (?)', (bibkey,))
+            local = {f: (t, s) for f, t, s in c.fetchall()}
+            wins = {f: v for f, (v, t, s) in entry.items()
+                    if (t, s) > local.get(f, (-1, ''))}
+            if not wins:
+                continue
+            c.execute('SELECT id, {:s} FROM note_plain WHERE bibkey = (?)'.format(
+                    ', '.join(SYNC_FIELDS)), (bibkey,))
+            res = c.fetchall()
+            if wins.get('_deleted'):
+                if res:
+                    c.execute('DELETE FROM tags WHERE bibkey = (?)', (bibkey,))
+                    c.execute('DELETE FROM note WHERE id = (?)', (res[0][0],))
+                wins = {'_deleted': True}
+            elif res or any(f in wins for f in SYNC_FIELDS):
+                if not res and '_deleted' in local and '_deleted' not in wins:
+                    continue    # deleted here after the remote edits
+                old = dict(zip(SYNC_FIELDS, res[0][1:])) if res else \
+                    dict.fromkeys(SYNC_FIELDS, '')
+                entry_dict = dict(old)
+                entry_dict.update((f, v) for f, v in wins.items()
+                                  if f in SYNC_FIELDS and v is not None)
+                entry_dict['bibkey'] = bibkey
+                if not entry_dict['genre']:
+                    entry_dict['genre'] = 'Theory'
+                if res:
+                    id_ = res[0][0]
+                    changed = list(f for f in SYNC_FIELDS if entry_dict[f] != old[f])
+                    if changed:
+                        _record_revision(c, id_, entry_dict)
+                        c.execute('UPDATE note SET {:s} WHERE id = (?)'.format(
+                                ', '.join('{:s} = (?)'.format(f) for f in changed)),
+                                  _stored_values(c, entry_dict, changed) + (id_,))
+                        if set(changed) & set(SIM_FIELDS):
+                            _index_similar(c, id_)
+                        if set(changed) & set(LINK_FIELDS):
+                            _index_links(c, id_)
+                else:
+                    c.execute('INSERT INTO note (bibkey, {:s}) VALUES (?, {:s})'.format(
+                            ', '.join(SYNC_FIELDS), ', '.join('?' * len(SYNC_FIELDS))),
+                              (bibkey,) + _stored_values(c, entry_dict, SYNC_FIELDS))
+                    id_ = c.lastrowid
+                    _record_revision(c, id_, entry_dict, is_new=True)
+                    _index_similar(c, id_)
+                    _index_links(c, id_, is_new=True)
+            if 'tags' in wins and db_bibkey_id(c, bibkey):
+                c.execute('DELETE FROM tags WHERE bibkey = (?)', (bibkey,))
+                c.executemany('INSERT INTO tags (bibkey, tag) VALUES (?, ?)',
+                              ((bibkey, tag) for tag in wins['tags']))
+            c.executemany(""" INSERT OR REPLACE INTO sync_log VALUES (?, ?, ?, ?, ?)""",
+                          ((bibkey, f, version, entry[f][1], entry[f][2]) for f in wins))
+            applied[bibkey] = sorted(wins)
+        c.execute("DELETE FROM settings WHERE key = 'sync_applying'")
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    if applied:
+        db_rematerialize_saved_searches(conn, c)
+    return applied
+
+
+def db_bibkey_id(c, bibkey):
+    """ Return the id of tbe bibkey. Reture None if not found """
+    c.execute('SELECT id FROM note WHERE bibkey = (?)', (bibkey,))
+    res = c.fetchall()
+    if res:
+        return res[0][0]
+    else:
+        return None
+
+
+def db_select_last_entry(c):
+    """ Seletc the last entry from database """
+    fields = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
+              'method', 'finding', 'comment', 'img_linkstr']
+    sql = "SELECT {:s} FROM note_plain ORDER BY id DESC LIMIT 1".format(','.join(fields))
+    c.execute(sql)
+    result = c.fetchall()
+    a_dict = {}
+    if result:
+        for field, value in zip(fields, result[0]):
+            a_dict[field] = value
+    else:
+        for field in fields:
+            a_dict[field] = ''
+
+    # get tags
+    if a_dict:
+        c.execute("SELECT tag FROM tags WHERE bibkey = (?) ORDER BY tag ASC",
+                  (a_dict['bibkey'], ))
+        tags = tuple(r[0] for r in c.fetchall())
+    else:
+        tags = ()
+
+    return a_dict, tags
+
+
+def db_select_entry(c, bibkey, fields=None):
+    """ Select entry from database
+    :argument
+        c: sqlite3 cursor
+        bibkey: str
+        fields: list            columns to read, default all. The long
+                                texts left out are read by db_iter_entry_text
+    :returns
+        entry_dict: dict
+    """
+    if fields is None:
+        fields = ENTRY_HEADER_FIELDS + ENTRY_TEXT_FIELDS
+    fields = ['bibkey'] + list(f for f in fields if f != 'bibkey')
+    sql = "SELECT {:s} FROM note_plain WHERE bibkey = (?)".format(','.join(fields))
+    c.execute(sql, (bibkey,))
+    result = c.fetchone()
+    if result is None:
+        raise IndexError('No entry {:s}'.format(bibkey))
+    a_dict = {}
+    for field, value in zip(fields, result):
+        a_dict[field] = value
+    c.execute("SELECT tag FROM tags WHERE bibkey = (?) ORDER BY tag ASC",
+              (a_dict['bibkey'],))
+    tags = tuple(r[0] for r in c.fetchall())
+    return a_dict, tags
+
+
+def db_iter_entry_text(c, bibkey, fields=ENTRY_TEXT_FIELDS):
+    """ Read the long text columns of an entry one at a time, so that each
+    can be shown before the next one is read
+    :returns
+        iterator of (field, text), text '' if the entry is gone
+    """
+    for field in fields:
+        c.execute("SELECT {:s} FROM note_plain WHERE bibkey = (?)".format(field), (bibkey,))
+        result = c.fetchone()
+        yield field, result[0] if result else ''
+
+
+def db_query_all_tags(c):
+    """ Query all tags """
+
+    c.execute("SELECT tag FROM stat_tag WHERE n > 0 ORDER BY tag ASC")
+    return tuple(r[0] for r in c.fetchall())
+
+
+def db_search_tag(c, tag):
+    """ Query bibkeys that have the tag """
+    c.execute("SELECT bibkey FROM tags WHERE tag = (?) ORDER BY bibkey ASC",
+              (tag,))
+    return list(r[0] for r in c.fetchall())
+
+
+def db_iter_img_links(c):
+    """ Iterate over (note id, link) of every image link, streaming the
+    notes instead of fetching them all at once """
+    cursor = c.connection.cursor()
+    cursor.execute("SELECT id, img_linkstr FROM note WHERE img_linkstr != ''")
+    for id_, linkstr in cursor:
+        for link in linkstr.split(','):
+            if link:
+                yield id_, link
+
+
+def db_unreferenced_links(c, links):
+    """ Return the links that no note links to """
+    a_list = []
+    for link in links:
+        c.execute(""" SELECT 1 FROM note WHERE
+        instr(',' || img_linkstr || ',', ',' || ? || ',') > 0 LIMIT 1""", (link,))
+        if not c.fetchall():
+            a_list.append(link)
+    return a_list
+
+
+def db_remove_img_links(conn, c, links):
+    """ Remove links from the img_linkstr of every note
+    :returns
+        n: int                  number of notes changed
+    """
+    links = set(links)
+    changed = []
+    for id_, linkstr in c.connection.execute(
+            "SELECT id, img_linkstr FROM note WHERE img_linkstr != ''"):
+        kept = list(l for l in linkstr.split(',') if l and l not in links)
+        if len(kept) != len(linkstr.split(',')):
+            changed.append((','.join(kept), id_))
+    c.executemany('UPDATE note SET img_linkstr = (?) WHERE id = (?)', changed)
+    conn.commit()
+    return len(changed)
+
+
+def db_img_digest_link(c, digest):
+    """ Return the link of the stored image with pixel digest, or None """
+    c.execute('SELECT link FROM img_digest WHERE digest = (?)', (digest,))
+    res = c.fetchall()
+    return res[0][0] if res else None
+
+
+def db_add_img_digests(conn, c, pairs):
+    """ Record the pixel digests of stored images
+    :argument
+        pairs: iterable of (digest, link)
+    """
+    c.executemany('INSERT OR REPLACE INTO img_digest VALUES (?, ?)', pairs)
+    conn.commit()
+
+
+def db_remove_img_digests(conn, c, links):
+    """ Forget the pixel digests of deleted images """
+    c.executemany('DELETE FROM img_digest WHERE link = (?)', ((l,) for l in links))
+    conn.commit()
+
+
+def _sim_counts(texts):
+    """ Return the term counts of the similarity fields of a note """
+    words = _RE_SIM_WORD.findall(' '.join(t or '' for t in texts).lower())
+    return Counter(w for w in words if w not in _SIM_STOPWORDS)
+
+
+def _sim_vector(counts, term_ids, dfs, n_docs):
+    """ Return the top weighted terms of a note as (term ids, weights)
+    arrays, l2 normalized, with weight (1 + log tf) * log(1 + n / df) """
+    weights = sorted((((1 + log(tf)) * log(1 + n_docs / max(dfs[t], 1)), term_ids[t])
+                      for t, tf in counts.items()), reverse=True)[:SIM_TOP_TERMS]
+    norm = sqrt(sum(w * w for w, _ in weights)) or 1.
+    return (array('i', (t for _, t in weights)),
+            array('f', (w / norm for w, _ in weights)))
+
+
+def _sim_n_docs(c):
+    """ Return the number of indexed notes, kept in the settings because
+    counting sim_doc scans the whole table """
+    return int(db_get_setting(c, 'sim_n_docs', '0'))
+
+
+def _index_similar(c, id_):
+    """ Update the similarity index of note id_. The other notes keep the
+    document frequencies they were weighted with until db_rebuild_similar. """
+    c.execute('SELECT {:s} FROM note_plain WHERE id = (?)'.format(','.join(SIM_FIELDS)), (id_,))
+    counts = _sim_counts(c.fetchone())
+    c.execute('SELECT terms FROM sim_doc WHERE note_id = (?)', (id_,))
+    res = c.fetchall()
+    if res:
+        c.execute(""" DELETE FROM sim_post WHERE note_id = (?) AND term_id IN
+        (SELECT value FROM json_each(?))""", (id_, res[0][0]))
+        c.execute(""" UPDATE sim_term SET df = df - 1 WHERE id IN
+        (SELECT value FROM json_each(?))""", (res[0][0],))
+    terms = json.dumps(list(counts))
+    c.execute('INSERT OR IGNORE INTO sim_term (term) SELECT value FROM json_each(?)',
+              (terms,))
+    c.execute(""" UPDATE sim_term SET df = df + 1 WHERE term IN
+    (SELECT value FROM json_each(?))""", (terms,))
+    c.execute(""" SELECT term, id, df FROM sim_term WHERE term IN
+    (SELECT value FROM json_each(?))""", (terms,))
+    term_ids = {}
+    dfs = {}
+    for term, tid, df in c.fetchall():
+        term_ids[term] = tid
+        dfs[term] = df
+    n_docs = _sim_n_docs(c)
+    if not res:
+        n_docs += 1
+        c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('sim_n_docs', ?)",
+                  (str(n_docs),))
+    vec_terms, vec_weights = _sim_vector(counts, term_ids, dfs, n_docs)
+    c.execute('INSERT OR REPLACE INTO sim_doc VALUES (?, ?, ?, ?)',
+              (id_, json.dumps(sorted(term_ids.values())),
+               vec_terms.tobytes(), vec_weights.tobytes()))
+    c.executemany('INSERT INTO sim_post VALUES (?, ?, ?)',
+                  ((t, id_, w) for t, w in zip(vec_terms, vec_weights)))
+
+
+def db_rebuild_similar(conn, c, progress=None, chunk=500):
+    """ Build the similarity index of all notes from scratch, weighted with
+    the document frequencies of the whole library
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        progress: callable      progress(n_done, n_total) called per chunk
+        chunk: int              notes written per batch
+    """
+    c.execute('SELECT COUNT(*) FROM note')
+    n_docs = c.fetchone()[0]
+    fields = ','.join(SIM_FIELDS)
+    # pass 1: document frequencies
+    dfs = Counter()
+    for row in c.connection.execute('SELECT {:s} FROM note_plain'.format(fields)):
+        dfs.update(_sim_counts(row).keys())
+    term_ids = {t: i for i, t in enumerate(dfs, start=1)}
+    c.execute('DELETE FROM sim_post')
+    c.execute('DELETE FROM sim_doc')
+    c.execute('DELETE FROM sim_term')
+    c.executemany('INSERT INTO sim_term (id, term, df) VALUES (?, ?, ?)',
+                  ((term_ids[t], t, df) for t, df in dfs.items()))
+    # pass 2: vectors and postings
+    cursor = c.connection.execute('SELECT id, {:s} FROM note_plain'.format(fields))
+    n_done = 0
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            break
+        docs = []
+        posts = []
+        for row in rows:
+            counts = _sim_counts(row[1:])
+            vec_terms, vec_weights = _sim_vector(counts, term_ids, dfs, n_docs)
+            docs.append((row[0], json.dumps(sorted(term_ids[t] for t in counts)),
+                         vec_terms.tobytes(), vec_weights.tobytes()))
+            posts.extend((t, row[0], w) for t, w in zip(vec_terms, vec_weights))
+        c.executemany('INSERT INTO sim_doc VALUES (?, ?, ?, ?)', docs)
+        c.executemany('INSERT INTO sim_post VALUES (?, ?, ?)', posts)
+        n_done += len(rows)
+        if progress:
+            progress(n_done, n_docs)
+    c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('sim_n_docs', ?)",
+              (str(n_docs),))
+    conn.commit()
+
+
+def db_similar_missing(c):
+    """ Return the number of notes missing from the similarity index """
+    c.execute('SELECT COUNT(*) FROM note')
+    return c.fetchone()[0] - _sim_n_docs(c)
+
+
+def db_related(c, bibkey, n=10):
+    """ Return the notes most similar to bibkey, by the cosine of their
+    tf-idf vectors
+    :returns
+        related: list of (bibkey, score)    best first
+    """
+    c.execute(""" SELECT note.id, vec_terms, vec_weights FROM note
+    JOIN sim_doc ON sim_doc.note_id = note.id WHERE note.bibkey = (?)""", (bibkey,))
+    res = c.fetchall()
+    if not res:
+        return []
+    id_, vec_terms, vec_weights = res[0]
+    terms = array('i')
+    terms.frombytes(vec_terms)
+    weights = array('f')
+    weights.frombytes(vec_weights)
+    # skipping common terms only pays off in large libraries
+    max_df = max(int(_sim_n_docs(c) * SIM_MAX_DF), 1000)
+    # the query terms drive the join, each one is a range of the postings
+    c.execute(""" WITH q (term_id, w) AS (
+        SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]')
+        FROM json_each(?))
+    SELECT note.bibkey, s.score FROM (
+        SELECT p.note_id, SUM(p.weight * q.w) AS score
+        FROM q JOIN sim_term AS t ON t.id = q.term_id AND t.df <= (?)
+        CROSS JOIN sim_post AS p ON p.term_id = q.term_id
+        WHERE p.note_id != (?)
+        GROUP BY p.note_id ORDER BY score DESC LIMIT (?)) AS s
+    JOIN note ON note.id = s.note_id ORDER BY s.score DESC""",
+              (json.dumps(list(zip(terms, weights))), max_df, id_, n))
+    return c.fetchall()
+
+
+class BibkeyMatcher:
+    """ Aho-Corasick automaton over bibkeys, to find every bibkey mentioned
+    in a text in one pass over the text. Matching ignores case, and a match
+    must not be part of a longer word. Keys added after the automaton is
+    built are searched for one by one, until it is built again. """
+
+    def __init__(self, keys):
+        self._keys = {}     # lower case key: [keys]
+        for key in keys:
+            if key:
+                self._keys.setdefault(key.lower(), []).append(key)
+        self.extra = []
+        # transitions are one dict keyed by state << 21 | code point, far
+        # smaller than a dict per state
+        goto = {}
+        children = [[]]
+        term = {}           # state: lower case key ending there
+        for lkey in self._keys:
+            s = 0
+            for ch in lkey:
+                code = ord(ch)
+                t = goto.get(s << 21 | code)
+                if t is None:
+                    t = len(children)
+                    goto[s << 21 | code] = t
+                    children.append([])
+                    children[s].append((code, t))
+                s = t
+            term[s] = lkey
+        n = len(children)
+        fail = array('i', bytes(4 * n))
+        out = array('i', bytes(4 * n))      # next state with a key on the fail chain
+        queue_ = list(t for code, t in children[0])
+        for s in queue_:
+            for code, t in children[s]:
+                f = fail[s]
+                while f and (f << 21 | code) not in goto:
+                    f = fail[f]
+                u = goto.get(f << 21 | code, 0)
+                fail[t] = u
+                out[t] = u if u in term else out[u]
+                queue_.append(t)
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._term = term
+
+    def add(self, key):
+        lkey = key.lower()
+        if lkey in self._keys:
+            if key not in self._keys[lkey]:
+                self._keys[lkey].append(key)
+        elif key:
+            self._keys[lkey] = [key]
+            self.extra.append(lkey)
+
+    @staticmethod
+    def _bounded(text, start, end):
+        return not ((start > 0 and (text[start-1].isalnum() or text[start-1] == '_')) or
+                    (end < len(text) and (text[end].isalnum() or text[end] == '_')))
+
+    def find(self, text):
+        """ Return the set of keys mentioned in text """
+        text = text.lower()
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        term = self._term
+        found = set()
+        s = 0
+        for i, ch in enumerate(text):
+            code = ord(ch)
+            t = goto.get(s << 21 | code)
+            while t is None and s:
+                s = fail[s]
+                t = goto.get(s << 21 | code)
+            s = t or 0
+            m = s if s in term else out[s]
+            while m:
+                lkey = term[m]
+                if lkey not in found and self._bounded(text, i + 1 - len(lkey), i + 1):
+                    found.add(lkey)
+                m = out[m]
+        for lkey in self.extra:
+            start = text.find(lkey)
+            while start >= 0:
+                if self._bounded(text, start, start + len(lkey)):
+                    found.add(lkey)
+                    break
+                start = text.find(lkey, start + 1)
+        return set(key for lkey in found for key in self._keys[lkey])
+
+
+_link_matchers = {}     # database: [matcher, largest note id in it]
+_link_lock = threading.Lock()
+
+
+def _link_matcher(c, rebuild=False):
+    """ Return the bibkey matcher of the database of c, shared by all its
+    connections. New notes are picked up by id; deleted ones stay in the
+    matcher but no longer resolve to a note. Call with _link_lock held. """
+    filename = c.connection.execute('PRAGMA database_list').fetchone()[2]
+    key = filename or id(c.connection)
+    entry = _link_matchers.get(key)
+    if rebuild or entry is None or len(entry[0].extra) > LINK_MAX_EXTRA:
+        c.execute('SELECT COALESCE(MAX(id), 0) FROM note')
+        max_id = c.fetchone()[0]
+        keys = (r[0] for r in c.connection.execute(
+                'SELECT bibkey FROM note WHERE id <= (?)', (max_id,)))
+        entry = _link_matchers[key] = [BibkeyMatcher(keys), max_id]
+    else:
+        c.execute('SELECT id, bibkey FROM note WHERE id > (?) ORDER BY id', (entry[1],))
+        for id_, bibkey in c.fetchall():
+            entry[0].add(bibkey)
+            entry[1] = id_
+    return entry[0]
+
+
+def db_prepare_links(filename):
+    """ Build the bibkey matcher of database filename ahead of the first
+    save, e.g. in a background thread at startup """
+    conn = open_db_readonly(filename)
+    try:
+        with _link_lock:
+            _link_matcher(conn.cursor())
+    finally:
+        conn.close()
+
+
+def _index_links(c, id_, is_new=False):
+    """ Replace the mention links of note id_ by the bibkeys found in its
+    text. A new note is also linked from the notes that mention it already,
+    found with the fts index. """
+    c.execute('SELECT bibkey, {:s} FROM note_plain WHERE id = (?)'.format(
+            ','.join(LINK_FIELDS)), (id_,))
+    row = c.fetchone()
+    with _link_lock:
+        keys = _link_matcher(c).find('\n'.join(t or '' for t in row[1:]))
+    keys.discard(row[0])
+    c.execute("DELETE FROM note_link WHERE src_id = (?) AND kind = 'mention'", (id_,))
+    if keys:
+        c.execute(""" INSERT OR IGNORE INTO note_link (src_id, dst_id, kind)
+        SELECT (?), id, 'mention' FROM note
+        WHERE bibkey IN (SELECT value FROM json_each(?))""", (id_, json.dumps(list(keys))))
+    if is_new:
+        query = '{{{:s}}} : "{:s}"'.format(' '.join(LINK_FIELDS), row[0].replace('"', '""'))
+        try:
+            c.execute(""" SELECT note.id, {:s} FROM fts JOIN note_plain AS note
+            ON note.id = fts.rowid WHERE fts MATCH (?) AND note.id != (?)""".format(
+                    ','.join('note.' + f for f in LINK_FIELDS)), (query, id_))
+            rows = c.fetchall()
+        except sqlite3.OperationalError:    # e.g. too short for trigrams
+            rows = []
+        # the fts match is a superset: tokens of the key, in any case
+        matcher = BibkeyMatcher([row[0]])
+        c.executemany("INSERT OR IGNORE INTO note_link VALUES (?, ?, 'mention')",
+                      ((r[0], id_) for r in rows
+                       if matcher.find('\n'.join(t or '' for t in r[1:]))))
+
+
+def db_rebuild_links(conn, c, progress=None, chunk=500):
+    """ Find the mention links of all notes from scratch
+    :argument
+        progress: callable      progress(n_done, n_total) called per chunk
+    """
+    c.execute('SELECT COUNT(*) FROM note')
+    n_total = c.fetchone()[0]
+    c.execute('SELECT id, bibkey FROM note')
+    ids = dict((bibkey, id_) for id_, bibkey in c.fetchall())
+    with _link_lock:
+        matcher = _link_matcher(c, rebuild=True)
+    c.execute("DELETE FROM note_link WHERE kind = 'mention'")
+    cursor = c.connection.execute('SELECT id, bibkey, {:s} FROM note_plain'.format(
+            ','.join(LINK_FIELDS)))
+    n_done = 0
+    while True:
+        rows = cursor.fetchmany(chunk)
+        if not rows:
+            break
+        c.executemany("INSERT INTO note_link VALUES (?, ?, 'mention')",
+                      ((row[0], ids[key]) for row in rows
+                       for key in matcher.find('\n'.join(t or '' for t in row[2:]))
+                       if key != row[1] and key in ids))
+        n_done += len(rows)
+        if progress:
+            progress(n_done, n_total)
+    c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('links_built', '1')")
+    conn.commit()
+
+
+def db_links_missing(c):
+    """ Return True if the links of an older library were never built """
+    return db_get_setting(c, 'links_built') is None
+
+
+def db_add_link(conn, c, src, dst, kind='cites'):
+    """ Link note src to note dst by hand
+    :returns
+        added: bool             False if a note does not exist or the link
+                                already does
+    """
+    c.execute(""" INSERT OR IGNORE INTO note_link (src_id, dst_id, kind)
+    SELECT s.id, d.id, (?) FROM note AS s, note AS d
+    WHERE s.bibkey = (?) AND d.bibkey = (?) AND s.id != d.id""", (kind, src, dst))
+    added = c.rowcount > 0
+    conn.commit()
+    return added
+
+
+def db_remove_link(conn, c, src, dst, kind='cites'):
+    c.execute(""" DELETE FROM note_link WHERE kind = (?)
+    AND src_id = (SELECT id FROM note WHERE bibkey = (?))
+    AND dst_id = (SELECT id FROM note WHERE bibkey = (?))""", (kind, src, dst))
+    conn.commit()
+
+
+def db_links(c, bibkey, cited_by=False):
+    """ Return the notes bibkey links to, or that link to it
+    :returns
+        links: list of (bibkey, kind)   sorted by bibkey
+    """
+    if cited_by:
+        join, where = 'l.src_id', 'l.dst_id'
+    else:
+        join, where = 'l.dst_id', 'l.src_id'
+    c.execute(""" SELECT n.bibkey, l.kind FROM note_link AS l
+    JOIN note AS n ON n.id = {:s}
+    WHERE {:s} = (SELECT id FROM note WHERE bibkey = (?))
+    ORDER BY n.bibkey, l.kind""".format(join, where), (bibkey,))
+    return c.fetchall()
+
+
+def db_link_neighbourhood(c, bibkey, hops=2, limit=1000):
+    """ Return the notes within hops links of bibkey, in either direction
+    :returns
+        notes: list of (bibkey, distance)   nearest first
+    """
+    # each note enters the walk at most once per distance, and the union
+    # of the two directions keeps both index lookups
+    c.execute(""" WITH RECURSIVE walk (id, depth) AS (
+        SELECT id, 0 FROM note WHERE bibkey = (?)
+        UNION
+        SELECT l.dst_id, w.depth + 1 FROM walk AS w
+        JOIN note_link AS l ON l.src_id = w.id WHERE w.depth < (?)
+        UNION
+        SELECT l.src_id, w.depth + 1 FROM walk AS w
+        JOIN note_link AS l ON l.dst_id = w.id WHERE w.depth < (?))
+    SELECT n.bibkey, MIN(w.depth) AS d FROM walk AS w JOIN note AS n ON n.id = w.id
+    WHERE w.depth > 0 AND n.bibkey != (?)
+    GROUP BY w.id ORDER BY d, n.bibkey LIMIT (?)""", (bibkey, hops, hops, bibkey, limit))
+    return c.fetchall()
+
+
+def _stats_length(row, packed=True):
+    """ Return the sql of the text length of a note row (new, old or note).
+    Packed texts are decoded unless packed is False. """
+    value = 'lt_unz({:s}.{:s})' if packed else '{:s}.{:s}'
+    return ' + '.join('LENGTH(COALESCE({:s}, \'\'))'.format(value.format(row, f))
+                      for f in STATS_LENGTH_FIELDS)
+
+
+def _create_stats(c, packed=False):
+    """ Create the aggregate tables and the triggers that maintain them.
+    stat_genre: notes and total text length per genre
+    stat_month: notes per month of creation ('' if unknown)
+    stat_tag: notes per tag
+    stat_cotag: notes per pair of tags (tag_a < tag_b)
+    note_meta: creation time of each note, as the note table has none
+    The triggers decode the texts if packed (zlib storage mode).
+    """
+    c.execute(""" CREATE TABLE IF NOT EXISTS note_meta (
+        note_id INTEGER PRIMARY KEY,
+        created REAL
+    );""")
+    c.execute(""" CREATE TABLE IF NOT EXISTS stat_genre (
+        genre TEXT PRIMARY KEY,
+        n INTEGER NOT NULL,
+        length INTEGER NOT NULL
+    );""")
+    c.execute(""" CREATE TABLE IF NOT EXISTS stat_month (
+        month TEXT PRIMARY KEY,
+        n INTEGER NOT NULL
+    );""")
+    c.execute(""" CREATE TABLE IF NOT EXISTS stat_tag (
+        tag TEXT PRIMARY KEY,
+        n INTEGER NOT NULL
+    );""")
+    c.execute(""" CREATE TABLE IF NOT EXISTS stat_cotag (
+        tag_a TEXT NOT NULL,
+        tag_b TEXT NOT NULL,
+        n INTEGER NOT NULL,
+        PRIMARY KEY (tag_a, tag_b)
+    ) WITHOUT ROWID;""")
+    month = "COALESCE(strftime('%Y-%m', {:s}, 'unixepoch'), '')"
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS stat_note_ai
+    AFTER INSERT ON note BEGIN
+      INSERT INTO note_meta VALUES (new.id, (julianday('now') - 2440587.5) * 86400.0);
+      INSERT INTO stat_genre VALUES (COALESCE(new.genre, ''), 1, {new_len})
+        ON CONFLICT (genre) DO UPDATE SET n = n + 1, length = length + excluded.length;
+      INSERT INTO stat_month VALUES ({month}, 1)
+        ON CONFLICT (month) DO UPDATE SET n = n + 1;
+    END;""".format(new_len=_stats_length('new', packed),
+                   month=month.format("(SELECT created FROM note_meta WHERE note_id = new.id)")))
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS stat_note_ad
+    AFTER DELETE ON note BEGIN
+      UPDATE stat_genre SET n = n - 1, length = length - ({old_len})
+        WHERE genre = COALESCE(old.genre, '');
+      UPDATE stat_month SET n = n - 1 WHERE month = {month};
+      DELETE FROM note_meta WHERE note_id = old.id;
+    END;""".format(old_len=_stats_length('old', packed),
+                   month=month.format("(SELECT created FROM note_meta WHERE note_id = old.id)")))
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS stat_note_au
+    AFTER UPDATE OF genre, {fields} ON note WHEN {not_packing} BEGIN
+      UPDATE stat_genre SET n = n - 1, length = length - ({old_len})
+        WHERE genre = COALESCE(old.genre, '');
+      INSERT INTO stat_genre VALUES (COALESCE(new.genre, ''), 1, {new_len})
+        ON CONFLICT (genre) DO UPDATE SET n = n + 1, length = length + excluded.length;
+    END;""".format(fields=', '.join(STATS_LENGTH_FIELDS), not_packing=_NOT_PACKING,
+                   old_len=_stats_length('old', packed),
+                   new_len=_stats_length('new', packed)))
+    # each pair of tags is counted once: by the trigger of whichever of the
+    # two rows is inserted (deleted) while the other one is present
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS stat_tag_ai
+    AFTER INSERT ON tags BEGIN
+      INSERT INTO stat_tag VALUES (new.tag, 1)
+        ON CONFLICT (tag) DO UPDATE SET n = n + 1;
+      INSERT INTO stat_cotag
+        SELECT MIN(tag, new.tag), MAX(tag, new.tag), 1 FROM tags
+        WHERE bibkey = new.bibkey AND tag != new.tag
+        ON CONFLICT (tag_a, tag_b) DO UPDATE SET n = n + 1;
+    END;""")
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS stat_tag_ad
+    AFTER DELETE ON tags BEGIN
+      UPDATE stat_tag SET n = n - 1 WHERE tag = old.tag;
+      UPDATE stat_cotag SET n = n - 1 WHERE (tag_a, tag_b) IN (
+        SELECT MIN(tag, old.tag), MAX(tag, old.tag) FROM tags
+        WHERE bibkey = old.bibkey AND tag != old.tag);
+    END;""")
+    c.execute(""" CREATE TRIGGER IF NOT EXISTS stat_tag_au
+    AFTER UPDATE OF bibkey, tag ON tags BEGIN
+      UPDATE stat_tag SET n = n - 1 WHERE tag = old.tag;
+      INSERT INTO stat_tag VALUES (new.tag, 1)
+        ON CONFLICT (tag) DO UPDATE SET n = n + 1;
+      UPDATE stat_cotag SET n = n - 1 WHERE (tag_a, tag_b) IN (
+        SELECT MIN(tag, old.tag), MAX(tag, old.tag) FROM tags
+        WHERE bibkey = old.bibkey AND tag != old.tag AND rowid != new.rowid);
+      INSERT INTO stat_cotag
+        SELECT MIN(tag, new.tag), MAX(tag, new.tag), 1 FROM tags
+        WHERE bibkey = new.bibkey AND tag != new.tag AND rowid != new.rowid
+        ON CONFLICT (tag_a, tag_b) DO UPDATE SET n = n + 1;
+    END;""")
+
+
+def _compute_stats(c):
+    """ Compute the aggregates from scratch
+    :returns
+        genres: {genre: (n, length)}
+        months: {month: n}
+        tags: {tag: n}
+        cotags: {(tag_a, tag_b): n}
+    """
+    c.execute(""" SELECT COALESCE(genre, ''), COUNT(*), SUM({:s})
+    FROM note GROUP BY 1""".format(_stats_length('note')))
+    genres = {g: (n, length) for g, n, length in c.fetchall()}
+    c.execute(""" SELECT COALESCE(strftime('%Y-%m', note_meta.created, 'unixepoch'), ''),
+    COUNT(*) FROM note LEFT JOIN note_meta ON note_meta.note_id = note.id GROUP BY 1""")
+    months = dict(c.fetchall())
+    c.execute('SELECT tag, COUNT(*) FROM tags GROUP BY tag')
+    tags = dict(c.fetchall())
+    c.execute(""" SELECT a.tag, b.tag, COUNT(*) FROM tags AS a
+    JOIN tags AS b ON a.bibkey = b.bibkey AND a.tag < b.tag GROUP BY 1, 2""")
+    cotags = {(a, b): n for a, b, n in c.fetchall()}
+    return genres, months, tags, cotags
+
+
+def db_rebuild_stats(conn, c):
+    """ Recompute the aggregate statistics from scratch. Notes without a
+    known creation time get the time of their first revision. """
+    c.execute(""" INSERT OR IGNORE INTO note_meta
+    SELECT note.id, (SELECT MIN(time) FROM note_rev_info WHERE note_id = note.id)
+    FROM note""")
+    genres, months, tags, cotags = _compute_stats(c)
+    c.execute('DELETE FROM stat_genre')
+    c.execute('DELETE FROM stat_month')
+    c.execute('DELETE FROM stat_tag')
+    c.execute('DELETE FROM stat_cotag')
+    c.executemany('INSERT INTO stat_genre VALUES (?, ?, ?)',
+                  ((g, n, length) for g, (n, length) in genres.items()))
+    c.executemany('INSERT INTO stat_month VALUES (?, ?)', months.items())
+    c.executemany('INSERT INTO stat_tag VALUES (?, ?)', tags.items())
+    c.executemany('INSERT INTO stat_cotag VALUES (?, ?, ?)',
+                  ((a, b, n) for (a, b), n in cotags.items()))
+    c.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('stats_built', ?)",
+              (str(time.time()),))
+    conn.commit()
+
+
+def db_verify_stats(c):
+    """ Compare the aggregate statistics with a computation from scratch
+    :returns
+        drift: list of str      one line per differing count, empty if none
+    """
+    genres, months, tags, cotags = _compute_stats(c)
+    c.execute('SELECT genre, n, length FROM stat_genre WHERE n != 0 OR length != 0')
+    stored = [('genre', {g: (n, length) for g, n, length in c.fetchall()}, genres)]
+    c.execute('SELECT month, n FROM stat_month WHERE n != 0')
+    stored.append(('month', dict(c.fetchall()), months))
+    c.execute('SELECT tag, n FROM stat_tag WHERE n != 0')
+    stored.append(('tag', dict(c.fetchall()), tags))
+    c.execute('SELECT tag_a, tag_b, n FROM stat_cotag WHERE n != 0')
+    stored.append(('tag pair', {(a, b): n for a, b, n in c.fetchall()}, cotags))
+    drift = []
+    for name, kept, fresh in stored:
+        for key in sorted(set(kept) | set(fresh), key=str):
+            if kept.get(key) != fresh.get(key):
+                drift.append('{:s} {!r}: stored {!r}, actual {!r}'.format(
+                    name, key, kept.get(key), fresh.get(key)))
+    return drift
+
+
+def db_stats(c):
+    """ Return summary counts of the library, read from the aggregates
+    :returns
+        stats: dict             number of notes, notes per genre, number of
+                                tags, average note length (characters)
+    """
+    c.execute('SELECT genre, n, length FROM stat_genre WHERE n > 0 ORDER BY genre')
+    rows = c.fetchall()
+    n_notes = sum(r[1] for r in rows)
+    length = sum(r[2] for r in rows)
+    c.execute('SELECT COUNT(*) FROM stat_tag WHERE n > 0')
+    n_tags = c.fetchone()[0]
+    return {'notes': n_notes, 'genres': {g: n for g, n, _ in rows}, 'tags': n_tags,
+            'avg_length': round(length / n_notes, 1) if n_notes else 0}
+
+
+def db_stats_months(c):
+    """ Return the number of notes created per month, {'YYYY-MM': n}, with
+    '' for notes of unknown creation time """
+    c.execute('SELECT month, n FROM stat_month WHERE n > 0 ORDER BY month')
+    return dict(c.fetchall())
+
+
+def db_stats_genre_length(c):
+    """ Return the average note length per genre """
+    c.execute('SELECT genre, 1.0 * length / n FROM stat_genre WHERE n > 0 ORDER BY genre')
+    return {g: round(avg, 1) for g, avg in c.fetchall()}
+
+
+def db_tag_cooccurrence(c, tag=None, n=20):
+    """ Return the most frequent pairs of tags on the same note
+    :argument
+        tag: str                only pairs with this tag
+        n: int                  number of pairs
+    :returns
+        pairs: list of (tag_a, tag_b, n_notes)
+    """
+    if tag is None:
+        c.execute(""" SELECT tag_a, tag_b, n FROM stat_cotag WHERE n > 0
+        ORDER BY n DESC, tag_a, tag_b LIMIT (?)""", (n,))
+    else:
+        c.execute(""" SELECT tag_a, tag_b, n FROM stat_cotag
+        WHERE (tag_a = (?) OR tag_b = (?)) AND n > 0
+        ORDER BY n DESC, tag_a, tag_b LIMIT (?)""", (tag, tag, n))
+    return c.fetchall()
+
+
+def db_add_attachment(conn, c, bibkey, name, kind, chunks, size=0,
+                      batch=ATTACH_BATCH):
+    """ Attach a text to note bibkey and index it chunk by chunk. An
+    attachment of the same name is replaced. The chunks are written batch
+    per transaction, so other connections are never locked out for long,
+    and searches find the first chunks while the rest is still read.
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        bibkey: str
+        name: str               name of the attachment, unique per note
+        kind: str               'text', 'markdown' or 'latex'
+        chunks: iterable of str texts of the chunks, consumed as written
+        size: int               size of the source in bytes
+        batch: int              chunks written per transaction
+    :returns
+        info: dict              name, chunks and characters indexed. None
+                                if the attachment was removed meanwhile
+    """
+    note_id = db_bibkey_id(c, bibkey)
+    if not note_id:
+        raise IndexError('No entry {:s}'.format(bibkey))
+    c.execute('DELETE FROM attachment WHERE note_id = (?) AND name = (?)',
+              (note_id, name))
+    c.execute(""" INSERT INTO attachment (note_id, name, kind, size, added)
+    VALUES (?,?,?,?,?)""", (note_id, name, kind, size, time.time()))
+    id_ = c.lastrowid
+    conn.commit()
+    n_chunks = 0
+    n_chars = 0
+    rows = []
+    for text in chunks:
+        rows.append((id_, note_id, n_chunks, text))
+        n_chunks += 1
+        n_chars += len(text)
+        if len(rows) >= batch:
+            if not _write_chunks(conn, c, id_, rows):
+                return None
+            rows = []
+    if not _write_chunks(conn, c, id_, rows):
+        return None
+    c.execute('UPDATE attachment SET n_chunks = (?) WHERE id = (?)', (n_chunks, id_))
+    conn.commit()
+    return {'name': name, 'chunks': n_chunks, 'chars': n_chars}
+
+
+def _write_chunks(conn, c, id_, rows):
+    """ Write chunks of attachment id_, unless it was deleted. Return
+    False if it was """
+    c.execute('SELECT 1 FROM attachment WHERE id = (?)', (id_,))
+    if c.fetchone() is None:
+        conn.rollback()
+        return False
+    c.executemany(""" INSERT INTO attachment_chunk (attachment_id, note_id,
+    seq, body) VALUES (?,?,?,?)""", rows)
+    conn.commit()
+    return True
+
+
+def db_remove_attachment(conn, c, bibkey, name):
+    """ Remove an attachment of note bibkey and its chunks. Return False if
+    there is no such attachment """
+    c.execute(""" DELETE FROM attachment WHERE name = (?)
+    AND note_id = (SELECT id FROM note WHERE bibkey = (?))""", (name, bibkey))
+    removed = c.rowcount > 0
+    conn.commit()
+    return removed
+
+
+def db_list_attachments(c, bibkey):
+    """ Return the attachments of note bibkey
+    :returns
+        attachments: list of (name, kind, size, n_chunks, added)
+                                n_chunks is None while it is ingested
+    """
+    c.execute(""" SELECT name, kind, size, n_chunks, added FROM attachment
+    WHERE note_id = (SELECT id FROM note WHERE bibkey = (?))
+    ORDER BY name""", (bibkey,))
+    return c.fetchall()
+
+
+def _split_query(query):
+    """ Split a search string into raw tokens
+    :argument
+        query: str
+    :returns
+        tokens: list of (negate, prefix_name, text, quoted)
+    """
+    tokens = []
+    i = 0
+    n = len(query)
+    while i < n:
+        if query[i].isspace():
+            i += 1
+            continue
+        negate = False
+        if query[i] == '-' and i + 1 < n and not query[i+1].isspace():
+            negate = True
+            i += 1
+        name = ''
+        j = i
+        while j < n and (query[j].isalnum() or query[j] == '_'):
+            j += 1
+        if j > i and j + 1 < n and query[j] == ':' and not query[j+1].isspace():
+            name = query[i:j].lower()
+            i = j + 1
+        if query[i] == '"':
+            j = query.find('"', i + 1)
+            if j < 0:       # unterminated quote runs to the end
+                j = n
+            text = query[i+1:j]
+            i = j + 1
+            if i < n and query[i] == '*':
+                text += '*'
+                i += 1
+            tokens.append((negate, name, text, True))
+        else:
+            j = i
+            while j < n and not query[j].isspace():
+                j += 1
+            tokens.append((negate, name, query[i:j], False))
+            i = j
+    return tokens
+
+
+def _fts_string(text):
+    """ Quote text as a fts5 string, keeping a trailing * as prefix query """
+    if text.endswith('*'):
+        text = text.rstrip('*')
+        suffix = ' *'
+    else:
+        suffix = ''
+    if not text.strip():
+        return ''
+    return '"{:s}"{:s}'.format(text.replace('"', '""'), suffix)
+
+
+SearchPlan = namedtuple('SearchPlan', ['where', 'params', 'fts_expr',
+                                       'att_expr', 'att_where', 'att_params',
+                                       'neg_expr', 'filter_where', 'filter_params'])
+SearchHit = namedtuple('SearchHit', ['bibkey', 'score', 'snippet', 'attachment'])
+
+
+@lru_cache(maxsize=256)
+def compile_query(query, field='ALL', genre='ALL', tags=()):
+    """ Compile a search string into a parameterized WHERE clause over note.
+    Syntax:
+        word            match word
+        "a phrase"      match the phrase
+        word*           prefix search
+        -word           exclude notes with word (also -"phrase", -field:word)
+        field:word      match word in one field (author, thesis, ...)
+        a OR b          match either a or b
+        a NEAR b        match a and b close to each other (NEAR/n sets distance)
+        tag:x           require tag x (-tag:x excludes it)
+        genre:y         restrict genre (repeat for several genres)
+    Compiled plans are cached per query string.
+    :argument
+        query: str              search string
+        field: str              field to search in, or 'ALL'
+        genre: str              genre, or 'ALL'
+        tags: tuple of str      notes must have one of these tags
+    :returns
+        plan: SearchPlan        where clause, its parameters and the fts
+                                expression matched against the note fields.
+                                Attachments have no fields: att_expr is
+                                matched against their chunks, '' if the query
+                                names a field, and the notes of the chunks
+                                must pass att_where. A query with only
+                                exclusions has no fts_expr but a neg_expr;
+                                filter_where holds the genre and tag
+                                conditions alone. A query left with no
+                                usable term (a lone OR, "") matches nothing.
+    """
+    if field != 'ALL' and field not in FTS_FIELDS:
+        raise ValueError('Unknown field: {:s}'.format(field))
+    groups = []         # AND of groups; each group is a list ORed together
+    negatives = []
+    conds = []
+    params = []
+    genres = []
+    joiner = None
+    fielded = field != 'ALL'
+    tokens = _split_query(query)
+    for negate, name, text, quoted in tokens:
+        if not (quoted or name or negate) and (
+                text in ('OR', 'NEAR') or
+                (text.startswith('NEAR/') and text[5:].isdigit())):
+            joiner = text
+            continue
+        if name == 'tag':
+            conds.append('{:s}EXISTS (SELECT 1 FROM tags WHERE '
+                         'tags.bibkey = note.bibkey AND tags.tag = ?)'.format(
+                             'NOT ' if negate else ''))
+            params.append(text)
+            joiner = None
+            continue
+        if name == 'genre':
+            if negate:
+                conds.append('note.genre IS NOT ? COLLATE NOCASE')
+                params.append(text)
+            else:
+                genres.append(text)
+            joiner = None
+            continue
+        if name and name not in FTS_FIELDS:
+            # not a field name, search the literal text
+            text = '{:s}:{:s}'.format(name, text)
+            name = ''
+        term = _fts_string(text)
+        if not term:
+            continue
+        if name:
+            term = '{:s} : {:s}'.format(name, term)
+            fielded = fielded or not negate
+        if negate:
+            negatives.append(term)
+        elif joiner == 'OR' and groups:
+            groups[-1].append(term)
+        elif joiner and joiner.startswith('NEAR') and groups and \
+                not name and not groups[-1][-1].startswith(tuple(FTS_FIELDS)):
+            # merge into the NEAR group of the previous term
+            last = groups[-1][-1]
+            distance = joiner[5:] if joiner != 'NEAR' else '10'
+            if last.startswith('NEAR('):
+                last = last[5:last.rindex(',')]
+            groups[-1][-1] = 'NEAR({:s} {:s}, {:s})'.format(last, term, distance)
+        else:
+            groups.append([term])
+        joiner = None
+
+    positive = ' AND '.join('(' + ' OR '.join(g) + ')' if len(g) > 1 else g[0]
+                            for g in groups)
+    negative = ' OR '.join(negatives)
+    if field != 'ALL':
+        if positive:
+            positive = '{:s} : ({:s})'.format(field, positive)
+        if negative:
+            negative = '{:s} : ({:s})'.format(field, negative)
+    if positive and negative:
+        fts_expr = '({:s}) NOT ({:s})'.format(positive, negative)
+    else:
+        fts_expr = positive
+
+    where = []
+    where_params = []
+    if fts_expr:
+        where.append('note.id IN (SELECT rowid FROM fts WHERE fts MATCH ?)')
+        where_params.append(fts_expr)
+    elif negative:
+        where.append('note.id NOT IN (SELECT rowid FROM fts WHERE fts MATCH ?)')
+        where_params.append(negative)
+    filters = []
+    filter_params = []
+    if genre != 'ALL':
+        genres.append(genre)
+    if genres:
+        filters.append('note.genre IN ({:s})'.format(
+            ','.join('? COLLATE NOCASE' for _ in genres)))
+        filter_params.extend(genres)
+    if tags:
+        filters.append('note.bibkey IN (SELECT bibkey FROM tags WHERE tag IN ({:s}))'.format(
+            ','.join('?' for _ in tags)))
+        filter_params.extend(tags)
+    filters.extend(conds)
+    filter_params.extend(params)
+    if tokens and not (groups or negatives or conds or genres):
+        # only joiners and empty strings, not the whole library
+        filters.append('0')
+    att_where = list(filters)
+    att_params = list(filter_params)
+    if negative:
+        att_where.insert(0, 'note.id NOT IN (SELECT rowid FROM fts WHERE fts MATCH ?)')
+        att_params.insert(0, negative)
+    return SearchPlan(' AND '.join(where + filters) or '1',
+                      tuple(where_params + filter_params), fts_expr,
+                      '' if fielded else positive, ' AND '.join(att_where) or '1',
+                      tuple(att_params), negative, ' AND '.join(filters) or '1',
+                      tuple(filter_params))
+
+
+def db_search_fulltext(c, field, genre, keyword, tags=None, attachments=False):
+    """ Query bibkeys that matches fields with keyword
+    :argument
+        c: sqlite3 cursor
+        field: str
+        genre: str
+        keyword: str            search string, see compile_query for syntax
+        tags: list of strings
+        attachments: bool       search the attachments too, and rank the
+                                results as db_search_hits
+    :returns
+        bibkeys: list of matched bibkeys, by bibkey or by rank
+    """
+    if attachments:
+        return list(hit.bibkey for hit in
+                    db_search_hits(c, field, genre, keyword, tags=tags, snippets=0))
+    plan = compile_query(keyword, field, genre, tuple(tags) if tags else ())
+    sql = """ SELECT note.bibkey FROM note WHERE {:s}
+    ORDER BY note.bibkey ASC""".format(plan.where)
+    c.execute(sql, plan.params)
+    return list(res[0] for res in c.fetchall())
+
+
+def db_search_hits(c, field, genre, keyword, tags=None, attachments=True,
+                   snippets=SNIPPET_HITS):
+    """ Search the notes and their attachments, best matches first.
+    Notes and attachment chunks are ranked apart by bm25, as their scores
+    do not compare, and merged by reciprocal rank: a note scores
+    1 / (ATTACH_RRF_K + rank) for its own rank, plus as much for the rank
+    of its best chunk. The snippet comes from the better of the two.
+    :argument
+        c: sqlite3 cursor
+        field, genre, keyword, tags: see db_search_fulltext
+        attachments: bool       search the attachment chunks
+        snippets: int           number of best hits that get a snippet,
+                                None for all
+    :returns
+        hits: list of SearchHit bibkey, score, snippet with the matches in
+                                [] ('' past the first snippets hits), and
+                                the attachment name of the snippet, '' if
+                                it is from the note
+    """
+    plan = compile_query(keyword, field, genre, tuple(tags) if tags else ())
+    if not plan.fts_expr:
+        # only exclusions and filters, nothing to rank
+        c.execute(""" SELECT note.bibkey FROM note WHERE {:s}
+        ORDER BY note.bibkey ASC""".format(plan.where), plan.params)
+        return list(SearchHit(r[0], 0.0, '', '') for r in c.fetchall())
+    # fts_expr holds the exclusions, only the filters are left to apply
+    c.execute(""" SELECT note.bibkey, note.id FROM fts JOIN note ON note.id = fts.rowid
+    WHERE fts MATCH ? AND {:s} ORDER BY fts.rank""".format(plan.filter_where),
+              (plan.fts_expr,) + plan.filter_params)
+    hits = {}       # bibkey: [score, best rank, rowid of the best match, attachment]
+    for rank, (bibkey, id_) in enumerate(c.fetchall(), 1):
+        hits[bibkey] = [1 / (ATTACH_RRF_K + rank), rank, id_, '']
+    if attachments and plan.att_expr:
+        # the best chunk of each note
+        c.execute(""" SELECT bibkey, chunk_id, attachment.name FROM (
+            SELECT note.bibkey AS bibkey, fts_att.rowid AS chunk_id,
+            chunk.attachment_id AS att_id, fts_att.rank AS r, row_number()
+            OVER (PARTITION BY chunk.note_id ORDER BY fts_att.rank) AS i
+            FROM fts_att JOIN attachment_chunk AS chunk ON chunk.id = fts_att.rowid
+            JOIN note ON note.id = chunk.note_id
+            WHERE fts_att MATCH ? AND {:s})
+        JOIN attachment ON attachment.id = att_id
+        WHERE i = 1 ORDER BY r""".format(plan.att_where),
+                  (plan.att_expr,) + plan.att_params)
+        for rank, (bibkey, chunk_id, name) in enumerate(c.fetchall(), 1):
+            hit = hits.setdefault(bibkey, [0.0, None, None, ''])
+            hit[0] += 1 / (ATTACH_RRF_K + rank)
+            if hit[1] is None or rank < hit[1]:
+                hit[1:] = [rank, chunk_id, name]
+    ranked = sorted(hits.items(), key=lambda item: (-item[1][0], item[0]))
+    results = []
+    for i, (bibkey, (score, rank, rowid, name)) in enumerate(ranked):
+        snippet = ''
+        if snippets is None or i < snippets:
+            # snippets only for the hits shown
+            table, expr = ('fts_att', plan.att_expr) if name else ('fts', plan.fts_expr)
+            c.execute(""" SELECT snippet({0:s}, -1, '[', ']', '...', ?)
+            FROM {0:s} WHERE {0:s} MATCH ? AND rowid = (?)""".format(table),
+                      (SNIPPET_TOKENS, expr, rowid))
+            snippet = c.fetchone()[0]
+        results.append(SearchHit(bibkey, score, snippet, name))
+    return results
+
+
+def db_search_bibkey(c, keyword):
+    """ Query bibkeys that matches fields with keyword
+    :argument
+        c: sqlite3 cursor
+        keyword: str
+    :returns
+        bibkeys: list of matched bibkeys
+    """
+
+    pattern = '%{:s}%'.format(keyword.replace('\\', '\\\\')
+                              .replace('%', '\\%').replace('_', '\\_'))
+    sql = """ SELECT bibkey FROM note WHERE bibkey LIKE ? ESCAPE '\\'
+    ORDER BY bibkey ASC """
+    c.execute(sql, (pattern,))
+    return list(res[0] for res in c.fetchall())
+
+
+# quick switcher: half life of the weight of a visit, lines ranked per
+# search, and the part of the author list that is searched
+QUICK_HALF_LIFE_DAYS = 14
+QUICK_CANDIDATES = 200
+QUICK_AUTHOR_CHARS = 80
+
+
+class QuickIndex:
+    """ In-memory index of bibkeys and authors for the quick switcher.
+
+    Notes are lines of two lower case texts, "bibkey<tab>author" and
+    "bibkey", kept in order of frecency (frequency and recency of visits),
+    with the last visited and new notes moved to the front. A search finds
+    the query in the first text, and its letters in order in the bibkeys
+    with one compiled regex, both scans running in C. The first
+    matching lines are the most frecent ones; they are ranked by match
+    quality, then frecency.
+
+    Lines rejected by a query are also rejected by its extensions, so while
+    a query is typed each keystroke only scans the lines the previous one
+    matched, and those it did not reach. """
+
+    def __init__(self, rows):
+        """ rows: iterable of (bibkey, author, visits, last visit time) """
+        self._visits = {}
+        self._bibkeys = {}      # lower case: bibkey
+        entries = []
+        now = time.time()
+        for bibkey, author, n, last in rows:
+            if n:
+                self._visits[bibkey] = (n, last)
+            self._bibkeys[bibkey.lower()] = bibkey
+            entries.append((self._frecency(bibkey, now), bibkey.lower(), self._author(author)))
+        entries.sort(key=lambda e: -e[0])    # stable: ties keep the row order
+        self._text = '\n' + ''.join('{:s}\t{:s}\n'.format(k, a) for f, k, a in entries)
+        self._keys = '\n' + ''.join(k + '\n' for f, k, a in entries)
+        self._narrow = {}       # per scan: (query, lines matched, text, position)
+
+    @staticmethod
+    def _author(author):
+        return (author or '')[:QUICK_AUTHOR_CHARS].lower().replace('\n', ' ').replace('\t', ' ')
+
+    def _frecency(self, bibkey, now):
+        if bibkey not in self._visits:
+            return 0.
+        n, last = self._visits[bibkey]
+        return (1 + log(n)) * 0.5 ** ((now - last) / (86400 * QUICK_HALF_LIFE_DAYS))
+
+    def _move(self, key, line):
+        """ Remove the lines of lower case bibkey key, and put line (with
+        author) and key at the front unless line is None """
+        i = self._text.find('\n{:s}\t'.format(key))
+        if i >= 0:
+            self._text = self._text[:i] + self._text[self._text.find('\n', i + 1):]
+        i = self._keys.find('\n{:s}\n'.format(key))
+        if i >= 0:
+            self._keys = self._keys[:i] + self._keys[i + len(key) + 1:]
+        if line is not None:
+            self._text = '\n' + line + self._text
+            self._keys = '\n' + key + self._keys
+        self._narrow = {}
+
+    def __len__(self):
+        return len(self._bibkeys)
+
+    def add(self, bibkey, author):
+        """ Add a new note at the front, or update the author of a note """
+        key = bibkey.lower()
+        self._bibkeys[key] = bibkey
+        self._move(key, '{:s}\t{:s}'.format(key, self._author(author)))
+
+    def remove(self, bibkey):
+        key = bibkey.lower()
+        if self._bibkeys.get(key) == bibkey:
+            del self._bibkeys[key]
+            self._move(key, None)
+        self._visits.pop(bibkey, None)
+
+    def visit(self, bibkey):
+        """ Count a visit of bibkey and move it to the front """
+        n, last = self._visits.get(bibkey, (0, 0))
+        self._visits[bibkey] = (n + 1, time.time())
+        key = bibkey.lower()
+        i = self._text.find('\n{:s}\t'.format(key))
+        if i >= 0:
+            self._move(key, self._text[i + 1:self._text.find('\n', i + 1)])
+
+    def search(self, query, n=20):
+        """ Return up to n bibkeys matching query, best first. Match quality
+        is, from best: prefix of the bibkey, part of the bibkey, part of the
+        author, letters of the bibkey in order (tighter first). """
+        q = query.strip().lower()
+        if not q:
+            keys = self._keys[1:].split('\n', n)[:n]
+            return list(self._bibkeys[k] for k in keys if k)
+        if '\n' in q or '\t' in q:
+            return []
+        found = {}      # lower case bibkey: order found
+        # re finds short strings faster than str.find, except single letters
+        literal = q if len(q) == 1 else re.compile(re.escape(q))
+        for line in self._scan('literal', self._text, q, literal):
+            found.setdefault(line.split('\t', 1)[0], len(found))
+        fuzzy = None
+        if len(found) < n and len(q) > 1:
+            # scattered letters only rank after the literal matches
+            fuzzy = re.compile(''.join(
+                    re.escape(ch) if i == 0 else '[^\n{0:s}]*{0:s}'.format(re.escape(ch))
+                    for i, ch in enumerate(q)))
+            for key in self._scan('fuzzy', self._keys, q, fuzzy):
+                found.setdefault(key, len(found))
+        now = time.time()
+        ranked = []
+        for key, order in found.items():
+            if key.startswith(q):
+                tier, span = 0, 0
+            elif q in key:
+                tier, span = 1, 0
+            else:
+                m = fuzzy.search(key) if fuzzy else None
+                tier, span = (3, m.end() - m.start()) if m else (2, 0)
+            bibkey = self._bibkeys[key]
+            ranked.append((tier, -self._frecency(bibkey, now), span, order, bibkey))
+        ranked.sort()
+        return list(r[-1] for r in ranked[:n])
+
+    def _scan(self, name, text, q, pattern):
+        """ Return the first QUICK_CANDIDATES lines of text that pattern
+        (a compiled regex or a string) matches, and keep what the extensions
+        of q have to scan """
+        narrow = self._narrow.get(name)
+        if narrow and q.startswith(narrow[0]):
+            parts = [[narrow[1], 0], [narrow[2], narrow[3]]]
+        else:
+            parts = [['', 0], [text, 0]]
+        lines = []
+        for part in parts:
+            text, pos = part
+            while len(lines) < QUICK_CANDIDATES:
+                if isinstance(pattern, str):
+                    i = text.find(pattern, pos)
+                else:
+                    m = pattern.search(text, pos)
+                    i = m.start() if m else -1
+                if i < 0:
+                    pos = len(text)
+                    break
+                start = text.rfind('\n', 0, i) + 1
+                pos = text.find('\n', i)
+                lines.append(text[start:pos])
+            part[1] = pos
+        # the lines up to pos that did not match are out for good; the long
+        # text is kept as it is, with the position to resume from
+        head, pos = parts[0]
+        self._narrow[name] = (q, '\n' + ''.join(line + '\n' for line in lines) +
+                              head[pos + 1:], parts[1][0], parts[1][1])
+        return lines
+
+
+def db_load_quick_index(c):
+    """ Return the QuickIndex of all notes, newest first among equals """
+    c.execute(""" SELECT note.bibkey, note.author, COALESCE(v.n, 0), COALESCE(v.last, 0)
+    FROM note_plain AS note LEFT JOIN note_visit AS v ON v.note_id = note.id
+    ORDER BY note.id DESC""")
+    return QuickIndex(c.fetchall())
+
+
+def db_record_visit(conn, c, bibkey):
+    """ Count a visit of note bibkey for the ranking of the quick switcher """
+    c.execute(""" INSERT INTO note_visit (note_id, n, last)
+    SELECT id, 1, (?) FROM note WHERE bibkey = (?)
+    ON CONFLICT (note_id) DO UPDATE SET n = n + 1, last = excluded.last""",
+              (time.time(), bibkey))
+    conn.commit()
@@ -0,0 +1,326 @@
+#! encoding = utf-8
+
+""" Image storage backends of liternote. Images are stored as encoded bytes
+(png, ...) under their link name, the names listed in note.img_linkstr.
+
+    file        one file per image in img/ (the original layout)
+    sqlite      blobs in img/liternote_img.db, read with incremental blob I/O
+    pack        one append-only pack file img/liternote_img.pack with an
+                offset index in img/liternote_img.idx
+
+Only depends on the standard library.
+"""
+
+import os
+import sqlite3
+import threading
+from os.path import isfile, isdir, getsize
+from os.path import join as path_join
+
+IMAGE_BACKENDS = ['file', 'sqlite', 'pack']
+IMAGE_DEFAULT_BACKEND = 'file'
+# how pasted images are downscaled and encoded, see liternote.encode_img
+IMAGE_FORMATS = ['auto', 'png', 'webp', 'jpeg']
+IMAGE_POLICY_DEFAULT = {
+    'max_dim': 1920,        # longest side in pixels, 0 keeps the full size
+    'format': 'auto',       # png for diagrams, webp (or jpeg) for photos
+    'quality': 85,          # quality of webp / jpeg
+    'png_level': 6,         # zlib compression level of png
+    'quantize': False,      # reduce diagrams to a 256 color palette
+}
+_STORE_FILES = ('liternote_img.db', 'liternote_img.db-journal',
+                'liternote_img.db-wal', 'liternote_img.db-shm',
+                'liternote_img.pack', 'liternote_img.idx')
+
+
+class FileImageStore:
+    """ One file per image """
+
+    backend = 'file'
+
+    def __init__(self, dirname):
+        self._dir = dirname
+        if not isdir(dirname):
+            os.makedirs(dirname)
+
+    def read(self, name):
+        """ Return the bytes of image name, or None if it does not exist """
+        try:
+            with open(path_join(self._dir, name), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def write(self, name, data):
+        with open(path_join(self._dir, name), 'wb') as f:
+            f.write(data)
+
+    def exists(self, name):
+        return isfile(path_join(self._dir, name))
+
+    def signature(self, name):
+        """ Return a value that changes whenever image name is rewritten,
+        or None if it does not exist. Used to skip unchanged images. """
+        try:
+            st = os.stat(path_join(self._dir, name))
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def delete(self, name):
+        filename = path_join(self._dir, name)
+        if isfile(filename):
+            os.remove(filename)
+
+    def names(self):
+        """ Iterate over the names of all stored images """
+        with os.scandir(self._dir) as it:
+            for entry in it:
+                if entry.name not in _STORE_FILES and entry.is_file():
+                    yield entry.name
+
+    def close(self):
+        pass
+
+
+class SqliteImageStore:
+    """ Images as blobs in a sqlite database of their own """
+
+    backend = 'sqlite'
+    chunk = 1 << 16     # bytes per incremental blob read
+
+    def __init__(self, dirname):
+        if not isdir(dirname):
+            os.makedirs(dirname)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path_join(dirname, 'liternote_img.db'),
+                                     check_same_thread=False)
+        self._conn.execute(""" CREATE TABLE IF NOT EXISTS img (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            data BLOB NOT NULL
+        );""")
+        self._conn.commit()
+
+    def read(self, name):
+        with self._lock:
+            res = self._conn.execute('SELECT id, LENGTH(data) FROM img WHERE name = (?)',
+                                     (name,)).fetchall()
+            if not res:
+                return None
+            id_, size = res[0]
+            if not hasattr(self._conn, 'blobopen'):     # python < 3.11
+                return self._conn.execute('SELECT data FROM img WHERE id = (?)',
+                                          (id_,)).fetchone()[0]
+            parts = []
+            with self._conn.blobopen('img', 'data', id_, readonly=True) as blob:
+                while size > 0:
+                    part = blob.read(min(self.chunk, size))
+                    parts.append(part)
+                    size -= len(part)
+            return b''.join(parts)
+
+    def write(self, name, data):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO img (name, data) VALUES (?, ?)',
+                               (name, sqlite3.Binary(data)))
+            self._conn.commit()
+
+    def exists(self, name):
+        with self._lock:
+            return bool(self._conn.execute('SELECT 1 FROM img WHERE name = (?)',
+                                           (name,)).fetchall())
+
+    def signature(self, name):
+        # INSERT OR REPLACE gives a rewritten image a new id
+        with self._lock:
+            res = self._conn.execute('SELECT id, LENGTH(data) FROM img WHERE name = (?)',
+                                     (name,)).fetchall()
+        return list(res[0]) if res else None
+
+    def delete(self, name):
+        with self._lock:
+            self._conn.execute('DELETE FROM img WHERE name = (?)', (name,))
+            self._conn.commit()
+
+    def names(self):
+        with self._lock:
+            names = list(r[0] for r in self._conn.execute('SELECT name FROM img'))
+        return iter(names)
+
+    def close(self):
+        self._conn.close()
+
+
+class PackImageStore:
+    """ Images appended to one pack file. The index file is append-only as
+    well: each line is "name offset length", a length of -1 deletes name.
+    Dead space is reclaimed by compact(). """
+
+    backend = 'pack'
+
+    def __init__(self, dirname):
+        if not isdir(dirname):
+            os.makedirs(dirname)
+        self._lock = threading.Lock()
+        self._pack_name = path_join(dirname, 'liternote_img.pack')
+        self._idx_name = path_join(dirname, 'liternote_img.idx')
+        self._index = {}    # name: (offset, length)
+        if isfile(self._idx_name):
+            with open(self._idx_name, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        name, offset, length = line.rstrip('\n').rsplit(' ', 2)
+                        offset, length = int(offset), int(length)
+                    except ValueError:      # torn last line
+                        continue
+                    if length < 0:
+                        self._index.pop(name, None)
+                    else:
+                        self._index[name] = (offset, length)
+        self._pack = open(self._pack_name, 'a+b')
+        self._idx = open(self._idx_name, 'a', encoding='utf-8')
+
+    def read(self, name):
+        with self._lock:
+            if name not in self._index:
+                return None
+            offset, length = self._index[name]
+            self._pack.seek(offset)
+            return self._pack.read(length)
+
+    def write(self, name, data):
+        with self._lock:
+            self._pack.seek(0, os.SEEK_END)
+            offset = self._pack.tell()
+            self._pack.write(data)
+            self._pack.flush()
+            os.fsync(self._pack.fileno())
+            # the index line is written after the data is durable
+            self._idx.write('{:s} {:d} {:d}\n'.format(name, offset, len(data)))
+            self._idx.flush()
+            self._index[name] = (offset, len(data))
+
+    def exists(self, name):
+        return name in self._index
+
+    def signature(self, name):
+        # rewritten images are appended at a new offset
+        with self._lock:
+            return list(self._index[name]) if name in self._index else None
+
+    def delete(self, name):
+        with self._lock:
+            if name in self._index:
+                self._idx.write('{:s} 0 -1\n'.format(name))
+                self._idx.flush()
+                del self._index[name]
+
+    def names(self):
+        with self._lock:
+            names = list(self._index)
+        return iter(names)
+
+    def dead_bytes(self):
+        """ Return the size of deleted or overwritten data in the pack """
+        with self._lock:
+            live = sum(length for offset, length in self._index.values())
+            return getsize(self._pack_name) - live
+
+    def compact(self):
+        """ Rewrite the pack and index without dead space """
+        with self._lock:
+            tmp_pack = self._pack_name + '.tmp'
+            tmp_idx = self._idx_name + '.tmp'
+            new_index = {}
+            with open(tmp_pack, 'wb') as fp, open(tmp_idx, 'w', encoding='utf-8') as fi:
+                for name, (offset, length) in self._index.items():
+                    self._pack.seek(offset)
+                    new_index[name] = (fp.tell(), length)
+                    fp.write(self._pack.read(length))
+                    fi.write('{:s} {:d} {:d}\n'.format(name, *new_index[name]))
+                fp.flush()
+                os.fsync(fp.fileno())
+            self._pack.close()
+            self._idx.close()
+            os.replace(tmp_pack, self._pack_name)
+            os.replace(tmp_idx, self._idx_name)
+            self._index = new_index
+            self._pack = open(self._pack_name, 'a+b')
+            self._idx = open(self._idx_name, 'a', encoding='utf-8')
+
+    def close(self):
+        self._pack.close()
+        self._idx.close()
+
+
+def open_image_store(backend, dirname):
+    """ Open the image store of backend in directory dirname """
+    if backend == 'file':
+        return FileImageStore(dirname)
+    elif backend == 'sqlite':
+        return SqliteImageStore(dirname)
+    elif backend == 'pack':
+        return PackImageStore(dirname)
+    else:
+        raise ValueError('Unknown image backend: {:s}'.format(backend))
+
+
+def migrate_images(src, dst, delete_src=False, progress=None):
+    """ Copy every image from store src to store dst
+    :argument
+        src, dst: image stores
+        delete_src: bool        remove each image from src once copied
+        progress: callable      progress(n_done) called every 100 images
+    :returns
+        n: int                  number of images copied
+    """
+    n = 0
+    for name in list(src.names()):
+        data = src.read(name)
+        if data is None:
+            continue
+        if not dst.exists(name):
+            dst.write(name, data)
+        if delete_src:
+            src.delete(name)
+        n += 1
+        if progress and n % 100 == 0:
+            progress(n)
+    return n
+
+
+def check_images(store, links):
+    """ Compare the links used by notes with the images in the store. The
+    links are consumed once into a set, then the store is walked once, so
+    the check is linear in the number of links and images.
+    :argument
+        store: image store
+        links: iterable of str  every link of every note
+    :returns
+        orphans: list of str    stored images no note links to
+        dangling: list of str   links without a stored image
+    """
+    refs = set(links)
+    orphans = []
+    for name in store.names():
+        if name in refs:
+            refs.discard(name)
+        else:
+            orphans.append(name)
+    return orphans, sorted(refs)
+
+
+def collect_garbage(store, links, dry_run=True):
+    """ Delete the stored images no note links to
+    :returns
+        orphans: list of str    orphaned images (deleted unless dry_run)
+        dangling: list of str   links without a stored image
+    """
+    orphans, dangling = check_images(store, links)
+    if not dry_run:
+        for name in orphans:
+            store.delete(name)
+        if isinstance(store, PackImageStore) and orphans:
+            store.compact()
+    return orphans, dangling
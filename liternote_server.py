@@ -0,0 +1,254 @@
+#! encoding = utf-8
+
+""" Local HTTP / JSON query server of liternote for editor plugins and
+scripts. Reads are served from a pool of read-only sqlite connections,
+writes go through a single writer connection.
+
+Endpoints:
+    GET  /search?q=QUERY[&field=F][&genre=G][&tag=T...]    -> [bibkey]
+         ...&attachments=1     also search the attachments, by rank
+    GET  /entry/BIBKEY                                     -> note with tags
+    PUT  /entry/BIBKEY   (JSON body, fields and "tags")    -> note with tags
+    GET  /tags                                             -> [tag]
+    GET  /tags/TAG                                         -> [bibkey]
+    GET  /related/BIBKEY[?n=N]                             -> [[bibkey, score]]
+    GET  /links/BIBKEY          -> {"cites": [[bibkey, kind]], "cited_by": [...]}
+    GET  /links/BIBKEY?hops=N                              -> [[bibkey, distance]]
+
+GET /entry answers with an ETag, and with 304 Not Modified when the
+request carries a matching If-None-Match header.
+
+Usage: liternote-server [--db FILE] [--host HOST] [--port PORT] [--readers N]
+"""
+
+import argparse
+import hashlib
+import json
+import queue
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from liternote_db import (
+    DB_FILE, FTS_FIELDS, create_or_open_db, open_db_readonly, db_bibkey_id,
+    db_select_entry, db_upsert_entry, db_query_all_tags, db_search_fulltext,
+    db_search_tag, db_related, db_links, db_link_neighbourhood,
+)
+
+ENTRY_FIELDS = ['bibkey', 'author', 'genre', 'thesis', 'hypothesis',
+                'method', 'finding', 'comment', 'img_linkstr']
+
+
+class ConnectionPool:
+    """ A fixed pool of read-only connections plus one writer connection """
+
+    def __init__(self, filename, n_readers=4):
+        self._writer, self._writer_cursor = create_or_open_db(
+                filename, check_same_thread=False)
+        # readers do not block the writer and vice versa in WAL mode
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        self._writer_lock = threading.Lock()
+        self._readers = queue.Queue()
+        for _ in range(n_readers):
+            self._readers.put(open_db_readonly(filename))
+
+    @contextmanager
+    def reader(self):
+        conn = self._readers.get()
+        try:
+            yield conn.cursor()
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def writer(self):
+        with self._writer_lock:
+            try:
+                yield self._writer, self._writer_cursor
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    def close(self):
+        while not self._readers.empty():
+            self._readers.get().close()
+        self._writer.close()
+
+
+def entry_etag(body):
+    """ Return the ETag of a serialized note """
+    return '"{:s}"'.format(hashlib.sha1(body).hexdigest())
+
+
+def dump_entry(entry_dict, tags):
+    entry_dict = dict(entry_dict)
+    entry_dict['tags'] = list(tags)
+    return json.dumps(entry_dict, ensure_ascii=False).encode('utf-8')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'     # keep-alive for clients polling often
+    disable_nagle_algorithm = True
+    server_version = 'liternote'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, etag=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, context):
+        self.send_json(status, {'error': context})
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        try:
+            if parts == ['search']:
+                self.get_search(parse_qs(url.query))
+            elif len(parts) == 2 and parts[0] == 'entry':
+                self.get_entry(parts[1])
+            elif parts == ['tags']:
+                with self.server.pool.reader() as c:
+                    self.send_json(200, list(db_query_all_tags(c)))
+            elif len(parts) == 2 and parts[0] == 'tags':
+                with self.server.pool.reader() as c:
+                    self.send_json(200, db_search_tag(c, parts[1]))
+            elif len(parts) == 2 and parts[0] == 'related':
+                n = int(parse_qs(url.query).get('n', ['10'])[0])
+                with self.server.pool.reader() as c:
+                    self.send_json(200, db_related(c, parts[1], n=n))
+            elif len(parts) == 2 and parts[0] == 'links':
+                hops = parse_qs(url.query).get('hops')
+                with self.server.pool.reader() as c:
+                    if hops:
+                        self.send_json(200, db_link_neighbourhood(c, parts[1], int(hops[0])))
+                    else:
+                        self.send_json(200, {'cites': db_links(c, parts[1]),
+                                             'cited_by': db_links(c, parts[1], True)})
+            else:
+                self.send_error_json(404, 'Not found')
+        except (sqlite3.Error, ValueError) as err:
+            self.send_error_json(400, str(err))
+
+    def do_PUT(self):
+        url = urlsplit(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        if len(parts) == 2 and parts[0] == 'entry':
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                data = json.loads(self.rfile.read(length).decode('utf-8'))
+                self.put_entry(parts[1], data)
+            except (sqlite3.Error, ValueError) as err:
+                self.send_error_json(400, str(err))
+        else:
+            self.send_error_json(404, 'Not found')
+
+    def get_search(self, query):
+        keyword = query.get('q', [''])[0]
+        field = query.get('field', ['ALL'])[0]
+        genre = query.get('genre', ['ALL'])[0]
+        tags = query.get('tag', [])
+        attachments = query.get('attachments', ['0'])[0] == '1'
+        if not keyword:
+            raise ValueError('Missing query parameter q')
+        with self.server.pool.reader() as c:
+            bibkeys = db_search_fulltext(c, field, genre, keyword, tags=tags,
+                                         attachments=attachments)
+        self.send_json(200, bibkeys)
+
+    def get_entry(self, bibkey):
+        with self.server.pool.reader() as c:
+            if not db_bibkey_id(c, bibkey):
+                self.send_error_json(404, 'Bibkey not found: {:s}'.format(bibkey))
+                return
+            body = dump_entry(*db_select_entry(c, bibkey))
+        etag = entry_etag(body)
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_json(200, body, etag=etag)
+
+    def put_entry(self, bibkey, data):
+        if not isinstance(data, dict):
+            raise ValueError('Entry must be a JSON object')
+        fields = {}
+        for field in ['genre'] + FTS_FIELDS:
+            if field in data:
+                value = data[field]
+                if value is not None and not isinstance(value, str):
+                    raise ValueError('Field {:s} must be a string'.format(field))
+                fields[field] = value or ''
+        tags = data.get('tags', [])
+        if not (isinstance(tags, list) and all(isinstance(t, str) for t in tags)):
+            raise ValueError('Tags must be a list of strings')
+        with self.server.pool.writer() as (conn, c):
+            if db_bibkey_id(c, bibkey):
+                entry_dict, old_tags = db_select_entry(c, bibkey)
+                if 'tags' not in data:
+                    tags = old_tags
+            else:
+                entry_dict = {field: '' for field in ENTRY_FIELDS}
+                entry_dict['genre'] = 'Theory'
+            entry_dict.update(fields)
+            entry_dict['bibkey'] = bibkey
+            db_upsert_entry(conn, c, entry_dict, tags=tags)
+            body = dump_entry(*db_select_entry(c, bibkey))
+        self.send_json(200, body, etag=entry_etag(body))
+
+
+class LiternoteServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, filename, n_readers=4, verbose=False):
+        self.pool = ConnectionPool(filename, n_readers=n_readers)
+        self.verbose = verbose
+        super().__init__(address, RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='liternote-server',
+                                     description='Local JSON query server')
+    parser.add_argument('--db', default=DB_FILE, help='database file')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--readers', type=int, default=4,
+                        help='number of read-only connections')
+    parser.add_argument('--verbose', action='store_true', help='log requests')
+    args = parser.parse_args(argv)
+
+    server = LiternoteServer((args.host, args.port), args.db,
+                             n_readers=args.readers, verbose=args.verbose)
+    print('Serving {:s} on http://{:s}:{:d}'.format(args.db, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
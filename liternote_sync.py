@@ -0,0 +1,107 @@
+#! encoding = utf-8
+
+""" Sync two copies of a liternote library with delta bundles.
+
+A bundle is a zip file holding the changes of the change log since a
+version (changes.json) and the images linked by the notes whose image
+links changed (img/NAME). Applying a bundle merges it field by field,
+the latest edit winning, and adds the images the library does not have.
+
+Only depends on the standard library.
+"""
+
+import json
+import uuid
+import zipfile
+from os.path import basename, isabs
+
+from liternote_db import (
+    db_get_setting, db_set_setting, db_sync_version, db_sync_changes,
+    db_apply_changes,
+)
+
+BUNDLE_FORMAT = 1
+
+
+class SameSiteError(ValueError):
+    """ The bundle carries the site of this library: it was exported from
+    it, or from a copy of its database file """
+
+
+def export_bundle(conn, c, store, filename, since=None):
+    """ Write the changes made after version since to a bundle
+    :argument
+        conn: sqlite3 connection
+        c: sqlite3 cursor
+        store: image store
+        filename: str           bundle file
+        since: int              default the version of the last export
+    :returns
+        info: dict              site, since, version, number of notes and images
+    """
+    if since is None:
+        since = int(db_get_setting(c, 'sync_exported', '0'))
+    version = db_sync_version(c)
+    changes = db_sync_changes(c, since)
+    links = set()
+    for entry in changes.values():
+        value = entry.get('img_linkstr', [None])[0]
+        if value:
+            links.update(l for l in value.split(',') if l)
+    n_img = 0
+    with zipfile.ZipFile(filename, 'w') as bundle:
+        bundle.writestr('changes.json', json.dumps({
+            'format': BUNDLE_FORMAT, 'site': db_get_setting(c, 'sync_site'),
+            'since': since, 'version': version, 'changes': changes,
+        }, ensure_ascii=False), compress_type=zipfile.ZIP_DEFLATED)
+        for link in sorted(links):
+            data = store.read(link)
+            if data is not None:
+                # images are compressed already
+                bundle.writestr('img/' + link, data, compress_type=zipfile.ZIP_STORED)
+                n_img += 1
+    db_set_setting(conn, c, 'sync_exported', str(version))
+    return {'site': db_get_setting(c, 'sync_site'), 'since': since,
+            'version': version, 'notes': len(changes), 'images': n_img}
+
+
+def apply_bundle(conn, c, store, filename):
+    """ Merge a bundle into the library
+    :returns
+        info: dict              remote site and version, notes changed,
+                                images added
+    """
+    with zipfile.ZipFile(filename) as bundle:
+        data = json.loads(bundle.read('changes.json').decode('utf-8'))
+        if data.get('format') != BUNDLE_FORMAT:
+            raise ValueError('Unknown bundle format: {!r}'.format(data.get('format')))
+        if data['site'] == db_get_setting(c, 'sync_site'):
+            raise SameSiteError('The bundle was exported from this library, or from '
+                                'a copy of it: give one of the two a new site to sync')
+        # image names are joined to the image directory, none may leave it
+        for name in bundle.namelist():
+            if name.startswith('img/'):
+                link = name[4:]
+                if link and (basename(link) != link or '\\' in link or
+                             '..' in link or isabs(link)):
+                    raise ValueError('Invalid image name in bundle: {!r}'.format(name))
+        n_img = 0
+        for name in bundle.namelist():
+            if name.startswith('img/') and name[4:] and not store.exists(name[4:]):
+                store.write(name[4:], bundle.read(name))
+                n_img += 1
+    applied = db_apply_changes(conn, c, data['changes'])
+    return {'site': data['site'], 'version': data['version'],
+            'notes': len(applied), 'images': n_img}
+
+
+def reset_site(conn, c):
+    """ Give the library a new site, for a copy of a database file that is
+    then synced with the original. Edits made so far keep the site they
+    were made at.
+    :returns
+        site: str               the new site
+    """
+    site = uuid.uuid4().hex
+    db_set_setting(conn, c, 'sync_site', site)
+    return site
@@ -7,15 +7,20 @@ setup(name='liternote',
       description='Simple Literature Note Editor',
       author='Luyao Zou',
       packages=find_packages('.'),
+      py_modules=['liternote', 'liternote_db', 'liternote_img', 'liternote_cli',
+                  'liternote_server', 'liternote_sync',
+                  'liternote_backup', 'liternote_attach'],
       entry_points={
         'gui_scripts': [
             'liternote = liternote:launch',
+        ],
+        'console_scripts': [
+            'liternote-cli = liternote_cli:main',
+            'liternote-server = liternote_server:main',
         ]},
+      python_requires='>=3.9',
       install_requires=[
             'PyQt5>=5.10',
         ],
-      extras_require={
-        ':python_version<"3.7"': ['importlib_resources'],
-      },
       license='MIT',
 )
@@ -0,0 +1,9 @@
+#! encoding = utf-8
+
+import os
+import sys
+from os.path import dirname, realpath
+
+# the suite drives the GUI without a display
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, dirname(dirname(realpath(__file__))))
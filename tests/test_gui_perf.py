@@ -0,0 +1,238 @@
+#! encoding = utf-8
+
+""" Performance regression tests of the GUI. A MainWindow is driven under
+the offscreen Qt platform against a synthetic library whose notes have many
+images and tags, and the latency of entry switch, save, search and opening
+the tag dialog is compared with the thresholds in perf_thresholds.json.
+Widget allocations and the peak memory are checked as well.
+
+Latencies are medians over repeated operations. On a slow machine, scale
+all thresholds with LITERNOTE_PERF_SCALE, e.g. LITERNOTE_PERF_SCALE=2.
+
+Usage: python -m pytest tests
+"""
+
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from os.path import dirname, realpath
+from os.path import join as path_join
+
+import pytest
+
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+from PyQt5 import QtCore
+from PyQt5.QtGui import QImage, QPainter, QColor
+
+import liternote
+import liternote_db as ln
+from liternote_img import IMAGE_DEFAULT_BACKEND, open_image_store
+
+N_NOTES = 1000
+N_IMAGES = 60           # images in the library, shared between notes
+N_TAGS = 400            # tags in the library
+IMAGES_PER_NOTE = 20
+TAGS_PER_NOTE = 30
+N_SWITCH = 40           # notes switched between
+N_REPEAT = 20
+QUERIES = ['spectrum', 'rotational transition', 'mol*', 'laboratory -survey']
+THRESHOLDS = path_join(dirname(realpath(__file__)), 'perf_thresholds.json')
+
+
+def threshold(name):
+    with open(THRESHOLDS, encoding='utf-8') as f:
+        limit = json.load(f)[name]
+    return limit * float(os.environ.get('LITERNOTE_PERF_SCALE', '1'))
+
+
+def timed(f, args_list):
+    """ Return the median latency of f(*args) over args_list in ms """
+    latency = []
+    for args in args_list:
+        t0 = time.perf_counter()
+        f(*args)
+        latency.append((time.perf_counter() - t0) * 1e3)
+    return statistics.median(latency)
+
+
+def synthetic_png(rnd):
+    """ A diagram-like image: a few filled rectangles on white """
+    img = QImage(480, 360, QImage.Format_RGB32)
+    img.fill(QColor('white'))
+    painter = QPainter(img)
+    for _ in range(30):
+        painter.fillRect(rnd.randrange(440), rnd.randrange(320),
+                         rnd.randint(4, 40), rnd.randint(4, 40),
+                         QColor(rnd.randrange(256), rnd.randrange(256),
+                                rnd.randrange(256)))
+    painter.end()
+    buf = QtCore.QBuffer()
+    buf.open(QtCore.QIODevice.WriteOnly)
+    img.save(buf, 'PNG')
+    return bytes(buf.data())
+
+
+def fill_library(root):
+    """ Write the database and images of a synthetic library in root.
+    Return the bibkeys of the notes. """
+    rnd = random.Random(0)
+    words = ['spectrum', 'rotational', 'transition', 'molecule', 'laboratory',
+             'survey'] + list('w{:04d}'.format(i) for i in range(3000))
+    weights = list(1 / (i + 1) for i in range(len(words)))
+
+    def text(n):
+        return ' '.join(rnd.choices(words, weights, k=n))
+
+    store = open_image_store(IMAGE_DEFAULT_BACKEND, path_join(root, 'img'))
+    links = list('img{:03d}.png'.format(i) for i in range(N_IMAGES))
+    for link in links:
+        store.write(link, synthetic_png(rnd))
+    store.close()
+    tags = list('tag{:03d}'.format(i) for i in range(N_TAGS))
+    bibkeys = list('key{:05d}'.format(i) for i in range(N_NOTES))
+    conn, c = ln.create_or_open_db(path_join(root, 'liternote.db'))
+    c.execute('PRAGMA synchronous=OFF')
+    for bibkey in bibkeys:
+        entry_dict = {
+            'bibkey': bibkey, 'author': text(6), 'genre': 'Theory',
+            'thesis': text(40), 'hypothesis': text(30),
+            'method': text(rnd.randint(100, 1000)),
+            'finding': text(rnd.randint(100, 600)), 'comment': text(20),
+            'img_linkstr': ','.join(rnd.sample(links, IMAGES_PER_NOTE)),
+        }
+        ln.db_insert_entry(conn, c, entry_dict, tags=rnd.sample(tags, TAGS_PER_NOTE))
+    # the window would build these at start up
+    ln.db_rebuild_similar(conn, c)
+    ln.db_rebuild_links(conn, c)
+    ln.db_set_setting(conn, c, 'backup_interval_min', '0')
+    conn.close()
+    return bibkeys
+
+
+def process_events(window):
+    """ Run the event loop until the entry is fully shown """
+    app = QtWidgets.QApplication.instance()
+    app.processEvents()
+    while window.mw._texts is not None:
+        app.processEvents()
+    app.processEvents()
+
+
+def n_pooled_widgets():
+    return sum(pool.n_created for pool in liternote._POOLS.values())
+
+
+@pytest.fixture(scope='module')
+def window(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('library'))
+    bibkeys = fill_library(root)
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    app.setStyleSheet(liternote.APP_STYLESHEET)
+    mp = pytest.MonkeyPatch()
+    mp.setattr(liternote, 'ROOT', root)
+    mp.setattr(QtWidgets.QMessageBox, 'question',
+               lambda *args: QtWidgets.QMessageBox.No)
+
+    def fail(title='', context='', style=''):
+        raise AssertionError('{:s}: {:s}'.format(title, context))
+
+    mp.setattr(liternote, 'msg', fail)
+    win = liternote.MainWindow()
+    process_events(win)
+    win.bibkeys = bibkeys
+    yield win
+    win.close()
+    mp.undo()
+
+
+def test_entry_switch(window):
+    keys = window.bibkeys[:N_SWITCH]
+
+    def switch(bibkey):
+        window.load_entry(bibkey)
+        process_events(window)
+
+    # the first pass grows the widget pools
+    for bibkey in keys:
+        switch(bibkey)
+    assert window.mw.inpBibKey.text() == keys[-1]
+    assert len(window.mw.gpImage.get_links()) == IMAGES_PER_NOTE
+    assert len(window.mw.tagBox.dispTags.tags()) == TAGS_PER_NOTE
+    t = timed(switch, list((k,) for k in keys))
+    assert t < threshold('entry_switch_ms'), 'entry switch {:.1f} ms'.format(t)
+
+
+def test_switch_allocates_no_widgets(window):
+    app = QtWidgets.QApplication.instance()
+    keys = window.bibkeys[:N_SWITCH]
+    for bibkey in keys:
+        window.load_entry(bibkey)
+        process_events(window)
+    n_pooled = n_pooled_widgets()
+    n_widgets = len(app.allWidgets())
+    for bibkey in reversed(keys):
+        window.load_entry(bibkey)
+        process_events(window)
+    assert n_pooled_widgets() == n_pooled
+    assert len(app.allWidgets()) == n_widgets
+
+
+def test_save(window):
+    bibkey = window.bibkeys[N_SWITCH]
+    window.load_entry(bibkey)
+    process_events(window)
+    rnd = random.Random(1)
+
+    def save():
+        window.mw.editComment.setPlainText('revised {:d}'.format(rnd.randrange(10**6)))
+        window.save_entry()
+        process_events(window)
+
+    t = timed(save, [()] * N_REPEAT)
+    a_dict, tags = ln.db_select_entry(window.cursor, bibkey)
+    assert a_dict['comment'] == window.mw.editComment.toPlainText()
+    assert len(tags) == TAGS_PER_NOTE
+    assert t < threshold('save_ms'), 'save {:.1f} ms'.format(t)
+
+
+def test_search(window):
+    app = QtWidgets.QApplication.instance()
+    window.dialogSearch.show()
+
+    def search(q):
+        window.dialogSearch.inpSearchWord.setText(q)
+        window.search_fulltext()
+        app.processEvents()
+
+    t = timed(search, list((q,) for q in QUERIES * (N_REPEAT // len(QUERIES))))
+    search(QUERIES[0])
+    window.dialogSearch.hide()
+    assert window.dialogSearch.listEntry.count() > 0
+    assert t < threshold('search_ms'), 'search {:.1f} ms'.format(t)
+
+
+def test_tag_dialog_open(window):
+    app = QtWidgets.QApplication.instance()
+    dialog = window.dialogPickSearchTags
+
+    def open_dialog():
+        window.refresh_all_tags()
+        dialog.show()
+        app.processEvents()
+        dialog.hide()
+
+    t = timed(open_dialog, [()] * N_REPEAT)
+    assert len(dialog._list_widgets) == N_TAGS
+    assert t < threshold('tag_dialog_ms'), 'tag dialog {:.1f} ms'.format(t)
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs the resource module')
+def test_peak_rss(window):
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    peak_mb = peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+    assert peak_mb < threshold('peak_rss_mb'), 'peak RSS {:.0f} MB'.format(peak_mb)